@@ -0,0 +1,95 @@
+"""
+Load test for the AI endpoints.
+
+Run the backend with the offline stub provider so no real LLM calls are made:
+
+    LLM_PROVIDER=stub LLM_STUB_LATENCY_MS=lognormal:6.5:0.6 LLM_STUB_ERROR_RATE=0.05 \
+        uvicorn server:app --port 8001
+
+and then point this script at it with a valid session token:
+
+    python benchmarks/ai_load_test.py --session <token> --endpoint tips --requests 200 --concurrency 50
+"""
+import argparse
+import asyncio
+import os
+import time
+from collections import Counter
+
+import httpx
+
+ENDPOINTS = {
+    "tips": "/api/ai/tips",
+    "tips-stream": "/api/ai/tips/stream",
+    "weekly": "/api/ai/weekly-report",
+    "weekly-stream": "/api/ai/weekly-report/stream",
+}
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def run_request(client, path, stream):
+    started = time.perf_counter()
+    first_token = None
+    outcome = None
+    if stream:
+        async with client.stream("POST", path) as resp:
+            outcome = str(resp.status_code)
+            async for line in resp.aiter_lines():
+                if line.startswith("event: token") and first_token is None:
+                    first_token = time.perf_counter() - started
+                elif line.startswith("event: fallback"):
+                    outcome = "fallback"
+    else:
+        resp = await client.post(path)
+        outcome = str(resp.status_code)
+        if resp.status_code == 200:
+            outcome = resp.json().get("source", outcome)
+    return time.perf_counter() - started, first_token, outcome
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Load test the AI endpoints")
+    parser.add_argument("--base-url", default=os.environ.get("REACT_APP_BACKEND_URL", "http://localhost:8001"))
+    parser.add_argument("--session", required=True, help="Session token of a (premium) test user")
+    parser.add_argument("--endpoint", choices=sorted(ENDPOINTS), default="tips")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=20)
+    args = parser.parse_args()
+
+    path = ENDPOINTS[args.endpoint]
+    stream = args.endpoint.endswith("stream")
+    semaphore = asyncio.Semaphore(args.concurrency)
+    headers = {"Authorization": f"Bearer {args.session}"}
+
+    async with httpx.AsyncClient(base_url=args.base_url.rstrip("/"), headers=headers, timeout=120) as client:
+        async def bounded():
+            async with semaphore:
+                try:
+                    return await run_request(client, path, stream)
+                except httpx.HTTPError as e:
+                    return None, None, type(e).__name__
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*[bounded() for _ in range(args.requests)])
+        elapsed = time.perf_counter() - started
+
+    latencies = [r[0] for r in results if r[0] is not None]
+    first_tokens = [r[1] for r in results if r[1] is not None]
+    outcomes = Counter(r[2] for r in results)
+
+    print(f"{args.requests} requests to {path} in {elapsed:.2f}s ({args.requests / elapsed:.1f} req/s)")
+    print(f"latency  p50={percentile(latencies, 50) * 1000:.0f}ms p95={percentile(latencies, 95) * 1000:.0f}ms p99={percentile(latencies, 99) * 1000:.0f}ms")
+    if stream:
+        print(f"ttft     p50={percentile(first_tokens, 50) * 1000:.0f}ms p95={percentile(first_tokens, 95) * 1000:.0f}ms p99={percentile(first_tokens, 99) * 1000:.0f}ms")
+    print(f"outcomes {dict(outcomes)}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
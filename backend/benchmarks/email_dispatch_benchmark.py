@@ -0,0 +1,149 @@
+"""
+Benchmark for email delivery against a local fake Resend API.
+
+Compares the old one-request-per-email path (a blocking client call per message
+on a worker thread, sent one after another) with EmailDispatcher, which sends
+batches of up to 100 over a pooled async client through a token bucket.
+
+Run from backend/ with the usual .env (server.py is imported for EmailDispatcher):
+
+    python benchmarks/email_dispatch_benchmark.py --emails 2000 --latency-ms 50 --provider-rate 10
+
+The fake server answers every request after --latency-ms and, when --provider-rate
+is set, rejects requests above that many per second with 429 like the real API.
+"""
+import argparse
+import asyncio
+import logging
+import sys
+import time
+from collections import deque
+from pathlib import Path
+
+import httpx
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from server import EmailDispatcher  # noqa: E402
+
+# server.py logs every HTTP request at INFO
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+
+class FakeEmailApi:
+    def __init__(self, latency_ms, provider_rate):
+        self.latency = latency_ms / 1000
+        self.provider_rate = provider_rate
+        self.recent = deque()
+        self.delivered = 0
+        self.requests = 0
+        self.rejected = 0
+
+    def over_limit(self):
+        now = time.monotonic()
+        while self.recent and now - self.recent[0] > 1:
+            self.recent.popleft()
+        if self.provider_rate and len(self.recent) >= self.provider_rate:
+            return True
+        self.recent.append(now)
+        return False
+
+    async def send(self, request: Request):
+        body = await request.json()
+        self.requests += 1
+        if self.over_limit():
+            self.rejected += 1
+            return JSONResponse({"message": "Too many requests"}, status_code=429, headers={"retry-after": "1"})
+        await asyncio.sleep(self.latency)
+        emails = body if isinstance(body, list) else [body]
+        self.delivered += len(emails)
+        return JSONResponse({"data": [{"id": str(i)} for i in range(len(emails))]})
+
+    def app(self):
+        return Starlette(routes=[
+            Route("/emails", self.send, methods=["POST"]),
+            Route("/emails/batch", self.send, methods=["POST"]),
+        ])
+
+
+def build_messages(count):
+    return [
+        {"to": f"user{i}@example.com", "subject": "Kako se osećaš danas?", "html": "<p>Zdravo!</p>",
+         "user_id": f"user_{i}", "email_type": "mood_reminder"}
+        for i in range(count)
+    ]
+
+
+async def run_sequential(url, messages):
+    # Mirrors the previous send_email_async loop: one blocking request per email via asyncio.to_thread
+    def send(message):
+        for _ in range(10):
+            response = httpx.post(f"{url}/emails", json={"to": [message["to"]], "subject": message["subject"], "html": message["html"]})
+            if response.status_code != 429:
+                return response.is_success
+            time.sleep(float(response.headers.get("retry-after", "1")))
+        return False
+
+    sent = 0
+    for message in messages:
+        if await asyncio.to_thread(send, message):
+            sent += 1
+    return sent
+
+
+async def run_dispatcher(url, messages, workers, rate):
+    dispatcher = EmailDispatcher(url, "re_benchmark", "benchmark@umiri.me", workers=workers, batch_size=100, rate_per_second=rate)
+    try:
+        return len(await dispatcher.send_many(messages))
+    finally:
+        await dispatcher.close()
+
+
+def report(name, fake, sent, elapsed):
+    rate = sent / elapsed if elapsed else 0.0
+    per_10k = 10000 / rate if rate else float("inf")
+    print(f"{name:<12} sent={sent:<6} requests={fake.requests:<6} rejected={fake.rejected:<5} "
+          f"time={elapsed:8.2f}s  {rate:9.1f} emails/s  ~{per_10k:8.1f}s per 10k")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--emails", type=int, default=2000)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--provider-rate", type=float, default=0, help="requests/s the fake API accepts (0 = unlimited)")
+    parser.add_argument("--rate", type=float, default=10, help="dispatcher token bucket rate in requests/s")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--port", type=int, default=8025)
+    parser.add_argument("--skip-sequential", action="store_true")
+    args = parser.parse_args()
+
+    messages = build_messages(args.emails)
+    url = f"http://127.0.0.1:{args.port}"
+
+    for name in ("sequential", "dispatcher"):
+        if name == "sequential" and args.skip_sequential:
+            continue
+        fake = FakeEmailApi(args.latency_ms, args.provider_rate)
+        server = uvicorn.Server(uvicorn.Config(fake.app(), port=args.port, log_level="warning"))
+        serving = asyncio.create_task(server.serve())
+        while not server.started:
+            await asyncio.sleep(0.01)
+
+        started = time.perf_counter()
+        if name == "sequential":
+            sent = await run_sequential(url, messages)
+        else:
+            sent = await run_dispatcher(url, messages, args.workers, args.rate)
+        report(name, fake, sent, time.perf_counter() - started)
+
+        server.should_exit = True
+        await serving
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,61 @@
+"""
+Benchmark for email template rendering.
+
+Compares rendering every part of a Jinja2 template for each recipient with
+EmailTemplates.render, which renders the shell once per template and shared
+context and only joins in each recipient's fields.
+
+Run from backend/ with the usual .env (server.py is imported for EmailTemplates):
+
+    python benchmarks/email_template_benchmark.py --recipients 10000
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from server import EMAIL_TEMPLATE_DIR, EmailTemplates, TRIAL_DAYS  # noqa: E402
+
+TEMPLATES = [("mood_reminder", {}), ("trial_warning", {"days_left": 2}), ("trial_expired", {})]
+
+
+def recipients(count):
+    return [{"user_name": f"Korisnik {i} <{i}@example.com>"} for i in range(count)]
+
+
+def run_full_render(templates, name, context, users):
+    # Compiled templates are cached by Jinja2, so this measures rendering only
+    parts = [templates.env.get_template(filename.format(name=name)) for _, filename in templates.PARTS]
+    for user in users:
+        [template.render(**context, **user) for template in parts]
+
+
+def run_shell_render(templates, name, context, users):
+    for user in users:
+        templates.render(name, user, **context)
+
+
+def report(name, mode, count, elapsed):
+    per_10k = elapsed / count * 10000
+    print(f"{name:<14} {mode:<6} recipients={count:<7} time={elapsed:8.3f}s  ~{per_10k:7.3f}s per 10k  "
+          f"{elapsed / count * 1e6:7.1f} us/email")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recipients", type=int, default=10000)
+    args = parser.parse_args()
+
+    users = recipients(args.recipients)
+    for name, context in TEMPLATES:
+        for mode, run in (("full", run_full_render), ("shell", run_shell_render)):
+            templates = EmailTemplates(EMAIL_TEMPLATE_DIR, app_url="https://umiri.me", trial_days=TRIAL_DAYS)
+            started = time.perf_counter()
+            run(templates, name, context, users)
+            report(name, mode, len(users), time.perf_counter() - started)
+
+
+if __name__ == "__main__":
+    main()
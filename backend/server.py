@@ -1,17 +1,30 @@
 from fastapi import FastAPI, APIRouter, Request, Response, HTTPException
+from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 import os
 import logging
 import httpx
 import asyncio
-import resend
+import json
+import time
+import zlib
+import random
+import re
+import socket
+import unicodedata
 from pathlib import Path
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+from markupsafe import escape
 from pydantic import BaseModel, Field, ConfigDict
 from typing import List, Optional, Dict
+from collections import Counter
 import uuid
-from datetime import datetime, timezone, timedelta
+from datetime import datetime, timezone, timedelta, time as dt_time
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from emergentintegrations.llm.chat import LlmChat, UserMessage
 from emergentintegrations.payments.stripe.checkout import StripeCheckout, CheckoutSessionResponse, CheckoutStatusResponse, CheckoutSessionRequest
 
@@ -24,13 +37,16 @@ db = client[os.environ['DB_NAME']]
 
 EMERGENT_LLM_KEY = os.environ.get('EMERGENT_LLM_KEY')
 STRIPE_API_KEY = os.environ.get('STRIPE_API_KEY')
+# Public URL of /api/webhook/stripe; the app's single Stripe client is built with it
+STRIPE_WEBHOOK_URL = os.environ.get('STRIPE_WEBHOOK_URL', '')
 ADMIN_EMAILS = [e.strip() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()]
 RESEND_API_KEY = os.environ.get('RESEND_API_KEY')
+RESEND_API_URL = os.environ.get('RESEND_API_URL', 'https://api.resend.com')
 SENDER_EMAIL = os.environ.get('SENDER_EMAIL', 'noreply@umiri.me')
-
-# Initialize Resend
-if RESEND_API_KEY and RESEND_API_KEY != 're_your_api_key_here':
-    resend.api_key = RESEND_API_KEY
+# Resend allows 2 API requests per second by default; each batch request carries up to 100 emails
+EMAIL_RATE_PER_SECOND = float(os.environ.get('EMAIL_RATE_PER_SECOND', '2'))
+EMAIL_WORKERS = int(os.environ.get('EMAIL_WORKERS', '4'))
+EMAIL_BATCH_SIZE = min(100, int(os.environ.get('EMAIL_BATCH_SIZE', '100')))
 
 app = FastAPI()
 api_router = APIRouter(prefix="/api")
@@ -65,6 +81,36 @@ BADGES = [
 ]
 
 FREE_AI_TIPS_PER_DAY = 1
+# Daily AI tip counters are removed by a TTL index after this many days
+AI_TIPS_USAGE_RETENTION_DAYS = 2
+
+# LLM settings
+LLM_PROVIDER = os.environ.get('LLM_PROVIDER', 'emergent')
+LLM_PROVIDER_MODEL = ("openai", "gpt-5.2")
+# Seconds without a new chunk before a stream is considered stalled (with the emergent provider,
+# which sends the reply as one chunk, this is the limit for the whole completion)
+AI_STREAM_STALL_SECONDS = float(os.environ.get('AI_STREAM_STALL_SECONDS', '20'))
+LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', '16'))
+LLM_CALL_TIMEOUT_SECONDS = float(os.environ.get('LLM_CALL_TIMEOUT_SECONDS', '30'))
+LLM_BREAKER_FAILURE_THRESHOLD = int(os.environ.get('LLM_BREAKER_FAILURE_THRESHOLD', '5'))
+LLM_BREAKER_RESET_SECONDS = float(os.environ.get('LLM_BREAKER_RESET_SECONDS', '30'))
+
+AI_TIPS_SYSTEM_MESSAGE = """Ti si nežan i mudar savetnik za mentalno zdravlje u aplikaciji Umiri.me.
+Pišeš na srpskom jeziku, latiničnim pismom.
+Daješ kratke, tople i praktične savete bazirane na raspoloženju korisnika.
+Tvoj ton je prijateljski, umirujući i podržavajući.
+Nikad ne dijagnostikuješ i ne zamenjuješ profesionalnu pomoć.
+Odgovaraš u 2-3 kratke rečenice. Možeš dodati i jedan emoji."""
+
+WEEKLY_REPORT_SYSTEM_MESSAGE = "Ti si AI wellness coach u aplikaciji Umiri.me. Pišeš na srpskom jeziku, latiničnim pismom. Praviš nedeljne izveštaje o raspoloženju. Tvoj ton je topao, konkretan i motivišući."
+
+FALLBACK_AI_TIP = "Danas odvoji vreme za sebe. Čak i pet minuta tišine može napraviti veliku razliku. 🌿"
+
+# Seconds to wait for the LLM before answering /ai/tips with a locally generated tip
+AI_TIP_HEDGE_SECONDS = float(os.environ.get('AI_TIP_HEDGE_SECONDS', '6'))
+# Keep LLM tips that arrive after the hedge fired and serve them on the next request
+AI_TIP_CACHE_LATE_REPLIES = os.environ.get('AI_TIP_CACHE_LATE_REPLIES', 'true').lower() == 'true'
+AI_TIP_CACHE_HOURS = 12
 
 # Models
 class MoodCreate(BaseModel):
@@ -96,12 +142,38 @@ class NotificationSettings(BaseModel):
     email_reminders: bool = True
     reminder_time: str = "20:00"  # HH:MM format
     trial_warnings: bool = True
+    timezone: Optional[str] = None  # IANA name, e.g. "Europe/Belgrade"; None keeps the current one
 
 class AdminGrantPremium(BaseModel):
     user_id: str
     plan_id: str = "admin_grant"
     days: int = 30
 
+class AdminBulkPremium(BaseModel):
+    user_ids: Optional[List[str]] = None
+    filter: str = ""
+    search: str = ""
+    plan_id: str = "admin_grant"
+    days: int = 30
+
+# User timezones - mood dates and reminders follow the user's local day
+DEFAULT_TIMEZONE = os.environ.get('DEFAULT_TIMEZONE', 'Europe/Belgrade')
+
+def parse_timezone(name: str) -> ZoneInfo:
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"Unknown timezone: {name}")
+
+def user_zone(user: dict) -> ZoneInfo:
+    try:
+        return parse_timezone(user.get("timezone") or DEFAULT_TIMEZONE)
+    except ValueError:
+        return ZoneInfo(DEFAULT_TIMEZONE)
+
+def user_today(user: dict) -> str:
+    return datetime.now(user_zone(user)).strftime("%Y-%m-%d")
+
 # Auth helpers
 async def get_current_user(request: Request) -> dict:
     session_token = request.cookies.get("session_token")
@@ -124,40 +196,61 @@ async def get_current_user(request: Request) -> dict:
     if expires_at < datetime.now(timezone.utc):
         raise HTTPException(status_code=401, detail="Sesija je istekla")
     
-    user = await db.users.find_one({"user_id": session["user_id"]}, {"_id": 0})
+    user = await db.users.find_one({"user_id": session["user_id"]}, USER_PRIVATE_FIELDS)
     if not user:
         raise HTTPException(status_code=404, detail="Korisnik nije pronađen")
     return user
 
 TRIAL_DAYS = 7
 
-async def is_premium(user_id: str) -> bool:
+# Entitlement cache - a user's active subscription is kept in process until
+# min(ENTITLEMENT_CACHE_SECONDS, expires_at) and dropped by every subscription write
+ENTITLEMENT_CACHE_SECONDS = float(os.environ.get('ENTITLEMENT_CACHE_SECONDS', '60'))
+ENTITLEMENT_CACHE_MAX_ENTRIES = 50000
+entitlement_cache: Dict[str, tuple] = {}
+
+def as_utc_datetime(value) -> datetime:
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+def invalidate_entitlement(*user_ids: str):
+    for user_id in user_ids:
+        entitlement_cache.pop(user_id, None)
+
+async def get_active_subscription(user_id: str) -> Optional[dict]:
+    now = time.time()
+    cached = entitlement_cache.get(user_id)
+    if cached and cached[0] > now:
+        return cached[1]
+    
     sub = await db.subscriptions.find_one(
         {"user_id": user_id, "status": "active"},
         {"_id": 0}
     )
+    valid_until = now + ENTITLEMENT_CACHE_SECONDS
+    if sub:
+        expires_ts = as_utc_datetime(sub.get("expires_at", "")).timestamp()
+        if expires_ts > now:
+            valid_until = min(valid_until, expires_ts)
+    if len(entitlement_cache) >= ENTITLEMENT_CACHE_MAX_ENTRIES:
+        entitlement_cache.clear()
+    entitlement_cache[user_id] = (valid_until, sub)
+    return sub
+
+async def is_premium(user_id: str) -> bool:
+    sub = await get_active_subscription(user_id)
     if not sub:
         return False
-    expires_at = sub.get("expires_at", "")
-    if isinstance(expires_at, str):
-        expires_at = datetime.fromisoformat(expires_at)
-    if expires_at.tzinfo is None:
-        expires_at = expires_at.replace(tzinfo=timezone.utc)
-    return expires_at > datetime.now(timezone.utc)
+    return as_utc_datetime(sub.get("expires_at", "")) > datetime.now(timezone.utc)
 
-async def get_subscription_info(user_id: str) -> dict:
-    sub = await db.subscriptions.find_one(
-        {"user_id": user_id, "status": "active"},
-        {"_id": 0}
-    )
+def subscription_info(sub: Optional[dict]) -> dict:
     if not sub:
         return {"is_premium": False, "is_trial": False, "days_left": 0, "plan_id": None}
     
-    expires_at = sub.get("expires_at", "")
-    if isinstance(expires_at, str):
-        expires_at = datetime.fromisoformat(expires_at)
-    if expires_at.tzinfo is None:
-        expires_at = expires_at.replace(tzinfo=timezone.utc)
+    expires_at = as_utc_datetime(sub.get("expires_at", ""))
     
     now = datetime.now(timezone.utc)
     is_active = expires_at > now
@@ -169,9 +262,26 @@ async def get_subscription_info(user_id: str) -> dict:
         "is_trial": is_trial and is_active,
         "days_left": days_left,
         "plan_id": sub.get("plan_id"),
-        "expires_at": sub.get("expires_at")
+        "expires_at": expires_at.isoformat()
     }
 
+async def get_subscription_info(user_id: str) -> dict:
+    return subscription_info(await get_active_subscription(user_id))
+
+# Subscription summary mirrored on the user document for admin sorting and filtering
+def user_subscription_fields(sub: Optional[dict]) -> dict:
+    if not sub or sub.get("status") != "active":
+        return {"subscription_status": "inactive", "subscription_plan_id": None, "subscription_expires_at": None}
+    return {
+        "subscription_status": "trial" if sub.get("is_trial") else "premium",
+        "subscription_plan_id": sub.get("plan_id"),
+        "subscription_expires_at": as_utc_datetime(sub["expires_at"])
+    }
+
+async def sync_user_subscription(user_id: str, sub: Optional[dict]):
+    invalidate_entitlement(user_id)
+    await db.users.update_one({"user_id": user_id}, {"$set": user_subscription_fields(sub)})
+
 async def activate_trial(user_id: str):
     existing = await db.subscriptions.find_one({"user_id": user_id}, {"_id": 0})
     if existing:
@@ -179,15 +289,104 @@ async def activate_trial(user_id: str):
     
     now = datetime.now(timezone.utc)
     expires_at = now + timedelta(days=TRIAL_DAYS)
-    await db.subscriptions.insert_one({
+    sub = {
         "user_id": user_id,
         "plan_id": "trial",
         "is_trial": True,
         "status": "active",
         "started_at": now.isoformat(),
-        "expires_at": expires_at.isoformat(),
+        "expires_at": expires_at,
         "updated_at": now.isoformat()
-    })
+    }
+    try:
+        await db.subscriptions.insert_one(sub)
+    except DuplicateKeyError:
+        # A concurrent login already started the trial
+        return
+    await sync_user_subscription(user_id, sub)
+
+# User search keys - normalized lowercase terms with an index that serves anchored prefix queries
+USER_PRIVATE_FIELDS = {"_id": 0, "search_terms": 0}
+USER_SEARCH_BACKFILL_BATCH = 1000
+
+def normalize_search_text(value: str) -> str:
+    value = (value or "").casefold().replace("đ", "dj")
+    value = unicodedata.normalize("NFKD", value)
+    value = "".join(c for c in value if not unicodedata.combining(c))
+    return " ".join(value.split())
+
+def user_search_terms(name: str, email: str) -> List[str]:
+    # Full name, each name token and the email, so "petr" finds "Marko Petrović"
+    full_name = normalize_search_text(name)
+    terms = {full_name, normalize_search_text(email), *full_name.split(" ")}
+    terms.discard("")
+    return sorted(terms)
+
+def user_search_query(search: str) -> dict:
+    prefix = normalize_search_text(search)
+    if not prefix:
+        return {}
+    return {"search_terms": {"$regex": f"^{re.escape(prefix)}"}}
+
+async def backfill_user_search_terms(only_missing: bool = True) -> int:
+    query = {"search_terms": {"$exists": False}} if only_missing else {}
+    updated = 0
+    batch = []
+    async for u in db.users.find(query, {"_id": 1, "name": 1, "email": 1}):
+        batch.append(UpdateOne({"_id": u["_id"]}, {"$set": {"search_terms": user_search_terms(u.get("name", ""), u.get("email", ""))}}))
+        if len(batch) >= USER_SEARCH_BACKFILL_BATCH:
+            updated += (await db.users.bulk_write(batch, ordered=False)).modified_count
+            batch = []
+    if batch:
+        updated += (await db.users.bulk_write(batch, ordered=False)).modified_count
+    return updated
+
+async def backfill_user_activity(only_missing: bool = True) -> int:
+    # Recomputes mood_count, last_mood_date and the subscription summary in pages of users.
+    # Missing users are found by a marker only this backfill writes: create_mood's $inc and
+    # subscription writes also set the summary fields on users who were never backfilled
+    query = {"activity_backfilled": {"$exists": False}} if only_missing else {}
+    updated = 0
+    cursor = db.users.find(query, {"_id": 0, "user_id": 1}).batch_size(USER_SEARCH_BACKFILL_BATCH)
+    while True:
+        page = await cursor.to_list(USER_SEARCH_BACKFILL_BATCH)
+        if not page:
+            break
+        user_ids = [u["user_id"] for u in page]
+        subs = await db.subscriptions.find(
+            {"user_id": {"$in": user_ids}, "status": "active"}, {"_id": 0}
+        ).to_list(None)
+        subs_by_user = {sub["user_id"]: sub for sub in subs}
+        mood_stats = await db.moods.aggregate([
+            {"$match": {"user_id": {"$in": user_ids}}},
+            {"$group": {"_id": "$user_id", "mood_count": {"$sum": 1}, "last_mood_date": {"$max": "$date"}}}
+        ]).to_list(None)
+        moods_by_user = {m["_id"]: m for m in mood_stats}
+        result = await db.users.bulk_write([
+            UpdateOne({"user_id": user_id}, {"$set": {
+                "mood_count": moods_by_user.get(user_id, {}).get("mood_count", 0),
+                "last_mood_date": moods_by_user.get(user_id, {}).get("last_mood_date"),
+                **user_subscription_fields(subs_by_user.get(user_id)),
+                "activity_backfilled": True
+            }})
+            for user_id in user_ids
+        ], ordered=False)
+        updated += result.modified_count
+    return updated
+
+async def backfill_subscription_dates() -> int:
+    # expires_at used to be stored as an ISO string, which the range queries below can't match
+    updated = 0
+    for collection, field in ((db.subscriptions, "expires_at"), (db.users, "subscription_expires_at")):
+        batch = []
+        async for doc in collection.find({field: {"$type": "string"}}, {"_id": 1, field: 1}):
+            batch.append(UpdateOne({"_id": doc["_id"]}, {"$set": {field: as_utc_datetime(doc[field])}}))
+            if len(batch) >= USER_SEARCH_BACKFILL_BATCH:
+                updated += (await collection.bulk_write(batch, ordered=False)).modified_count
+                batch = []
+        if batch:
+            updated += (await collection.bulk_write(batch, ordered=False)).modified_count
+    return updated
 
 # Auth endpoints
 @api_router.post("/auth/session")
@@ -212,7 +411,11 @@ async def create_session(request: Request, response: Response):
         user_id = existing["user_id"]
         await db.users.update_one(
             {"email": user_data["email"]},
-            {"$set": {"name": user_data["name"], "picture": user_data.get("picture", "")}}
+            {"$set": {
+                "name": user_data["name"],
+                "picture": user_data.get("picture", ""),
+                "search_terms": user_search_terms(user_data["name"], user_data["email"])
+            }}
         )
     else:
         await db.users.insert_one({
@@ -220,6 +423,11 @@ async def create_session(request: Request, response: Response):
             "email": user_data["email"],
             "name": user_data["name"],
             "picture": user_data.get("picture", ""),
+            "search_terms": user_search_terms(user_data["name"], user_data["email"]),
+            "mood_count": 0,
+            "last_mood_date": None,
+            **user_subscription_fields(None),
+            "activity_backfilled": True,
             "created_at": datetime.now(timezone.utc).isoformat()
         })
         # Auto-activate 7-day trial for new users
@@ -239,7 +447,7 @@ async def create_session(request: Request, response: Response):
         max_age=7 * 24 * 60 * 60
     )
     
-    user = await db.users.find_one({"user_id": user_id}, {"_id": 0})
+    user = await db.users.find_one({"user_id": user_id}, USER_PRIVATE_FIELDS)
     return user
 
 @api_router.get("/auth/me")
@@ -265,9 +473,8 @@ async def create_mood(mood_data: MoodCreate, request: Request):
     
     mood_info = MOOD_TYPES[mood_data.mood_type]
     now = datetime.now(timezone.utc)
-    today = now.strftime("%Y-%m-%d")
+    today = now.astimezone(user_zone(user)).strftime("%Y-%m-%d")
     
-    existing = await db.moods.find_one({"user_id": user["user_id"], "date": today}, {"_id": 0})
     mood_entry = {
         "mood_id": f"mood_{uuid.uuid4().hex[:12]}",
         "user_id": user["user_id"],
@@ -283,10 +490,14 @@ async def create_mood(mood_data: MoodCreate, request: Request):
         "date": today
     }
     
-    if existing:
-        await db.moods.update_one({"user_id": user["user_id"], "date": today}, {"$set": mood_entry})
-    else:
-        await db.moods.insert_one(mood_entry)
+    result = await db.moods.update_one(
+        {"user_id": user["user_id"], "date": today}, {"$set": mood_entry}, upsert=True
+    )
+    # Keep the activity summary on the user in step; only a new day's entry adds to the count
+    summary = {"$max": {"last_mood_date": today}}
+    if result.upserted_id is not None:
+        summary["$inc"] = {"mood_count": 1}
+    await db.users.update_one({"user_id": user["user_id"]}, summary)
     
     return {k: v for k, v in mood_entry.items() if k != "_id"}
 
@@ -326,8 +537,7 @@ async def get_mood_stats(request: Request):
     dates = sorted(set(m["date"] for m in all_moods), reverse=True)
     
     streak = 0
-    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-    check_date = today
+    check_date = user_today(user)
     for i in range(len(dates) + 1):
         if check_date in dates:
             streak += 1
@@ -396,22 +606,330 @@ async def export_moods(request: Request):
         headers={"Content-Disposition": "attachment; filename=umiri_me_raspolozenja.csv"}
     )
 
+# Background tasks - keep references so pending tasks aren't garbage collected
+background_tasks = set()
+
+def spawn_background(coro) -> asyncio.Task:
+    task = asyncio.ensure_future(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+# LLM helpers
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+# LLM providers - selected with LLM_PROVIDER ("emergent" or "stub")
+class EmergentLlmProvider:
+    async def complete(self, session_id: str, system_message: str, text: str) -> str:
+        chat = LlmChat(api_key=EMERGENT_LLM_KEY, session_id=session_id, system_message=system_message)
+        chat.with_model(*LLM_PROVIDER_MODEL)
+        return await chat.send_message(UserMessage(text=text))
+
+    async def stream(self, session_id: str, system_message: str, text: str):
+        # LlmChat only exposes full completions, so with this provider the reply arrives as a single
+        # chunk once it is fully generated; the stall guard then bounds the whole completion
+        yield await self.complete(session_id, system_message, text)
+
+STUB_TIP_REPLIES = [
+    "Danas odvoji nekoliko minuta za miran dah i šetnju bez telefona. Mali koraci prave veliku razliku. 🌿",
+    "Primećujem da ti je ova nedelja bila promenljiva. Pokušaj večeras da zapišeš jednu stvar na kojoj si zahvalan/na. 💛",
+    "Tvoje raspoloženje zaslužuje pažnju. Probaj vežbu disanja 4-4-6 pre spavanja i vidi kako se osećaš ujutru. 🌙",
+]
+
+STUB_WEEKLY_REPLIES = [
+    "Ove nedelje si imao/la i lakše i teže dane, ali si redovno beležio/la raspoloženje. "
+    "Najviše su ti prijali dani sa dovoljno sna i vremena sa dragim ljudima. "
+    "Za sledeću nedelju probaj da zadržiš isti ritam spavanja i isplaniraš jedan opuštajući vikend trenutak.",
+]
+
+class StubLlmProvider:
+    # Offline provider for load tests: canned Serbian replies with injected latency, errors
+    # and chunk timing. Latency specs are in milliseconds: "fixed:300", "uniform:100:900",
+    # "normal:400:120" or "lognormal:6:0.5" (mu and sigma of the underlying normal).
+    def __init__(self, latency: str = "fixed:300", error_rate: float = 0.0, chunk_delay: str = "fixed:40",
+                 chunk_words: int = 3, seed: Optional[int] = None):
+        self.latency = self._parse_distribution(latency)
+        self.chunk_delay = self._parse_distribution(chunk_delay)
+        self.error_rate = error_rate
+        self.chunk_words = max(1, chunk_words)
+        self._rng = random.Random(seed)
+
+    @staticmethod
+    def _parse_distribution(spec: str) -> tuple:
+        kind, *params = spec.split(":")
+        params = [float(p) for p in params]
+        expected = {"fixed": 1, "uniform": 2, "normal": 2, "lognormal": 2}
+        if kind not in expected or len(params) != expected[kind]:
+            raise ValueError(f"Invalid latency spec: {spec}")
+        return kind, params
+
+    def _sample_seconds(self, distribution: tuple) -> float:
+        kind, params = distribution
+        if kind == "fixed":
+            ms = params[0]
+        elif kind == "uniform":
+            ms = self._rng.uniform(*params)
+        elif kind == "normal":
+            ms = self._rng.gauss(*params)
+        else:
+            ms = self._rng.lognormvariate(*params)
+        return max(0.0, ms) / 1000
+
+    def _reply_for(self, text: str) -> str:
+        replies = STUB_WEEKLY_REPLIES if "nedeljni izveštaj" in text.lower() else STUB_TIP_REPLIES
+        return self._rng.choice(replies)
+
+    async def _first_byte(self):
+        await asyncio.sleep(self._sample_seconds(self.latency))
+        if self._rng.random() < self.error_rate:
+            raise RuntimeError("Stub LLM injected error")
+
+    async def complete(self, session_id: str, system_message: str, text: str) -> str:
+        await self._first_byte()
+        return self._reply_for(text)
+
+    async def stream(self, session_id: str, system_message: str, text: str):
+        await self._first_byte()
+        words = self._reply_for(text).split(" ")
+        for i in range(0, len(words), self.chunk_words):
+            if i:
+                await asyncio.sleep(self._sample_seconds(self.chunk_delay))
+            chunk = " ".join(words[i:i + self.chunk_words])
+            yield chunk if i + self.chunk_words >= len(words) else chunk + " "
+
+def create_llm_provider(name: str):
+    if name == "stub":
+        seed = os.environ.get('LLM_STUB_SEED')
+        return StubLlmProvider(
+            latency=os.environ.get('LLM_STUB_LATENCY_MS', 'fixed:300'),
+            error_rate=float(os.environ.get('LLM_STUB_ERROR_RATE', '0')),
+            chunk_delay=os.environ.get('LLM_STUB_CHUNK_DELAY_MS', 'fixed:40'),
+            chunk_words=int(os.environ.get('LLM_STUB_CHUNK_WORDS', '3')),
+            seed=int(seed) if seed else None,
+        )
+    if name == "emergent":
+        return EmergentLlmProvider()
+    raise ValueError(f"Unknown LLM provider: {name}")
+
+class LlmUnavailable(Exception):
+    pass
+
+class SharedStream:
+    # One upstream stream fanned out to every reader with the same key; late readers replay
+    # the chunks buffered so far before waiting for new ones
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[Exception] = None
+        self.readers = 0
+        self.task: Optional[asyncio.Future] = None
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def publish(self, chunk: str):
+        self.chunks.append(chunk)
+        self._notify()
+
+    def finish(self, error: Optional[Exception] = None):
+        self.done = True
+        self.error = error
+        self._notify()
+
+    async def read(self):
+        i = 0
+        while True:
+            if i < len(self.chunks):
+                yield self.chunks[i]
+                i += 1
+            elif self.done:
+                if self.error:
+                    raise self.error
+                return
+            else:
+                await self._changed.wait()
+
+class LlmGateway:
+    # Shared entry point for all LLM calls: per-key single-flight, a global concurrency
+    # limit, a hard per-call timeout (a deadline for the whole stream when streaming) and a
+    # circuit breaker that fails fast while the provider is unhealthy so callers can serve
+    # their fallback immediately.
+    def __init__(self, provider, max_concurrency: int, call_timeout: float, failure_threshold: int, reset_seconds: float):
+        self.provider = provider
+        self.call_timeout = call_timeout
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._streams: Dict[str, SharedStream] = {}
+        self._state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    def _allow(self) -> bool:
+        if self._state == "closed":
+            return True
+        if self._state == "open" and time.monotonic() - self._opened_at >= self.reset_seconds:
+            # Let a single probe through; its outcome closes or re-opens the breaker
+            self._state = "half_open"
+            return True
+        return False
+
+    def _record_success(self):
+        self._state = "closed"
+        self._failures = 0
+
+    def _record_failure(self):
+        self._failures += 1
+        if self._state == "half_open" or self._failures >= self.failure_threshold:
+            if self._state != "open":
+                logger.warning(f"LLM circuit breaker opened after {self._failures} failures")
+            self._state = "open"
+            self._opened_at = time.monotonic()
+
+    def _record_abandoned(self):
+        # A probe the client walked away from proves nothing either way; re-open so the next one can run
+        if self._state == "half_open":
+            self._state = "open"
+            self._opened_at = time.monotonic()
+
+    async def _acquire_slot(self):
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.call_timeout)
+        except asyncio.TimeoutError:
+            # A saturated pool means the provider is not keeping up
+            self._record_failure()
+            raise LlmUnavailable("LLM concurrency limit reached")
+
+    async def _call(self, session_id: str, system_message: str, text: str) -> str:
+        await self._acquire_slot()
+        try:
+            reply = await asyncio.wait_for(self.provider.complete(session_id, system_message, text), timeout=self.call_timeout)
+        except Exception:
+            self._record_failure()
+            raise
+        finally:
+            self._semaphore.release()
+        self._record_success()
+        return reply
+
+    async def complete(self, key: str, session_id: str, system_message: str, text: str) -> str:
+        # Concurrent requests with the same key share one upstream call
+        inflight = self._inflight.get(key)
+        if inflight is None:
+            if not self._allow():
+                raise LlmUnavailable("LLM circuit breaker is open")
+            inflight = asyncio.ensure_future(self._call(session_id, system_message, text))
+            self._inflight[key] = inflight
+            inflight.add_done_callback(lambda fut: self._inflight.pop(key, None) if self._inflight.get(key) is fut else None)
+        return await asyncio.shield(inflight)
+
+    async def _produce(self, shared: SharedStream, session_id: str, system_message: str, text: str):
+        try:
+            await self._acquire_slot()
+        except LlmUnavailable as e:
+            shared.finish(e)
+            return
+        chunks = self.provider.stream(session_id, system_message, text)
+        deadline = time.monotonic() + self.call_timeout
+        completed, error = False, None
+        try:
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), timeout=max(0.0, deadline - time.monotonic()))
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    raise LlmUnavailable(f"LLM stream exceeded {self.call_timeout}s")
+                shared.publish(chunk)
+            completed = True
+        except Exception as e:
+            error = e
+        finally:
+            self._semaphore.release()
+            # When every reader left, the last one already recorded the outcome and finished the stream
+            if not shared.done:
+                if completed:
+                    self._record_success()
+                    shared.finish()
+                elif error is not None:
+                    self._record_failure()
+                    shared.finish(error)
+                else:
+                    shared.finish(LlmUnavailable("LLM stream cancelled"))
+            await chunks.aclose()
+
+    async def stream(self, key: str, session_id: str, system_message: str, text: str):
+        # Concurrent streams with the same key read one upstream stream
+        shared = self._streams.get(key)
+        if shared is None:
+            if not self._allow():
+                raise LlmUnavailable("LLM circuit breaker is open")
+            shared = SharedStream()
+            shared.task = asyncio.ensure_future(self._produce(shared, session_id, system_message, text))
+            self._streams[key] = shared
+            shared.task.add_done_callback(lambda task: self._streams.pop(key, None) if self._streams.get(key) is shared else None)
+        shared.readers += 1
+        cancelled = False
+        try:
+            async for chunk in shared.read():
+                yield chunk
+        except asyncio.CancelledError:
+            # A stall timeout cancels the pending chunk, which counts as a provider failure
+            cancelled = True
+            raise
+        finally:
+            shared.readers -= 1
+            if shared.readers == 0 and not shared.done:
+                # Nobody is left to read the rest. GeneratorExit from aclose() (client disconnected)
+                # proves nothing about the provider either way
+                shared.finish(LlmUnavailable("LLM stream abandoned"))
+                shared.task.cancel()
+                if cancelled:
+                    self._record_failure()
+                else:
+                    self._record_abandoned()
+
+llm_gateway = LlmGateway(
+    create_llm_provider(LLM_PROVIDER),
+    max_concurrency=LLM_MAX_CONCURRENCY,
+    call_timeout=LLM_CALL_TIMEOUT_SECONDS,
+    failure_threshold=LLM_BREAKER_FAILURE_THRESHOLD,
+    reset_seconds=LLM_BREAKER_RESET_SECONDS,
+)
+
+async def stream_with_stall_guard(chunks, fallback_text: str):
+    # Yields SSE events for each chunk and the full text once the stream completes.
+    # If no chunk arrives within AI_STREAM_STALL_SECONDS the fallback text is sent instead.
+    parts = []
+    iterator = chunks.__aiter__()
+    while True:
+        try:
+            chunk = await asyncio.wait_for(iterator.__anext__(), timeout=AI_STREAM_STALL_SECONDS)
+        except StopAsyncIteration:
+            break
+        except Exception as e:
+            logger.error(f"LLM stream error: {e!r}")
+            await iterator.aclose()
+            yield sse_event("fallback", {"text": fallback_text}), None
+            return
+        if chunk:
+            parts.append(chunk)
+            yield sse_event("token", {"text": chunk}), None
+    if not parts:
+        yield sse_event("fallback", {"text": fallback_text}), None
+        return
+    yield None, "".join(parts)
+
 # Weekly AI Report
-@api_router.post("/ai/weekly-report")
-async def get_weekly_report(request: Request):
-    user = await get_current_user(request)
-    premium = await is_premium(user["user_id"])
-    if not premium:
-        raise HTTPException(status_code=403, detail="Nedeljni izveštaj je dostupan samo za Premium korisnike")
-    
-    week_ago = (datetime.now(timezone.utc) - timedelta(days=7)).strftime("%Y-%m-%d")
-    moods = await db.moods.find(
-        {"user_id": user["user_id"], "date": {"$gte": week_ago}}, {"_id": 0}
-    ).sort("date", 1).to_list(7)
-    
-    if not moods:
-        return {"report": "Nemaš dovoljno podataka za nedeljni izveštaj. Nastavi da beležiš raspoloženja!", "generated_at": datetime.now(timezone.utc).isoformat()}
-    
+def build_weekly_report_prompt(moods: list) -> tuple:
     mood_details = []
     all_triggers = {}
     gratitudes = []
@@ -451,20 +969,101 @@ Napravi kratak, topao izveštaj sa:
 3. Preporuka za sledeću nedelju (1-2 rečenice)
 
 Budi konkretan, koristi podatke. Piši na srpskom, latiničnim pismom."""
+    return prompt, avg_score
+
+def weekly_report_fingerprint(moods: list) -> str:
+    # Changes whenever a mood in the window is added or edited, which invalidates the cached report
+    return f"{len(moods)}:{max(m.get('created_at', '') for m in moods)}"
+
+def weekly_report_fallback(moods: list, avg_score: float) -> str:
+    return f"Ove nedelje si zabeležio/la {len(moods)} raspoloženja sa prosečnom ocenom {avg_score}/5. Nastavi tako!"
+
+async def load_weekly_report_context(request: Request) -> tuple:
+    user = await get_current_user(request)
+    premium = await is_premium(user["user_id"])
+    if not premium:
+        raise HTTPException(status_code=403, detail="Nedeljni izveštaj je dostupan samo za Premium korisnike")
+    
+    week_ago = (datetime.now(timezone.utc) - timedelta(days=7)).strftime("%Y-%m-%d")
+    moods = await db.moods.find(
+        {"user_id": user["user_id"], "date": {"$gte": week_ago}}, {"_id": 0}
+    ).sort("date", 1).to_list(7)
+    return user, moods
+
+async def get_cached_weekly_report(user_id: str, moods: list) -> Optional[dict]:
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    return await db.ai_weekly_reports.find_one(
+        {"user_id": user_id, "date": today, "fingerprint": weekly_report_fingerprint(moods)},
+        {"_id": 0, "report": 1, "avg_score": 1, "total_entries": 1, "generated_at": 1}
+    )
+
+async def cache_weekly_report(user_id: str, moods: list, result: dict):
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    await db.ai_weekly_reports.update_one(
+        {"user_id": user_id, "date": today},
+        {"$set": {**result, "user_id": user_id, "date": today, "fingerprint": weekly_report_fingerprint(moods)}},
+        upsert=True
+    )
+
+NO_WEEKLY_DATA_REPORT = "Nemaš dovoljno podataka za nedeljni izveštaj. Nastavi da beležiš raspoloženja!"
+
+@api_router.post("/ai/weekly-report")
+async def get_weekly_report(request: Request):
+    user, moods = await load_weekly_report_context(request)
+    
+    if not moods:
+        return {"report": NO_WEEKLY_DATA_REPORT, "generated_at": datetime.now(timezone.utc).isoformat()}
+    
+    cached = await get_cached_weekly_report(user["user_id"], moods)
+    if cached:
+        return cached
+    
+    prompt, avg_score = build_weekly_report_prompt(moods)
 
     try:
-        chat = LlmChat(
-            api_key=EMERGENT_LLM_KEY,
-            session_id=f"weekly_{user['user_id']}_{datetime.now().strftime('%Y%m%d')}",
-            system_message="Ti si AI wellness coach u aplikaciji Umiri.me. Pišeš na srpskom jeziku, latiničnim pismom. Praviš nedeljne izveštaje o raspoloženju. Tvoj ton je topao, konkretan i motivišući."
+        report_text = await llm_gateway.complete(
+            f"weekly:{user['user_id']}",
+            f"weekly_{user['user_id']}_{datetime.now().strftime('%Y%m%d')}",
+            WEEKLY_REPORT_SYSTEM_MESSAGE, prompt
         )
-        chat.with_model("openai", "gpt-5.2")
-        user_msg = UserMessage(text=prompt)
-        report_text = await chat.send_message(user_msg)
-        return {"report": report_text, "avg_score": avg_score, "total_entries": len(moods), "generated_at": datetime.now(timezone.utc).isoformat()}
+        result = {"report": report_text, "avg_score": avg_score, "total_entries": len(moods), "generated_at": datetime.now(timezone.utc).isoformat()}
+        await cache_weekly_report(user["user_id"], moods, result)
+        return result
     except Exception as e:
         logger.error(f"Weekly report error: {e}")
-        return {"report": f"Ove nedelje si zabeležio/la {len(moods)} raspoloženja sa prosečnom ocenom {avg_score}/5. Nastavi tako!", "avg_score": avg_score, "total_entries": len(moods), "generated_at": datetime.now(timezone.utc).isoformat()}
+        return {"report": weekly_report_fallback(moods, avg_score), "avg_score": avg_score, "total_entries": len(moods), "generated_at": datetime.now(timezone.utc).isoformat()}
+
+@api_router.post("/ai/weekly-report/stream")
+async def stream_weekly_report(request: Request):
+    user, moods = await load_weekly_report_context(request)
+    cached = await get_cached_weekly_report(user["user_id"], moods) if moods else None
+    
+    async def events():
+        if not moods:
+            yield sse_event("done", {"report": NO_WEEKLY_DATA_REPORT, "generated_at": datetime.now(timezone.utc).isoformat()})
+            return
+        if cached:
+            yield sse_event("token", {"text": cached["report"]})
+            yield sse_event("done", cached)
+            return
+        
+        prompt, avg_score = build_weekly_report_prompt(moods)
+        yield sse_event("start", {"avg_score": avg_score, "total_entries": len(moods)})
+        chunks = llm_gateway.stream(
+            f"weekly:{user['user_id']}",
+            f"weekly_{user['user_id']}_{datetime.now().strftime('%Y%m%d')}",
+            WEEKLY_REPORT_SYSTEM_MESSAGE, prompt
+        )
+        async for event, full_text in stream_with_stall_guard(chunks, weekly_report_fallback(moods, avg_score)):
+            if event:
+                yield event
+                continue
+            # Stream completed - cache the full report
+            result = {"report": full_text, "avg_score": avg_score, "total_entries": len(moods), "generated_at": datetime.now(timezone.utc).isoformat()}
+            await cache_weekly_report(user["user_id"], moods, result)
+            yield sse_event("done", result)
+    
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 # Gamification
 @api_router.get("/gamification/stats")
@@ -478,8 +1077,7 @@ async def get_gamification(request: Request):
     
     dates = sorted(set(m["date"] for m in all_moods), reverse=True)
     streak = 0
-    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-    check_date = today
+    check_date = user_today(user)
     for i in range(len(dates) + 1):
         if check_date in dates:
             streak += 1
@@ -507,20 +1105,78 @@ async def get_gamification(request: Request):
     
     return {"streak": streak, "total_entries": total, "unique_moods": unique_moods, "notes_count": notes_count, "badges": earned_badges}
 
-# AI Tips with free tier limit
-@api_router.post("/ai/tips")
-async def get_ai_tip(request: Request):
-    user = await get_current_user(request)
-    premium = await is_premium(user["user_id"])
-    
-    if not premium:
-        today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-        tips_today = await db.ai_tips_usage.count_documents({"user_id": user["user_id"], "date": today})
-        if tips_today >= FREE_AI_TIPS_PER_DAY:
-            raise HTTPException(status_code=403, detail="Dostigao/la si dnevni limit besplatnih AI saveta. Nadogradi na Premium za neograničene savete!")
+# Local tip engine - deterministic Serbian tips used when the LLM is slow or unavailable
+MOOD_TIP_GROUPS = {
+    "srecan": "positive", "odusevljen": "positive", "miran": "calm", "neutralan": "neutral",
+    "umoran": "tired", "tuzan": "sad", "anksiozan": "anxious", "ljut": "angry",
+}
+
+MOOD_TIP_OPENERS = {
+    "positive": ["Lepo je videti da ti je raspoloženje ovih dana dobro.", "Tvoja nedavna raspoloženja zrače energijom."],
+    "calm": ["Primećujem mnogo mirnih dana u poslednje vreme.", "Deluje da si pronašao/la lep unutrašnji balans."],
+    "neutral": ["Tvoji dani su u poslednje vreme prilično ujednačeni.", "Neutralni dani su sasvim u redu – i oni su deo puta."],
+    "tired": ["Čini se da te umor prati ovih dana.", "Tvoje telo ti možda poručuje da mu treba više odmora."],
+    "sad": ["Vidim da su ti poslednji dani bili teži.", "Tuga je prirodan deo života i u redu je osećati je."],
+    "anxious": ["Primećujem da te je u poslednje vreme pratila napetost.", "Napetost ume da iscrpi, zato budi nežan/na prema sebi."],
+    "angry": ["Deluje da se u tebi nakupilo dosta frustracije.", "Ljutnja često govori da je neka tvoja granica pređena."],
+}
+
+MOOD_TIP_ACTIONS = {
+    "positive": "Zapiši šta je doprinelo ovim danima, da im se vratiš kad zatreba. ✨",
+    "calm": "Sačuvaj ovaj mir kratkom šetnjom ili s nekoliko minuta tišine bez telefona. 🌿",
+    "neutral": "Probaj danas da uradiš jednu malu stvar samo za sebe, makar na deset minuta. 🌱",
+    "tired": "Pokušaj večeras da legneš pola sata ranije i skloniš ekrane pre spavanja. 🌙",
+    "sad": "Javi se nekome kome veruješ – i kratak razgovor može da olakša. 💛",
+    "anxious": "Probaj vežbu disanja 4-4-6: udahni 4 sekunde, zadrži 4, izdahni 6. 🌬️",
+    "angry": "Pre nego što reaguješ, izađi u kratku šetnju ili zapiši šta te je naljutilo. 🍃",
+}
+
+TRIGGER_TIPS = {
+    "posao": {"positive": "Posao ti očigledno daje energiju – samo ostavi prostora i za odmor.", "negative": "Posao te u poslednje vreme opterećuje, pa napravi jasnu granicu gde se radni dan završava."},
+    "san": {"positive": "Dobar san ti pomaže, zato se drži svog ritma spavanja.", "negative": "San utiče na tvoje raspoloženje, pa probaj da ležeš i ustaješ u isto vreme."},
+    "vezba": {"positive": "Vežbanje ti prija, vrati mu se i danas, makar kroz kratku šetnju.", "negative": "Ako ti vežbanje trenutno teško pada, probaj nešto lakše, poput istezanja."},
+    "drustvo": {"positive": "Vreme sa ljudima ti puni baterije – dogovori se danas sa nekim dragim.", "negative": "Društvo te ponekad iscrpljuje i u redu je da sebi daš malo vremena nasamo."},
+    "ishrana": {"positive": "Tvoja ishrana ti daje dobru podršku, nastavi tako.", "negative": "Obrati pažnju na redovne obroke i dovoljno vode, jer utiču na to kako se osećaš."},
+    "porodica": {"positive": "Porodica ti je oslonac, pa im danas posveti malo vremena.", "negative": "Odnosi u porodici te opterećuju, pokušaj mirno da kažeš šta ti je potrebno."},
+    "zdravlje": {"positive": "Briga o zdravlju se isplati – nastavi da slušaš svoje telo.", "negative": "Zdravlje ti utiče na raspoloženje, zato budi strpljiv/a prema sebi i odmaraj kad možeš."},
+    "vreme": {"positive": "Lepo vreme ti popravlja raspoloženje, iskoristi ga za boravak napolju.", "negative": "Vremenski uslovi ti kvare raspoloženje, pokušaj da uhvatiš malo dnevnog svetla."},
+    "novac": {"positive": "Osećaj finansijske stabilnosti ti prija i to je dobra osnova.", "negative": "Brige oko novca su teške, zapiši jedan mali, konkretan korak koji možeš da preduzmeš."},
+    "ucenje": {"positive": "Učenje ti daje zamah, nastavi sa malim, redovnim koracima.", "negative": "Učenje te trenutno iscrpljuje, probaj da radiš u kraćim blokovima sa pauzama."},
+    "odmor": {"positive": "Odmor ti očigledno prija, planiraj ga svesno i ove nedelje.", "negative": "Čak i odmor može da bude stresan, pokušaj da ga ne puniš obavezama."},
+    "kreativnost": {"positive": "Kreativnost te ispunjava – odvoji danas vreme za nešto što stvaraš.", "negative": "Ako ti kreativnost trenutno ne ide, ne forsiraj je, inspiracija se vraća posle odmora."},
+}
+
+def generate_local_tip(recent_moods: list, seed: str = "") -> str:
+    # recent_moods is sorted newest first; the same input and seed always give the same tip
+    if not recent_moods:
+        return FALLBACK_AI_TIP
     
-    recent_moods = await db.moods.find({"user_id": user["user_id"]}, {"_id": 0}).sort("date", -1).limit(7).to_list(7)
+    mood_counts = Counter(m["mood_type"] for m in recent_moods)
+    recency = {m["mood_type"]: i for i, m in reversed(list(enumerate(recent_moods)))}
+    dominant = max(mood_counts, key=lambda mt: (mood_counts[mt], -recency[mt]))
+    group = MOOD_TIP_GROUPS.get(dominant, "neutral")
     
+    trigger_scores = {}
+    for m in recent_moods:
+        for t in m.get("triggers", []):
+            if t in TRIGGER_TIPS:
+                trigger_scores.setdefault(t, []).append(m["score"])
+    top_trigger = None
+    if trigger_scores:
+        trigger_order = list(TRIGGER_TYPES)
+        top_trigger = max(trigger_scores, key=lambda t: (len(trigger_scores[t]), -trigger_order.index(t)))
+    
+    variant = zlib.crc32(f"{seed}:{dominant}:{top_trigger}".encode())
+    openers = MOOD_TIP_OPENERS[group]
+    parts = [openers[variant % len(openers)]]
+    if top_trigger:
+        avg = sum(trigger_scores[top_trigger]) / len(trigger_scores[top_trigger])
+        parts.append(TRIGGER_TIPS[top_trigger]["positive" if avg >= 3 else "negative"])
+    parts.append(MOOD_TIP_ACTIONS[group])
+    return " ".join(parts)
+
+# AI Tips with free tier limit
+def build_tip_prompt(recent_moods: list) -> str:
     mood_summary = ""
     if recent_moods:
         mood_labels = [f"{m['emoji']} {m['label']}" for m in recent_moods]
@@ -532,36 +1188,172 @@ async def get_ai_tip(request: Request):
             mood_summary += f"\nFaktori koji utiču: {', '.join(trigger_labels)}"
     else:
         mood_summary = "Korisnik tek počinje da koristi aplikaciju."
-    
+    return f"{mood_summary}\n\nDaj mi personalizovani savet za danas baziran na mojim raspoloženjima."
+
+async def reserve_ai_tip(user_id: str) -> Optional[str]:
+    # One counter document per user and day. The conditional $inc reserves a tip before the
+    # LLM call; once the limit is reached the filter no longer matches and the upsert collides
+    # with the existing _id, so parallel requests can never exceed the daily quota.
+    now = datetime.now(timezone.utc)
+    quota_key = f"{user_id}:{now.strftime('%Y-%m-%d')}"
     try:
-        chat = LlmChat(
-            api_key=EMERGENT_LLM_KEY,
-            session_id=f"tips_{user['user_id']}_{datetime.now().strftime('%Y%m%d%H%M%S')}",
-            system_message="""Ti si nežan i mudar savetnik za mentalno zdravlje u aplikaciji Umiri.me.
-Pišeš na srpskom jeziku, latiničnim pismom.
-Daješ kratke, tople i praktične savete bazirane na raspoloženju korisnika.
-Tvoj ton je prijateljski, umirujući i podržavajući.
-Nikad ne dijagnostikuješ i ne zamenjuješ profesionalnu pomoć.
-Odgovaraš u 2-3 kratke rečenice. Možeš dodati i jedan emoji."""
+        await db.ai_tips_usage.find_one_and_update(
+            {"_id": quota_key, "count": {"$lt": FREE_AI_TIPS_PER_DAY}},
+            {
+                "$inc": {"count": 1},
+                "$setOnInsert": {
+                    "user_id": user_id,
+                    "date": now.strftime("%Y-%m-%d"),
+                    "expires_at": now + timedelta(days=AI_TIPS_USAGE_RETENTION_DAYS)
+                }
+            },
+            upsert=True
         )
-        chat.with_model("openai", "gpt-5.2")
-        user_msg = UserMessage(text=f"{mood_summary}\n\nDaj mi personalizovani savet za danas baziran na mojim raspoloženjima.")
-        tip_text = await chat.send_message(user_msg)
-        
-        # Track usage for free tier
-        if not premium:
-            await db.ai_tips_usage.insert_one({
-                "user_id": user["user_id"],
-                "date": datetime.now(timezone.utc).strftime("%Y-%m-%d"),
-                "created_at": datetime.now(timezone.utc).isoformat()
-            })
-        
-        return {"tip": tip_text, "generated_at": datetime.now(timezone.utc).isoformat()}
+    except DuplicateKeyError:
+        return None
+    return quota_key
+
+async def refund_ai_tip(quota_key: Optional[str]):
+    if not quota_key:
+        return
+    await db.ai_tips_usage.update_one({"_id": quota_key, "count": {"$gt": 0}}, {"$inc": {"count": -1}})
+
+async def load_tip_context(request: Request) -> tuple:
+    user = await get_current_user(request)
+    premium = await is_premium(user["user_id"])
+    recent_moods = await db.moods.find({"user_id": user["user_id"]}, {"_id": 0}).sort("date", -1).limit(7).to_list(7)
+    
+    quota_key = None
+    if not premium:
+        quota_key = await reserve_ai_tip(user["user_id"])
+        if not quota_key:
+            raise HTTPException(status_code=403, detail="Dostigao/la si dnevni limit besplatnih AI saveta. Nadogradi na Premium za neograničene savete!")
+    
+    return user, quota_key, recent_moods
+
+async def pop_cached_ai_tip(user_id: str) -> Optional[str]:
+    cached = await db.ai_tip_cache.find_one_and_delete(
+        {"_id": user_id, "expires_at": {"$gt": datetime.now(timezone.utc)}}
+    )
+    return cached["tip"] if cached else None
+
+async def cache_ai_tip(user_id: str, tip: str):
+    now = datetime.now(timezone.utc)
+    await db.ai_tip_cache.update_one(
+        {"_id": user_id},
+        {"$set": {"tip": tip, "created_at": now.isoformat(), "expires_at": now + timedelta(hours=AI_TIP_CACHE_HOURS)}},
+        upsert=True
+    )
+
+# LLM tip calls in flight per user, shared by overlapping /ai/tips requests. "waiting" counts the
+# requests still inside their hedge budget; "cache_late" is set once one of them gave up on the call
+ai_tip_calls: Dict[str, dict] = {}
+
+def start_ai_tip_call(user: dict, recent_moods: list) -> dict:
+    call = ai_tip_calls.get(user["user_id"])
+    if call is not None:
+        return call
+    task = asyncio.ensure_future(llm_gateway.complete(
+        f"tips:{user['user_id']}",
+        f"tips_{user['user_id']}_{datetime.now().strftime('%Y%m%d%H%M%S')}",
+        AI_TIPS_SYSTEM_MESSAGE, build_tip_prompt(recent_moods)
+    ))
+    call = {"task": task, "waiting": 0, "cache_late": False}
+    ai_tip_calls[user["user_id"]] = call
+    
+    def on_done(task: asyncio.Future):
+        if ai_tip_calls.get(user["user_id"]) is call:
+            ai_tip_calls.pop(user["user_id"])
+        if not call["cache_late"] or task.cancelled() or task.exception():
+            return
+        # A request still waiting on the call serves this tip itself; caching it too would serve it twice
+        if call["waiting"]:
+            return
+        spawn_background(cache_ai_tip(user["user_id"], task.result()))
+    task.add_done_callback(on_done)
+    return call
+
+@api_router.post("/ai/tips")
+async def get_ai_tip(request: Request):
+    user, quota_key, recent_moods = await load_tip_context(request)
+    local_tip = generate_local_tip(recent_moods, seed=datetime.now(timezone.utc).strftime("%Y-%m-%d"))
+    
+    if AI_TIP_CACHE_LATE_REPLIES:
+        cached_tip = await pop_cached_ai_tip(user["user_id"])
+        if cached_tip:
+            return {"tip": cached_tip, "source": "ai", "generated_at": datetime.now(timezone.utc).isoformat()}
+    
+    # Hedge: if the LLM hasn't answered within the budget, answer with the local tip
+    call = start_ai_tip_call(user, recent_moods)
+    llm_task = call["task"]
+    call["waiting"] += 1
+    try:
+        done, _ = await asyncio.wait({llm_task}, timeout=AI_TIP_HEDGE_SECONDS)
+    finally:
+        call["waiting"] -= 1
+    
+    if not done:
+        if AI_TIP_CACHE_LATE_REPLIES:
+            call["cache_late"] = True
+        elif not call["waiting"]:
+            llm_task.cancel()
+        # Only LLM tips count against the free tier
+        await refund_ai_tip(quota_key)
+        return {"tip": local_tip, "source": "local", "generated_at": datetime.now(timezone.utc).isoformat()}
+    
+    try:
+        tip_text = llm_task.result()
+        return {"tip": tip_text, "source": "ai", "generated_at": datetime.now(timezone.utc).isoformat()}
     except Exception as e:
         logger.error(f"AI tip error: {e}")
-        return {"tip": "Danas odvoji vreme za sebe. Čak i pet minuta tišine može napraviti veliku razliku. 🌿", "generated_at": datetime.now(timezone.utc).isoformat()}
+        # Fallback tips don't count against the free tier
+        await refund_ai_tip(quota_key)
+        return {"tip": local_tip, "source": "local", "generated_at": datetime.now(timezone.utc).isoformat()}
+
+@api_router.post("/ai/tips/stream")
+async def stream_ai_tip(request: Request):
+    user, quota_key, recent_moods = await load_tip_context(request)
+    
+    async def events():
+        delivered = False
+        try:
+            yield sse_event("start", {})
+            chunks = llm_gateway.stream(
+                f"tips:{user['user_id']}",
+                f"tips_{user['user_id']}_{datetime.now().strftime('%Y%m%d%H%M%S')}",
+                AI_TIPS_SYSTEM_MESSAGE, build_tip_prompt(recent_moods)
+            )
+            fallback_tip = generate_local_tip(recent_moods, seed=datetime.now(timezone.utc).strftime("%Y-%m-%d"))
+            async for event, full_text in stream_with_stall_guard(chunks, fallback_tip):
+                if event:
+                    yield event
+                    continue
+                delivered = True
+                yield sse_event("done", {"tip": full_text, "generated_at": datetime.now(timezone.utc).isoformat()})
+        finally:
+            # The reserved tip is only kept once the whole tip has been delivered
+            if not delivered:
+                await refund_ai_tip(quota_key)
+    
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 # Stripe Payment Endpoints
+# Stripe Checkout sessions expire 24 hours after creation
+CHECKOUT_SESSION_TTL_HOURS = 24
+# Don't hand out a session that would expire while the user is still paying
+CHECKOUT_REUSE_MARGIN_MINUTES = 30
+PENDING_PAYMENT_STATUSES = ["initiated", "unpaid"]
+
+# One StripeCheckout for the lifetime of the app, built from the configured webhook URL (never from
+# the caller's Host header), so the Stripe HTTP client and its connection pool are shared by every path
+stripe_client: Optional[StripeCheckout] = None
+
+def get_stripe_checkout() -> StripeCheckout:
+    global stripe_client
+    if stripe_client is None:
+        stripe_client = StripeCheckout(api_key=STRIPE_API_KEY, webhook_url=STRIPE_WEBHOOK_URL)
+    return stripe_client
+
 @api_router.get("/subscription/status")
 async def get_subscription_status(request: Request):
     user = await get_current_user(request)
@@ -582,13 +1374,28 @@ async def create_checkout(checkout_req: CheckoutRequest, request: Request):
     plan = PREMIUM_PLANS[checkout_req.plan_id]
     origin_url = checkout_req.origin_url
     
+    # Reuse an unexpired open session for the same user, plan and origin
+    now = datetime.now(timezone.utc)
+    open_txn = await db.payment_transactions.find_one(
+        {
+            "user_id": user["user_id"],
+            "plan_id": checkout_req.plan_id,
+            "origin_url": origin_url,
+            "amount": plan["amount"],
+            "payment_status": {"$in": PENDING_PAYMENT_STATUSES},
+            "status": {"$in": ["pending", "open"]},
+            "checkout_expires_at": {"$gt": (now + timedelta(minutes=CHECKOUT_REUSE_MARGIN_MINUTES)).isoformat()}
+        },
+        {"_id": 0, "session_id": 1, "checkout_url": 1},
+        sort=[("created_at", -1)]
+    )
+    if open_txn:
+        return {"url": open_txn["checkout_url"], "session_id": open_txn["session_id"]}
+    
     success_url = f"{origin_url}/premium/success?session_id={{CHECKOUT_SESSION_ID}}"
     cancel_url = f"{origin_url}/premium"
     
-    host_url = str(request.base_url).rstrip('/')
-    webhook_url = f"{host_url}/api/webhook/stripe"
-    
-    stripe_checkout = StripeCheckout(api_key=STRIPE_API_KEY, webhook_url=webhook_url)
+    stripe_checkout = get_stripe_checkout()
     
     checkout_request = CheckoutSessionRequest(
         amount=plan["amount"],
@@ -614,29 +1421,91 @@ async def create_checkout(checkout_req: CheckoutRequest, request: Request):
         "currency": plan["currency"],
         "payment_status": "initiated",
         "status": "pending",
+        "origin_url": origin_url,
+        "checkout_url": session.url,
+        "checkout_expires_at": (now + timedelta(hours=CHECKOUT_SESSION_TTL_HOURS)).isoformat(),
         "created_at": datetime.now(timezone.utc).isoformat()
     })
     
     return {"url": session.url, "session_id": session.session_id}
 
-@api_router.get("/subscription/checkout/status/{session_id}")
-async def check_checkout_status(session_id: str, request: Request):
-    user = await get_current_user(request)
-    
-    txn = await db.payment_transactions.find_one({"session_id": session_id}, {"_id": 0})
+# A claim that was never completed (worker died mid-activation) can be taken over after this long
+ACTIVATION_CLAIM_SECONDS = 300
+
+async def activate_paid_subscription(session_id: str) -> bool:
+    # Shared by the webhook consumer, status polling and reconciliation. Claiming the transaction
+    # is a single conditional write on the unique session_id, so whichever path gets there
+    # first activates the subscription and every later call is a no-op. The transaction is only
+    # marked paid once the subscription is written, so the paid fast paths never skip a failed one.
+    now = datetime.now(timezone.utc)
+    txn = await db.payment_transactions.find_one_and_update(
+        {"session_id": session_id, "$or": [
+            {"subscription_applied": {"$exists": False}},
+            {"subscription_applied": "pending", "activation_claimed_at": {"$lt": (now - timedelta(seconds=ACTIVATION_CLAIM_SECONDS)).isoformat()}}
+        ]},
+        {"$set": {"subscription_applied": "pending", "activation_claimed_at": now.isoformat()}},
+        projection={"_id": 0}
+    )
     if not txn:
-        raise HTTPException(status_code=404, detail="Transakcija nije pronađena")
-    
-    if txn.get("payment_status") == "paid":
-        return {"status": "complete", "payment_status": "paid", "message": "Plaćanje uspešno!"}
-    
-    host_url = str(request.base_url).rstrip('/')
-    webhook_url = f"{host_url}/api/webhook/stripe"
-    stripe_checkout = StripeCheckout(api_key=STRIPE_API_KEY, webhook_url=webhook_url)
+        return False
     
+    plan_id = txn.get("plan_id", "monthly")
+    plan = PREMIUM_PLANS.get(plan_id, PREMIUM_PLANS["monthly"])
+    sub = {
+        "user_id": txn["user_id"],
+        "plan_id": plan_id,
+        "session_id": session_id,
+        "is_trial": False,
+        "status": "active",
+        "started_at": now.isoformat(),
+        "expires_at": now + timedelta(days=plan["period"]),
+        "updated_at": now.isoformat()
+    }
     try:
-        checkout_status = await stripe_checkout.get_checkout_status(session_id)
-        
+        await db.subscriptions.update_one({"user_id": txn["user_id"]}, {"$set": sub}, upsert=True)
+    except Exception:
+        # Release the claim so a retry can apply it
+        await db.payment_transactions.update_one(
+            {"session_id": session_id}, {"$unset": {"subscription_applied": "", "activation_claimed_at": ""}}
+        )
+        raise
+    await db.payment_transactions.update_one({"session_id": session_id}, {"$set": {
+        "payment_status": "paid",
+        "status": "complete",
+        "subscription_applied": True,
+        "updated_at": datetime.now(timezone.utc).isoformat()
+    }})
+    await sync_user_subscription(txn["user_id"], sub)
+    notify_checkout_paid(session_id)
+    return True
+
+# Checkout status polling - short-lived per-session cache plus optional long-polling
+CHECKOUT_STATUS_CACHE_SECONDS = 5
+CHECKOUT_STATUS_MAX_WAIT_SECONDS = 25
+# While long-polling, the DB is re-checked this often for activations done by other workers
+CHECKOUT_STATUS_RECHECK_SECONDS = 2
+PAID_CHECKOUT_RESPONSE = {"status": "complete", "payment_status": "paid", "message": "Plaćanje uspešno!"}
+checkout_status_cache: Dict[str, tuple] = {}
+checkout_paid_waiters: Dict[str, list] = {}
+
+def notify_checkout_paid(session_id: str):
+    checkout_status_cache.pop(session_id, None)
+    waiter = checkout_paid_waiters.get(session_id)
+    if waiter:
+        waiter[0].set()
+
+async def fetch_checkout_status(session_id: str, txn: dict) -> dict:
+    now = time.monotonic()
+    cached = checkout_status_cache.get(session_id)
+    if cached and cached[0] > now:
+        return cached[1]
+    
+    checkout_status = await get_stripe_checkout().get_checkout_status(session_id)
+    
+    if checkout_status.payment_status == "paid":
+        await activate_paid_subscription(session_id)
+    elif (checkout_status.status, checkout_status.payment_status) != (txn.get("status"), txn.get("payment_status")):
+        # Only write when Stripe reports something new
         await db.payment_transactions.update_one(
             {"session_id": session_id},
             {"$set": {
@@ -645,79 +1514,230 @@ async def check_checkout_status(session_id: str, request: Request):
                 "updated_at": datetime.now(timezone.utc).isoformat()
             }}
         )
-        
-        if checkout_status.payment_status == "paid":
-            already_activated = await db.subscriptions.find_one({"session_id": session_id}, {"_id": 0})
-            if not already_activated:
-                plan = PREMIUM_PLANS.get(txn.get("plan_id", "monthly"), PREMIUM_PLANS["monthly"])
-                expires_at = datetime.now(timezone.utc) + timedelta(days=plan["period"])
-                
-                await db.subscriptions.update_one(
-                    {"user_id": txn["user_id"]},
-                    {"$set": {
-                        "user_id": txn["user_id"],
-                        "plan_id": txn.get("plan_id", "monthly"),
-                        "session_id": session_id,
-                        "status": "active",
-                        "started_at": datetime.now(timezone.utc).isoformat(),
-                        "expires_at": expires_at.isoformat(),
-                        "updated_at": datetime.now(timezone.utc).isoformat()
-                    }},
-                    upsert=True
-                )
-        
-        return {
-            "status": checkout_status.status,
-            "payment_status": checkout_status.payment_status,
-            "message": "Plaćanje uspešno!" if checkout_status.payment_status == "paid" else "Čeka se plaćanje..."
-        }
+    
+    result = {
+        "status": checkout_status.status,
+        "payment_status": checkout_status.payment_status,
+        "message": "Plaćanje uspešno!" if checkout_status.payment_status == "paid" else "Čeka se plaćanje..."
+    }
+    if len(checkout_status_cache) > 1000:
+        for sid in [sid for sid, (expires, _) in checkout_status_cache.items() if expires <= now]:
+            checkout_status_cache.pop(sid, None)
+    checkout_status_cache[session_id] = (now + CHECKOUT_STATUS_CACHE_SECONDS, result)
+    return result
+
+async def wait_for_checkout_paid(session_id: str, timeout: float) -> bool:
+    waiter = checkout_paid_waiters.setdefault(session_id, [asyncio.Event(), 0])
+    waiter[1] += 1
+    deadline = time.monotonic() + timeout
+    try:
+        while (remaining := deadline - time.monotonic()) > 0:
+            try:
+                await asyncio.wait_for(waiter[0].wait(), timeout=min(remaining, CHECKOUT_STATUS_RECHECK_SECONDS))
+                return True
+            except asyncio.TimeoutError:
+                pass
+            txn = await db.payment_transactions.find_one({"session_id": session_id}, {"_id": 0, "payment_status": 1})
+            if txn and txn.get("payment_status") == "paid":
+                return True
+        return False
+    finally:
+        waiter[1] -= 1
+        if waiter[1] == 0:
+            checkout_paid_waiters.pop(session_id, None)
+
+@api_router.get("/subscription/checkout/status/{session_id}")
+async def check_checkout_status(session_id: str, request: Request, wait: int = 0):
+    user = await get_current_user(request)
+    
+    txn = await db.payment_transactions.find_one({"session_id": session_id}, {"_id": 0})
+    if not txn:
+        raise HTTPException(status_code=404, detail="Transakcija nije pronađena")
+    
+    if txn.get("payment_status") == "paid":
+        return PAID_CHECKOUT_RESPONSE
+    
+    try:
+        result = await fetch_checkout_status(session_id, txn)
     except Exception as e:
         logger.error(f"Checkout status error: {e}")
         raise HTTPException(status_code=500, detail="Greška pri proveri statusa")
+    
+    # Long-poll: hold the request until the webhook consumer activates the session
+    if wait > 0 and result["payment_status"] != "paid" and result["status"] == "open":
+        if await wait_for_checkout_paid(session_id, min(wait, CHECKOUT_STATUS_MAX_WAIT_SECONDS)):
+            return PAID_CHECKOUT_RESPONSE
+    return result
 
 @api_router.post("/webhook/stripe")
 async def stripe_webhook(request: Request):
     body = await request.body()
     signature = request.headers.get("Stripe-Signature", "")
-    
-    host_url = str(request.base_url).rstrip('/')
-    webhook_url = f"{host_url}/api/webhook/stripe"
-    stripe_checkout = StripeCheckout(api_key=STRIPE_API_KEY, webhook_url=webhook_url)
+    stripe_checkout = get_stripe_checkout()
     
     try:
         webhook_response = await stripe_checkout.handle_webhook(body, signature)
-        
-        if webhook_response.payment_status == "paid":
-            session_id = webhook_response.session_id
-            txn = await db.payment_transactions.find_one({"session_id": session_id}, {"_id": 0})
-            if txn:
-                await db.payment_transactions.update_one(
-                    {"session_id": session_id},
-                    {"$set": {"payment_status": "paid", "status": "complete", "updated_at": datetime.now(timezone.utc).isoformat()}}
-                )
-                
-                already_activated = await db.subscriptions.find_one({"session_id": session_id}, {"_id": 0})
-                if not already_activated:
-                    plan = PREMIUM_PLANS.get(txn.get("plan_id", "monthly"), PREMIUM_PLANS["monthly"])
-                    expires_at = datetime.now(timezone.utc) + timedelta(days=plan["period"])
-                    await db.subscriptions.update_one(
-                        {"user_id": txn["user_id"]},
-                        {"$set": {
-                            "user_id": txn["user_id"],
-                            "plan_id": txn.get("plan_id", "monthly"),
-                            "session_id": session_id,
-                            "status": "active",
-                            "started_at": datetime.now(timezone.utc).isoformat(),
-                            "expires_at": expires_at.isoformat(),
-                            "updated_at": datetime.now(timezone.utc).isoformat()
-                        }},
-                        upsert=True
-                    )
-        
-        return {"status": "ok"}
     except Exception as e:
         logger.error(f"Webhook error: {e}")
         return {"status": "error"}
+    
+    # Persist and ack immediately; activation happens in the stripe event consumer
+    received_at = datetime.now(timezone.utc).isoformat()
+    try:
+        await db.stripe_events.insert_one({
+            "event_id": webhook_response.event_id,
+            "event_type": webhook_response.event_type,
+            "session_id": webhook_response.session_id,
+            "payment_status": webhook_response.payment_status,
+            "metadata": webhook_response.metadata,
+            "payload": body.decode("utf-8", errors="replace"),
+            "status": "pending",
+            "attempts": 0,
+            "received_at": received_at,
+            "next_attempt_at": received_at
+        })
+    except DuplicateKeyError:
+        # Stripe retried an event we already stored
+        return {"status": "ok"}
+    
+    stripe_events_signal.set()
+    return {"status": "ok"}
+
+# Stripe event consumer
+STRIPE_EVENT_LEASE_SECONDS = 60
+STRIPE_EVENT_MAX_ATTEMPTS = 10
+STRIPE_EVENT_POLL_SECONDS = 15
+stripe_events_signal = asyncio.Event()
+
+async def process_stripe_event(event: dict):
+    if event.get("payment_status") == "paid":
+        await activate_paid_subscription(event["session_id"])
+
+async def claim_stripe_event() -> Optional[dict]:
+    # Leases make the queue safe with several workers; an expired lease is picked up again
+    now = datetime.now(timezone.utc)
+    return await db.stripe_events.find_one_and_update(
+        {"$or": [
+            {"status": "pending", "next_attempt_at": {"$lte": now.isoformat()}},
+            {"status": "processing", "lease_until": {"$lt": now.isoformat()}}
+        ]},
+        {
+            "$set": {"status": "processing", "lease_until": (now + timedelta(seconds=STRIPE_EVENT_LEASE_SECONDS)).isoformat()},
+            "$inc": {"attempts": 1}
+        },
+        sort=[("next_attempt_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+async def drain_stripe_events() -> int:
+    processed = 0
+    while True:
+        event = await claim_stripe_event()
+        if not event:
+            return processed
+        try:
+            await process_stripe_event(event)
+            update = {"status": "done", "processed_at": datetime.now(timezone.utc).isoformat()}
+            processed += 1
+        except Exception as e:
+            logger.error(f"Stripe event {event.get('event_id')} failed: {e}")
+            failed = event["attempts"] >= STRIPE_EVENT_MAX_ATTEMPTS
+            retry_at = datetime.now(timezone.utc) + timedelta(seconds=min(600, 2 ** event["attempts"]))
+            update = {"status": "failed" if failed else "pending", "last_error": str(e), "next_attempt_at": retry_at.isoformat()}
+        await db.stripe_events.update_one({"_id": event["_id"]}, {"$set": update, "$unset": {"lease_until": ""}})
+
+async def stripe_event_consumer():
+    while True:
+        try:
+            await drain_stripe_events()
+        except Exception as e:
+            logger.error(f"Stripe event consumer error: {e}")
+        # Woken by the webhook; the timeout also picks up events received by other workers
+        try:
+            await asyncio.wait_for(stripe_events_signal.wait(), timeout=STRIPE_EVENT_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        stripe_events_signal.clear()
+
+# Payment reconciliation - resolves transactions stuck in "initiated" without a webhook or poll
+RECONCILE_STALE_MINUTES = 10
+RECONCILE_ABANDON_HOURS = CHECKOUT_SESSION_TTL_HOURS
+RECONCILE_CONCURRENCY = 5
+RECONCILE_BATCH_SIZE = 500
+RECONCILE_INTERVAL_SECONDS = int(os.environ.get('RECONCILE_INTERVAL_SECONDS', '600'))
+last_reconciliation: dict = {}
+
+async def expire_pending_transaction(session_id: str, metrics: Counter):
+    await db.payment_transactions.update_one(
+        {"session_id": session_id, "payment_status": {"$in": PENDING_PAYMENT_STATUSES}},
+        {"$set": {"status": "expired", "payment_status": "expired", "updated_at": datetime.now(timezone.utc).isoformat()}}
+    )
+    metrics["expired"] += 1
+
+async def reconcile_transaction(stripe_checkout, txn: dict, abandon_before: str, metrics: Counter):
+    session_id = txn["session_id"]
+    try:
+        checkout_status = await stripe_checkout.get_checkout_status(session_id)
+    except Exception as e:
+        logger.error(f"Reconciliation status error for {session_id}: {e}")
+        metrics["errors"] += 1
+        # Past the abandon cutoff the session can no longer be paid. A session Stripe keeps failing on
+        # (e.g. one it can't find) would otherwise stay at the head of the oldest-first batch forever
+        if txn["created_at"] < abandon_before:
+            await expire_pending_transaction(session_id, metrics)
+        return
+    
+    if checkout_status.payment_status == "paid":
+        if await activate_paid_subscription(session_id):
+            metrics["activated"] += 1
+        else:
+            metrics["already_applied"] += 1
+    elif checkout_status.status == "expired" or txn["created_at"] < abandon_before:
+        await expire_pending_transaction(session_id, metrics)
+    else:
+        metrics["still_pending"] += 1
+
+async def reconcile_pending_payments(stripe_checkout=None, batch_size: int = RECONCILE_BATCH_SIZE) -> dict:
+    stripe_checkout = stripe_checkout or get_stripe_checkout()
+    started = time.monotonic()
+    now = datetime.now(timezone.utc)
+    stale_before = (now - timedelta(minutes=RECONCILE_STALE_MINUTES)).isoformat()
+    abandon_before = (now - timedelta(hours=RECONCILE_ABANDON_HOURS)).isoformat()
+    
+    pending = await db.payment_transactions.find(
+        {"payment_status": {"$in": PENDING_PAYMENT_STATUSES}, "created_at": {"$lt": stale_before}},
+        {"_id": 0, "session_id": 1, "created_at": 1}
+    ).sort("created_at", 1).limit(batch_size).to_list(batch_size)
+    
+    metrics = Counter()
+    semaphore = asyncio.Semaphore(RECONCILE_CONCURRENCY)
+    
+    async def bounded(txn):
+        async with semaphore:
+            await reconcile_transaction(stripe_checkout, txn, abandon_before, metrics)
+    
+    await asyncio.gather(*[bounded(txn) for txn in pending])
+    
+    result = {
+        "scanned": len(pending),
+        **{key: metrics[key] for key in ("activated", "already_applied", "expired", "still_pending", "errors")},
+        "duration_ms": round((time.monotonic() - started) * 1000),
+        "finished_at": datetime.now(timezone.utc).isoformat()
+    }
+    last_reconciliation.clear()
+    last_reconciliation.update(result)
+    logger.info(f"Payment reconciliation: {result}")
+    return result
+
+@api_router.post("/admin/reconcile-payments")
+async def admin_reconcile_payments(request: Request):
+    await require_admin(request)
+    return await reconcile_pending_payments()
+
+@api_router.get("/admin/reconcile-payments")
+async def admin_last_reconciliation(request: Request):
+    await require_admin(request)
+    return last_reconciliation or {"message": "Usklađivanje još nije pokrenuto"}
 
 @api_router.get("/mood-types")
 async def get_mood_types():
@@ -738,59 +1758,466 @@ async def require_admin(request: Request) -> dict:
         raise HTTPException(status_code=403, detail="Nemate admin pristup")
     return user
 
+# Sortable fields for /admin/users; "-field" sorts descending
+# Every sort field has a (field, user_id) index, and the status filter has (subscription_status, field, user_id)
+# for the activity sorts; ensure_indexes must be kept in step with this set
+ADMIN_USER_SORT_FIELDS = {"created_at", "name", "email", "mood_count", "last_mood_date", "subscription_expires_at"}
+ADMIN_USER_STATUSES = {"trial", "premium", "inactive"}
+
+def admin_user_sort(sort: str) -> List[tuple]:
+    field = sort.lstrip("-")
+    if field not in ADMIN_USER_SORT_FIELDS:
+        raise HTTPException(status_code=400, detail=f"Nepoznato polje za sortiranje: {field}")
+    # user_id as tie-breaker keeps pages stable for equal values
+    direction = -1 if sort.startswith("-") else 1
+    return [(field, direction), ("user_id", direction)]
+
+def admin_user_filter(filter: str) -> dict:
+    # Comma separated "key:value" pairs, e.g. "status:trial,inactive_days:14,min_moods:5"
+    query = {}
+    now = datetime.now(timezone.utc)
+    for part in filter.split(","):
+        if not part.strip():
+            continue
+        key, _, value = part.partition(":")
+        key, value = key.strip(), value.strip()
+        try:
+            if key == "status":
+                if value not in ADMIN_USER_STATUSES:
+                    raise ValueError(value)
+                if value == "inactive":
+                    query["$or"] = [
+                        {"subscription_status": "inactive"},
+                        {"subscription_expires_at": {"$lte": now}}
+                    ]
+                else:
+                    query["subscription_status"] = value
+                    query["subscription_expires_at"] = {"$gt": now}
+            elif key == "inactive_days":
+                cutoff = (now - timedelta(days=int(value))).strftime("%Y-%m-%d")
+                # Users who never logged a mood count as inactive too
+                query["last_mood_date"] = {"$not": {"$gte": cutoff}}
+            elif key == "min_moods":
+                query["mood_count"] = {"$gte": int(value)}
+            elif key == "plan":
+                query["subscription_plan_id"] = value
+            elif key in ("signed_up_after", "signed_up_before"):
+                operator = "$gte" if key == "signed_up_after" else "$lt"
+                query.setdefault("created_at", {})[operator] = parse_day(value).isoformat()
+            else:
+                raise ValueError(key)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Neispravan filter: {part.strip()}")
+    return query
+
 @api_router.get("/admin/users")
-async def admin_list_users(request: Request, limit: int = 50, offset: int = 0, search: str = ""):
+async def admin_list_users(request: Request, limit: int = 50, offset: int = 0, search: str = "", sort: str = "", filter: str = ""):
     await require_admin(request)
-    query = {}
-    if search:
-        query = {"$or": [
-            {"name": {"$regex": search, "$options": "i"}},
-            {"email": {"$regex": search, "$options": "i"}}
-        ]}
-    users = await db.users.find(query, {"_id": 0}).skip(offset).limit(limit).to_list(limit)
+    query = {**user_search_query(search), **admin_user_filter(filter)}
+    cursor = db.users.find(query, USER_PRIVATE_FIELDS)
+    if sort:
+        cursor = cursor.sort(admin_user_sort(sort))
+    users = await cursor.skip(offset).limit(limit).to_list(limit)
     total = await db.users.count_documents(query)
     
+    # Activity and subscription summaries live on the user document, so a page is a single query
     enriched = []
     for u in users:
-        sub_info = await get_subscription_info(u["user_id"])
-        mood_count = await db.moods.count_documents({"user_id": u["user_id"]})
-        last_mood = await db.moods.find_one({"user_id": u["user_id"]}, {"_id": 0}, sort=[("date", -1)])
+        sub = None
+        if u.get("subscription_status") in ("trial", "premium"):
+            sub = {
+                "plan_id": u.get("subscription_plan_id"),
+                "is_trial": u["subscription_status"] == "trial",
+                "expires_at": u.get("subscription_expires_at")
+            }
         enriched.append({
             **u,
-            **sub_info,
-            "mood_count": mood_count,
-            "last_active": last_mood["date"] if last_mood else None
+            **subscription_info(sub),
+            "mood_count": u.get("mood_count", 0),
+            "last_active": u.get("last_mood_date")
         })
     
     return {"users": enriched, "total": total}
 
-@api_router.get("/admin/stats")
-async def admin_dashboard_stats(request: Request):
-    await require_admin(request)
-    total_users = await db.users.count_documents({})
-    total_moods = await db.moods.count_documents({})
-    active_subs = await db.subscriptions.count_documents({"status": "active"})
-    trial_subs = await db.subscriptions.count_documents({"status": "active", "is_trial": True})
-    paid_subs = active_subs - trial_subs
-    total_transactions = await db.payment_transactions.count_documents({"payment_status": "paid"})
-    
-    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-    today_moods = await db.moods.count_documents({"date": today})
-    
-    week_ago = (datetime.now(timezone.utc) - timedelta(days=7)).strftime("%Y-%m-%d")
-    weekly_active = len(await db.moods.distinct("user_id", {"date": {"$gte": week_ago}}))
-    
+# Admin dashboard metrics - one query per collection, served from a short-lived snapshot
+ADMIN_STATS_CACHE_SECONDS = int(os.environ.get('ADMIN_STATS_CACHE_SECONDS', '30'))
+admin_stats_snapshot = {"data": None, "computed_at": 0.0}
+admin_stats_refresh: Optional[asyncio.Task] = None
+
+def facet_count(result: List[dict], name: str) -> int:
+    if not result or not result[0].get(name):
+        return 0
+    return result[0][name][0]["n"]
+
+async def compute_admin_stats() -> dict:
+    now = datetime.now(timezone.utc)
+    today = now.strftime("%Y-%m-%d")
+    week_ago = (now - timedelta(days=7)).strftime("%Y-%m-%d")
+    
+    # Totals come from collection metadata instead of scanning every document
+    total_users = await db.users.estimated_document_count()
+    total_moods = await db.moods.estimated_document_count()
+    # Weekly actives are grouped and counted server-side, the id list never leaves MongoDB
+    moods = await db.moods.aggregate([
+        {"$match": {"date": {"$gte": week_ago}}},
+        {"$facet": {
+            "today": [{"$match": {"date": today}}, {"$count": "n"}],
+            "weekly_active": [{"$group": {"_id": "$user_id"}}, {"$count": "n"}]
+        }}
+    ]).to_list(1)
     return {
         "total_users": total_users,
         "total_moods": total_moods,
+        **await count_subscription_stats(),
+        "total_transactions": await db.payment_transactions.count_documents({"payment_status": "paid"}),
+        "today_moods": facet_count(moods, "today"),
+        "weekly_active_users": facet_count(moods, "weekly_active"),
+        "generated_at": now.isoformat()
+    }
+
+async def count_subscription_stats() -> dict:
+    subs = await db.subscriptions.aggregate([
+        {"$match": {"status": "active"}},
+        {"$facet": {
+            "active": [{"$count": "n"}],
+            "trial": [{"$match": {"is_trial": True}}, {"$count": "n"}]
+        }}
+    ]).to_list(1)
+    active_subs = facet_count(subs, "active")
+    trial_subs = facet_count(subs, "trial")
+    return {
         "active_subscriptions": active_subs,
         "trial_subscriptions": trial_subs,
-        "paid_subscriptions": paid_subs,
-        "total_transactions": total_transactions,
-        "today_moods": today_moods,
-        "weekly_active_users": weekly_active
+        "paid_subscriptions": active_subs - trial_subs
     }
 
+async def refresh_admin_stats() -> dict:
+    try:
+        data = await compute_admin_stats()
+    except Exception as e:
+        logger.error(f"Admin stats refresh failed: {e}")
+        raise
+    admin_stats_snapshot.update({"data": data, "computed_at": time.time()})
+    return data
+
+async def get_admin_stats() -> dict:
+    global admin_stats_refresh
+    if admin_stats_refresh is None or admin_stats_refresh.done():
+        if admin_stats_snapshot["data"] is not None and time.time() - admin_stats_snapshot["computed_at"] < ADMIN_STATS_CACHE_SECONDS:
+            return admin_stats_snapshot["data"]
+        admin_stats_refresh = spawn_background(refresh_admin_stats())
+    if admin_stats_snapshot["data"] is not None:
+        # Stale snapshot is served while a single refresh runs in the background
+        return admin_stats_snapshot["data"]
+    return await asyncio.shield(admin_stats_refresh)
+
+@api_router.get("/admin/stats")
+async def admin_dashboard_stats(request: Request):
+    await require_admin(request)
+    return await get_admin_stats()
+
+# Live admin stats - counters kept in memory and updated from change streams while admins are connected
+ADMIN_STREAM_COALESCE_SECONDS = float(os.environ.get('ADMIN_STREAM_COALESCE_SECONDS', '1'))
+ADMIN_STREAM_POLL_SECONDS = float(os.environ.get('ADMIN_STREAM_POLL_SECONDS', '15'))
+ADMIN_STREAM_KEEPALIVE_SECONDS = 20
+ADMIN_STREAM_COLLECTIONS = ["users", "moods", "subscriptions", "payment_transactions"]
+# Code MongoDB returns when $changeStream is used on a standalone server
+CHANGE_STREAMS_UNSUPPORTED = 40573
+
+class AdminStatsFeed:
+    def __init__(self, coalesce_seconds: float, poll_seconds: float):
+        self.coalesce_seconds = coalesce_seconds
+        self.poll_seconds = poll_seconds
+        self.stats: Optional[dict] = None
+        self.version = 0
+        self.mode = "starting"
+        self.subscribers = 0
+        self._updated = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._day = None
+    
+    def subscribe(self):
+        self.subscribers += 1
+        if self._task is None or self._task.done():
+            self._task = spawn_background(self.run())
+    
+    def unsubscribe(self):
+        self.subscribers -= 1
+        if self.subscribers <= 0 and self._task:
+            self._task.cancel()
+            self._task = None
+            self.stats = None
+    
+    def publish(self):
+        self.stats["generated_at"] = datetime.now(timezone.utc).isoformat()
+        self.version += 1
+        updated, self._updated = self._updated, asyncio.Event()
+        updated.set()
+    
+    async def wait_for_update(self, seen_version: int, timeout: float) -> bool:
+        if self.version != seen_version and self.stats is not None:
+            return True
+        try:
+            await asyncio.wait_for(self._updated.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+    
+    async def resync(self):
+        self.stats = await compute_admin_stats()
+        self._day = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+        self.publish()
+    
+    async def run(self):
+        # Every (re)connect recounts from the database and opens a fresh stream; resuming from an
+        # old token would replay changes the recount already includes
+        while True:
+            try:
+                await self.resync()
+                await self.watch()
+            except asyncio.CancelledError:
+                raise
+            except OperationFailure as e:
+                if e.code != CHANGE_STREAMS_UNSUPPORTED:
+                    logger.error(f"Admin stats change stream error: {e}")
+                    await asyncio.sleep(self.poll_seconds)
+                    continue
+                logger.info("Change streams unavailable, admin stats fall back to polling")
+                await self.poll()
+            except Exception as e:
+                logger.error(f"Admin stats feed error: {e}")
+                await asyncio.sleep(self.poll_seconds)
+    
+    async def poll(self):
+        self.mode = "polling"
+        while True:
+            await asyncio.sleep(self.poll_seconds)
+            previous = {k: v for k, v in self.stats.items() if k != "generated_at"}
+            self.stats = await compute_admin_stats()
+            if {k: v for k, v in self.stats.items() if k != "generated_at"} != previous:
+                self.publish()
+    
+    async def watch(self):
+        pipeline = [{"$match": {
+            "ns.coll": {"$in": ADMIN_STREAM_COLLECTIONS},
+            "operationType": {"$in": ["insert", "update", "replace", "delete"]}
+        }}]
+        max_await_ms = max(1, int(self.coalesce_seconds * 1000))
+        async with db.watch(pipeline, max_await_time_ms=max_await_ms) as stream:
+            self.mode = "change_stream"
+            pending = set()
+            last_flush = 0.0
+            while True:
+                change = await stream.try_next()
+                if change is not None:
+                    pending.add(self.apply(change))
+                    # Bursts are folded into one push per coalescing window
+                    if time.monotonic() - last_flush < self.coalesce_seconds:
+                        continue
+                if pending:
+                    await self.flush(pending)
+                    pending = set()
+                    last_flush = time.monotonic()
+                elif self._day != datetime.now(timezone.utc).strftime("%Y-%m-%d"):
+                    await self.resync()
+    
+    def apply(self, change: dict) -> str:
+        collection = change["ns"]["coll"]
+        operation = change["operationType"]
+        if collection == "users" and operation == "insert":
+            self.stats["total_users"] += 1
+        elif collection == "users" and operation == "delete":
+            self.stats["total_users"] -= 1
+        elif collection == "moods" and operation == "insert":
+            self.stats["total_moods"] += 1
+            if change.get("fullDocument", {}).get("date") == self._day:
+                self.stats["today_moods"] += 1
+        elif collection == "moods" and operation == "delete":
+            self.stats["total_moods"] -= 1
+        return collection
+    
+    async def flush(self, pending: set):
+        if self._day != datetime.now(timezone.utc).strftime("%Y-%m-%d"):
+            await self.resync()
+            return
+        # Status flips can't be applied as deltas without pre-images, so these are recounted on an index
+        if "subscriptions" in pending:
+            self.stats.update(await count_subscription_stats())
+        if "payment_transactions" in pending:
+            self.stats["total_transactions"] = await db.payment_transactions.count_documents({"payment_status": "paid"})
+        self.publish()
+
+admin_stats_feed = AdminStatsFeed(ADMIN_STREAM_COALESCE_SECONDS, ADMIN_STREAM_POLL_SECONDS)
+
+@api_router.get("/admin/stats/stream")
+async def admin_stats_stream(request: Request):
+    await require_admin(request)
+    
+    async def events():
+        admin_stats_feed.subscribe()
+        try:
+            seen = 0
+            while not await request.is_disconnected():
+                if await admin_stats_feed.wait_for_update(seen, ADMIN_STREAM_KEEPALIVE_SECONDS):
+                    seen = admin_stats_feed.version
+                    yield sse_event("stats", {**admin_stats_feed.stats, "mode": admin_stats_feed.mode})
+                else:
+                    yield ": keepalive\n\n"
+        finally:
+            admin_stats_feed.unsubscribe()
+    
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# Daily activity rollups - one document per UTC day with the day's counts (DAU, WAU, MAU, signups).
+# The user ids behind them live in activity_days, one small document per active user and day,
+# so no single document grows with the user base
+DAILY_ACTIVITY_INTERVAL_SECONDS = int(os.environ.get('DAILY_ACTIVITY_INTERVAL_SECONDS', '3600'))
+DAILY_ACTIVITY_BACKFILL_DAYS = int(os.environ.get('DAILY_ACTIVITY_BACKFILL_DAYS', '90'))
+DAILY_ACTIVITY_BATCH = 1000
+METRICS_MAX_DAYS = 365
+
+def parse_day(value: str) -> datetime:
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Datum mora biti u formatu YYYY-MM-DD")
+
+def week_start(day: str) -> str:
+    date = datetime.strptime(day, "%Y-%m-%d")
+    return (date - timedelta(days=date.weekday())).strftime("%Y-%m-%d")
+
+async def count_active_users(start: str, end: str) -> int:
+    result = await db.activity_days.aggregate([
+        {"$match": {"date": {"$gte": start, "$lte": end}}},
+        {"$group": {"_id": "$user_id"}},
+        {"$count": "users"}
+    ], allowDiskUse=True).to_list(1)
+    return result[0]["users"] if result else 0
+
+async def write_activity_days(day: str, active: list, rolled_at: str):
+    users = await db.users.find(
+        {"user_id": {"$in": [a["_id"] for a in active]}}, {"_id": 0, "user_id": 1, "created_at": 1}
+    ).to_list(None)
+    cohorts = {
+        u["user_id"]: week_start(as_utc_datetime(u["created_at"]).strftime("%Y-%m-%d"))
+        for u in users if u.get("created_at")
+    }
+    await db.activity_days.bulk_write([
+        UpdateOne({"_id": f"{day}:{a['_id']}"}, {"$set": {
+            "user_id": a["_id"], "date": day, "week": week_start(day), "cohort": cohorts.get(a["_id"]), "rolled_at": rolled_at
+        }}, upsert=True)
+        for a in active
+    ], ordered=False)
+
+async def rollup_daily_activity(day: str) -> dict:
+    start = parse_day(day)
+    rolled_at = datetime.now(timezone.utc).isoformat()
+    active_count = mood_count = 0
+    batch = []
+    async for a in db.moods.aggregate([
+        {"$match": {"date": day}},
+        {"$group": {"_id": "$user_id", "moods": {"$sum": 1}}}
+    ]):
+        active_count += 1
+        mood_count += a["moods"]
+        batch.append(a)
+        if len(batch) >= DAILY_ACTIVITY_BATCH:
+            await write_activity_days(day, batch, rolled_at)
+            batch = []
+    if batch:
+        await write_activity_days(day, batch, rolled_at)
+    # Users whose moods for the day were deleted since the last rollup
+    await db.activity_days.delete_many({"date": day, "rolled_at": {"$ne": rolled_at}})
+    
+    rollup = {
+        "date": day,
+        "active_count": active_count,
+        "mood_count": mood_count,
+        "wau": await count_active_users((start - timedelta(days=6)).strftime("%Y-%m-%d"), day),
+        "mau": await count_active_users((start - timedelta(days=29)).strftime("%Y-%m-%d"), day),
+        "signup_count": await db.users.count_documents(
+            {"created_at": {"$gte": start.isoformat(), "$lt": (start + timedelta(days=1)).isoformat()}}
+        ),
+        "computed_at": rolled_at
+    }
+    await db.daily_activity.update_one({"_id": day}, {"$set": rollup, "$unset": {"active_users": "", "signups": ""}}, upsert=True)
+    return rollup
+
+async def backfill_daily_activity(days: int, only_missing: bool = True) -> int:
+    today = datetime.now(timezone.utc)
+    # Oldest first: a day's WAU/MAU count the activity of the days before it
+    wanted = [(today - timedelta(days=i)).strftime("%Y-%m-%d") for i in range(days - 1, -1, -1)]
+    if only_missing:
+        existing = set(await db.daily_activity.distinct("_id", {"_id": {"$in": wanted}}))
+        # Everything from the first missing day on, since the windows after it are stale too.
+        # Today and yesterday are still changing (late entries around midnight), so they are always recomputed
+        missing = [i for i, day in enumerate(wanted) if day not in existing]
+        wanted = wanted[min(missing + [max(len(wanted) - 2, 0)]):]
+    for day in wanted:
+        await rollup_daily_activity(day)
+    return len(wanted)
+
+async def refresh_daily_activity() -> int:
+    return await backfill_daily_activity(DAILY_ACTIVITY_BACKFILL_DAYS)
+
+async def load_daily_activity(start: str, end: str, fields: dict) -> dict:
+    docs = await db.daily_activity.find({"_id": {"$gte": start, "$lte": end}}, fields).to_list(None)
+    return {doc["_id"]: doc for doc in docs}
+
+@api_router.get("/admin/metrics/active")
+async def admin_metrics_active(request: Request, days: int = 30, end: str = ""):
+    await require_admin(request)
+    days = max(1, min(days, METRICS_MAX_DAYS))
+    end_day = parse_day(end) if end else datetime.now(timezone.utc)
+    series_days = [(end_day - timedelta(days=i)).strftime("%Y-%m-%d") for i in range(days - 1, -1, -1)]
+    rollups = await load_daily_activity(series_days[0], series_days[-1], {"active_count": 1, "wau": 1, "mau": 1})
+    
+    series = []
+    for day in series_days:
+        rollup = rollups.get(day, {})
+        series.append({"date": day, "dau": rollup.get("active_count", 0), "wau": rollup.get("wau", 0), "mau": rollup.get("mau", 0)})
+    return {"series": series}
+
+@api_router.get("/admin/metrics/retention")
+async def admin_metrics_retention(request: Request, weeks: int = 8, end: str = ""):
+    await require_admin(request)
+    weeks = max(1, min(weeks, METRICS_MAX_DAYS // 7))
+    end_day = parse_day(end) if end else datetime.now(timezone.utc)
+    end_week = parse_day(week_start(end_day.strftime("%Y-%m-%d")))
+    week_keys = [(end_week - timedelta(weeks=i)).strftime("%Y-%m-%d") for i in range(weeks - 1, -1, -1)]
+    last_day = (end_week + timedelta(days=6)).strftime("%Y-%m-%d")
+    rollups = await load_daily_activity(week_keys[0], last_day, {"signup_count": 1})
+    
+    signups = Counter()
+    for day, doc in rollups.items():
+        signups[week_start(day)] += doc.get("signup_count", 0)
+    # Distinct users per (signup week, active week), counted by MongoDB so only weeks² rows come back
+    retained_rows = await db.activity_days.aggregate([
+        {"$match": {"week": {"$gte": week_keys[0], "$lte": week_keys[-1]}, "cohort": {"$gte": week_keys[0], "$lte": week_keys[-1]}}},
+        {"$group": {"_id": {"cohort": "$cohort", "week": "$week", "user_id": "$user_id"}}},
+        {"$group": {"_id": {"cohort": "$_id.cohort", "week": "$_id.week"}, "users": {"$sum": 1}}}
+    ], allowDiskUse=True).to_list(None)
+    retained_by_week = {(row["_id"]["cohort"], row["_id"]["week"]): row["users"] for row in retained_rows}
+    
+    result = []
+    for n, week in enumerate(week_keys):
+        cohort = signups[week]
+        retained = [retained_by_week.get((week, later), 0) for later in week_keys[n:]]
+        result.append({
+            "week": week,
+            "signups": cohort,
+            "active": retained,
+            "retention": [round(r / cohort, 4) if cohort else 0.0 for r in retained]
+        })
+    return {"cohorts": result}
+
+@api_router.post("/admin/metrics/rollup")
+async def admin_metrics_rollup(request: Request, days: int = 1):
+    await require_admin(request)
+    days = max(1, min(days, METRICS_MAX_DAYS))
+    rolled = await backfill_daily_activity(days, only_missing=False)
+    return {"message": "Rollup završen", "days": rolled}
+
 @api_router.post("/admin/grant-premium")
 async def admin_grant_premium(data: AdminGrantPremium, request: Request):
     await require_admin(request)
@@ -802,20 +2229,18 @@ async def admin_grant_premium(data: AdminGrantPremium, request: Request):
     now = datetime.now(timezone.utc)
     expires_at = now + timedelta(days=data.days)
     
-    await db.subscriptions.update_one(
-        {"user_id": data.user_id},
-        {"$set": {
-            "user_id": data.user_id,
-            "plan_id": data.plan_id,
-            "is_trial": False,
-            "status": "active",
-            "started_at": now.isoformat(),
-            "expires_at": expires_at.isoformat(),
-            "updated_at": now.isoformat(),
-            "granted_by": "admin"
-        }},
-        upsert=True
-    )
+    sub = {
+        "user_id": data.user_id,
+        "plan_id": data.plan_id,
+        "is_trial": False,
+        "status": "active",
+        "started_at": now.isoformat(),
+        "expires_at": expires_at,
+        "updated_at": now.isoformat(),
+        "granted_by": "admin"
+    }
+    await db.subscriptions.update_one({"user_id": data.user_id}, {"$set": sub}, upsert=True)
+    await sync_user_subscription(data.user_id, sub)
     
     return {"message": f"Premium dodeljen korisniku {user['name']} na {data.days} dana", "expires_at": expires_at.isoformat()}
 
@@ -831,188 +2256,486 @@ async def admin_revoke_premium(request: Request):
         {"user_id": user_id},
         {"$set": {"status": "revoked", "updated_at": datetime.now(timezone.utc).isoformat()}}
     )
+    await sync_user_subscription(user_id, None)
     
     return {"message": "Premium ukinut" if result.modified_count else "Korisnik nema aktivnu pretplatu"}
 
+# Bulk premium grant/revoke - runs as a background job in chunks, progress is kept in admin_jobs
+BULK_PREMIUM_CHUNK = 1000
+
+async def bulk_target_user_ids(data: AdminBulkPremium):
+    # Explicit ids are checked against users so unknown ids don't create orphan subscriptions
+    if data.user_ids:
+        for i in range(0, len(data.user_ids), BULK_PREMIUM_CHUNK):
+            chunk = data.user_ids[i:i + BULK_PREMIUM_CHUNK]
+            users = await db.users.find({"user_id": {"$in": chunk}}, {"_id": 0, "user_id": 1}).to_list(None)
+            yield [u["user_id"] for u in users]
+        return
+    # Pages walk _id, which the job never changes, so updating the filtered fields can't skip users
+    query = {**user_search_query(data.search), **admin_user_filter(data.filter)}
+    last_id = None
+    while True:
+        page_query = {**query, "_id": {"$gt": last_id}} if last_id is not None else query
+        users = await db.users.find(page_query, {"_id": 1, "user_id": 1}).sort("_id", 1).limit(BULK_PREMIUM_CHUNK).to_list(None)
+        if not users:
+            return
+        last_id = users[-1]["_id"]
+        yield [u["user_id"] for u in users]
+
+async def grant_premium_chunk(user_ids: List[str], sub: dict) -> int:
+    result = await db.subscriptions.bulk_write([
+        UpdateOne({"user_id": user_id}, {"$set": {**sub, "user_id": user_id}}, upsert=True)
+        for user_id in user_ids
+    ], ordered=False)
+    await db.users.update_many({"user_id": {"$in": user_ids}}, {"$set": user_subscription_fields(sub)})
+    return result.modified_count + result.upserted_count
+
+async def revoke_premium_chunk(user_ids: List[str], sub: dict) -> int:
+    result = await db.subscriptions.update_many(
+        {"user_id": {"$in": user_ids}, "status": "active"},
+        {"$set": {"status": "revoked", "updated_at": sub["updated_at"]}}
+    )
+    await db.users.update_many({"user_id": {"$in": user_ids}}, {"$set": user_subscription_fields(None)})
+    return result.modified_count
+
+async def run_bulk_premium_job(job_id: str, data: AdminBulkPremium, apply_chunk, sub: dict):
+    try:
+        async for user_ids in bulk_target_user_ids(data):
+            if not user_ids:
+                continue
+            changed = await apply_chunk(user_ids, sub)
+            invalidate_entitlement(*user_ids)
+            await db.admin_jobs.update_one({"job_id": job_id}, {
+                "$inc": {"processed": len(user_ids), "changed": changed},
+                "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}
+            })
+        status, error = "completed", None
+    except Exception as e:
+        logger.error(f"Bulk premium job {job_id} failed: {e}")
+        status, error = "failed", str(e)
+    await db.admin_jobs.update_one({"job_id": job_id}, {"$set": {
+        "status": status,
+        "error": error,
+        "finished_at": datetime.now(timezone.utc).isoformat()
+    }})
+
+async def start_bulk_premium_job(request: Request, data: AdminBulkPremium, job_type: str) -> dict:
+    admin = await require_admin(request)
+    if not data.user_ids and not data.filter and not data.search:
+        raise HTTPException(status_code=400, detail="Navedite user_ids, filter ili search")
+    query = {**user_search_query(data.search), **admin_user_filter(data.filter)}
+    total = len(data.user_ids) if data.user_ids else await db.users.count_documents(query)
+    
+    now = datetime.now(timezone.utc)
+    job = {
+        "job_id": f"job_{uuid.uuid4().hex[:12]}",
+        "type": job_type,
+        "status": "running",
+        "total": total,
+        "processed": 0,
+        "changed": 0,
+        "created_by": admin["email"],
+        "started_at": now.isoformat(),
+        "updated_at": now.isoformat()
+    }
+    await db.admin_jobs.insert_one(job)
+    if job_type == "grant_premium":
+        sub = {
+            "plan_id": data.plan_id,
+            "is_trial": False,
+            "status": "active",
+            "started_at": now.isoformat(),
+            "expires_at": now + timedelta(days=data.days),
+            "updated_at": now.isoformat(),
+            "granted_by": "admin"
+        }
+        spawn_background(run_bulk_premium_job(job["job_id"], data, grant_premium_chunk, sub))
+    else:
+        spawn_background(run_bulk_premium_job(job["job_id"], data, revoke_premium_chunk, {"updated_at": now.isoformat()}))
+    return {k: v for k, v in job.items() if k != "_id"}
+
+@api_router.post("/admin/grant-premium/bulk")
+async def admin_bulk_grant_premium(data: AdminBulkPremium, request: Request):
+    return await start_bulk_premium_job(request, data, "grant_premium")
+
+@api_router.post("/admin/revoke-premium/bulk")
+async def admin_bulk_revoke_premium(data: AdminBulkPremium, request: Request):
+    return await start_bulk_premium_job(request, data, "revoke_premium")
+
+@api_router.get("/admin/jobs/{job_id}")
+async def admin_get_job(job_id: str, request: Request):
+    await require_admin(request)
+    job = await db.admin_jobs.find_one({"job_id": job_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Posao nije pronađen")
+    return job
+
+@api_router.post("/admin/maintenance/backfill")
+async def admin_backfill(request: Request):
+    await require_admin(request)
+    subscription_dates = await backfill_subscription_dates()
+    search_terms = await backfill_user_search_terms(only_missing=False)
+    activity = await backfill_user_activity(only_missing=False)
+    reminders = await backfill_reminder_schedule(only_missing=False)
+    return {
+        "message": "Backfill završen",
+        "users_search_terms": search_terms,
+        "users_activity": activity,
+        "reminder_schedule": reminders,
+        "subscription_dates": subscription_dates
+    }
+
 @api_router.get("/admin/check")
 async def admin_check(request: Request):
     user = await get_current_user(request)
     is_admin = user.get("email") in ADMIN_EMAILS
     return {"is_admin": is_admin}
 
-# Email Templates
-def get_mood_reminder_email(user_name: str) -> tuple:
-    subject = "Kako se danas osećaš? 🌿"
-    html = f"""
-    <!DOCTYPE html>
-    <html>
-    <head><meta charset="utf-8"></head>
-    <body style="font-family: 'Segoe UI', Arial, sans-serif; background-color: #F9F9F7; margin: 0; padding: 40px 20px;">
-        <table width="100%" cellpadding="0" cellspacing="0" style="max-width: 500px; margin: 0 auto;">
-            <tr>
-                <td style="background: linear-gradient(135deg, #4A6C6F 0%, #5C7F82 100%); border-radius: 20px 20px 0 0; padding: 30px; text-align: center;">
-                    <h1 style="color: white; margin: 0; font-size: 24px; font-weight: 300;">umiri.me</h1>
-                </td>
-            </tr>
-            <tr>
-                <td style="background: white; padding: 40px 30px; border-radius: 0 0 20px 20px;">
-                    <h2 style="color: #2D3A3A; margin: 0 0 20px 0; font-size: 22px;">Zdravo, {user_name}! 👋</h2>
-                    <p style="color: #5C6B6B; font-size: 16px; line-height: 1.6; margin: 0 0 25px 0;">
-                        Primetili smo da danas još nisi zabeležio/la svoje raspoloženje. 
-                        Odvoji minut da pratiš kako se osećaš – to je mali korak sa velikim uticajem na tvoje blagostanje.
-                    </p>
-                    <table width="100%" cellpadding="0" cellspacing="0">
-                        <tr>
-                            <td align="center">
-                                <a href="https://umiri.me/mood" style="display: inline-block; background: #4A6C6F; color: white; text-decoration: none; padding: 14px 35px; border-radius: 30px; font-size: 16px; font-weight: 500;">
-                                    Zabeleži raspoloženje
-                                </a>
-                            </td>
-                        </tr>
-                    </table>
-                    <p style="color: #8A9999; font-size: 13px; margin: 30px 0 0 0; text-align: center;">
-                        Svaki dan je nova prilika da se povežeš sa sobom. 🌱
-                    </p>
-                </td>
-            </tr>
-            <tr>
-                <td style="padding: 20px; text-align: center;">
-                    <p style="color: #8A9999; font-size: 12px; margin: 0;">
-                        Ako ne želiš više da primaš ove podsetnice, možeš ih isključiti u 
-                        <a href="https://umiri.me/profile" style="color: #4A6C6F;">podešavanjima profila</a>.
-                    </p>
-                </td>
-            </tr>
-        </table>
-    </body>
-    </html>
-    """
-    return subject, html
-
-def get_trial_warning_email(user_name: str, days_left: int) -> tuple:
-    subject = f"Tvoj trial ističe za {days_left} dana ⏰"
-    html = f"""
-    <!DOCTYPE html>
-    <html>
-    <head><meta charset="utf-8"></head>
-    <body style="font-family: 'Segoe UI', Arial, sans-serif; background-color: #F9F9F7; margin: 0; padding: 40px 20px;">
-        <table width="100%" cellpadding="0" cellspacing="0" style="max-width: 500px; margin: 0 auto;">
-            <tr>
-                <td style="background: linear-gradient(135deg, #E09F7D 0%, #D4896A 100%); border-radius: 20px 20px 0 0; padding: 30px; text-align: center;">
-                    <h1 style="color: white; margin: 0; font-size: 24px; font-weight: 300;">umiri.me</h1>
-                </td>
-            </tr>
-            <tr>
-                <td style="background: white; padding: 40px 30px; border-radius: 0 0 20px 20px;">
-                    <h2 style="color: #2D3A3A; margin: 0 0 20px 0; font-size: 22px;">Zdravo, {user_name}! 👋</h2>
-                    <p style="color: #5C6B6B; font-size: 16px; line-height: 1.6; margin: 0 0 15px 0;">
-                        Tvoj <strong>7-dnevni besplatni trial</strong> ističe za <strong style="color: #E09F7D;">{days_left} dana</strong>.
-                    </p>
-                    <p style="color: #5C6B6B; font-size: 16px; line-height: 1.6; margin: 0 0 25px 0;">
-                        Da bi nastavio/la da koristiš sve Premium funkcije – neograničene AI savete, 
-                        nedeljne izveštaje i CSV izvoz – nadogradi svoj nalog.
-                    </p>
-                    <table width="100%" cellpadding="0" cellspacing="0" style="background: #F2F4F0; border-radius: 12px; padding: 20px; margin: 0 0 25px 0;">
-                        <tr>
-                            <td>
-                                <p style="color: #2D3A3A; font-size: 14px; margin: 0 0 10px 0; font-weight: 600;">Premium uključuje:</p>
-                                <p style="color: #5C6B6B; font-size: 14px; margin: 0; line-height: 1.8;">
-                                    ✓ Neograničeni AI saveti<br>
-                                    ✓ Nedeljni AI izveštaji<br>
-                                    ✓ CSV izvoz podataka<br>
-                                    ✓ Prioritetna podrška
-                                </p>
-                            </td>
-                        </tr>
-                    </table>
-                    <table width="100%" cellpadding="0" cellspacing="0">
-                        <tr>
-                            <td align="center">
-                                <a href="https://umiri.me/premium" style="display: inline-block; background: #E09F7D; color: white; text-decoration: none; padding: 14px 35px; border-radius: 30px; font-size: 16px; font-weight: 500;">
-                                    Nadogradi na Premium
-                                </a>
-                            </td>
-                        </tr>
-                    </table>
-                    <p style="color: #8A9999; font-size: 13px; margin: 25px 0 0 0; text-align: center;">
-                        Samo 500 RSD mesečno ili 4200 RSD godišnje (uštedi 30%)
-                    </p>
-                </td>
-            </tr>
-        </table>
-    </body>
-    </html>
-    """
-    return subject, html
-
-def get_trial_expired_email(user_name: str) -> tuple:
-    subject = "Tvoj trial je istekao – nastavi sa Premium! 💫"
-    html = f"""
-    <!DOCTYPE html>
-    <html>
-    <head><meta charset="utf-8"></head>
-    <body style="font-family: 'Segoe UI', Arial, sans-serif; background-color: #F9F9F7; margin: 0; padding: 40px 20px;">
-        <table width="100%" cellpadding="0" cellspacing="0" style="max-width: 500px; margin: 0 auto;">
-            <tr>
-                <td style="background: linear-gradient(135deg, #7CA5B8 0%, #6994A7 100%); border-radius: 20px 20px 0 0; padding: 30px; text-align: center;">
-                    <h1 style="color: white; margin: 0; font-size: 24px; font-weight: 300;">umiri.me</h1>
-                </td>
-            </tr>
-            <tr>
-                <td style="background: white; padding: 40px 30px; border-radius: 0 0 20px 20px;">
-                    <h2 style="color: #2D3A3A; margin: 0 0 20px 0; font-size: 22px;">Zdravo, {user_name}! 👋</h2>
-                    <p style="color: #5C6B6B; font-size: 16px; line-height: 1.6; margin: 0 0 20px 0;">
-                        Tvoj besplatni trial period je završen. Hvala ti što si isprobao/la Umiri.me!
-                    </p>
-                    <p style="color: #5C6B6B; font-size: 16px; line-height: 1.6; margin: 0 0 25px 0;">
-                        I dalje možeš beležiti raspoloženja, ali Premium funkcije su sada zaključane. 
-                        Nadogradi da nastaviš da koristiš sve što ti pomaže na putu ka boljem blagostanju.
-                    </p>
-                    <table width="100%" cellpadding="0" cellspacing="0">
-                        <tr>
-                            <td align="center">
-                                <a href="https://umiri.me/premium" style="display: inline-block; background: #4A6C6F; color: white; text-decoration: none; padding: 14px 35px; border-radius: 30px; font-size: 16px; font-weight: 500;">
-                                    Nastavi sa Premium
-                                </a>
-                            </td>
-                        </tr>
-                    </table>
-                    <p style="color: #8A9999; font-size: 13px; margin: 25px 0 0 0; text-align: center;">
-                        Uvek možeš nastaviti besplatno – tvoji podaci su sačuvani. 🌿
-                    </p>
-                </td>
-            </tr>
-        </table>
-    </body>
-    </html>
-    """
-    return subject, html
-
-# Email sending helper
-async def send_email_async(to_email: str, subject: str, html_content: str) -> bool:
-    if not RESEND_API_KEY or RESEND_API_KEY == 're_your_api_key_here':
+# Email templates - Jinja2 templates in templates/emails (<name>.subject.txt, <name>.html, <name>.txt)
+# are compiled once; each template and shared context (e.g. days_left) is rendered once into a shell
+# and recipients only get their own fields joined in
+APP_URL = os.environ.get('APP_URL', 'https://umiri.me')
+EMAIL_TEMPLATE_DIR = ROOT_DIR / "templates" / "emails"
+EMAIL_RECIPIENT_FIELDS = ("user_name",)
+EMAIL_FIELD_MARKER = "\x00"
+
+class EmailTemplates:
+    PARTS = (("subject", "{name}.subject.txt"), ("html", "{name}.html"), ("text", "{name}.txt"))
+    
+    def __init__(self, directory: Path, **globals):
+        self.env = Environment(
+            loader=FileSystemLoader(directory),
+            autoescape=select_autoescape(["html"]),
+            trim_blocks=True,
+            lstrip_blocks=True
+        )
+        self.env.globals.update(globals)
+        self._shells: Dict[tuple, dict] = {}
+    
+    def shell(self, name: str, **context) -> dict:
+        # Recipient fields are rendered as markers and split out, leaving [static, field, static, ...]
+        key = (name, tuple(sorted(context.items())))
+        shell = self._shells.get(key)
+        if shell is None:
+            markers = {field: f"{EMAIL_FIELD_MARKER}{field}{EMAIL_FIELD_MARKER}" for field in EMAIL_RECIPIENT_FIELDS}
+            split = re.compile(f"{EMAIL_FIELD_MARKER}(\\w+){EMAIL_FIELD_MARKER}")
+            shell = {}
+            for part, filename in self.PARTS:
+                rendered = self.env.get_template(filename.format(name=name)).render(**context, **markers)
+                shell[part] = split.split(rendered.strip() if part == "subject" else rendered)
+            self._shells[key] = shell
+        return shell
+    
+    def render(self, name: str, recipient: dict, **context) -> dict:
+        # Returns {"subject", "html", "text"}; only the html part escapes recipient fields
+        rendered = {}
+        for part, segments in self.shell(name, **context).items():
+            pieces = list(segments)
+            for i in range(1, len(pieces), 2):
+                value = str(recipient[pieces[i]])
+                pieces[i] = str(escape(value)) if part == "html" else value
+            rendered[part] = "".join(pieces)
+        return rendered
+
+email_templates = EmailTemplates(EMAIL_TEMPLATE_DIR, app_url=APP_URL, trial_days=TRIAL_DAYS)
+
+# Email sending - Resend's HTTP API over a pooled client, batched and rate limited
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class EmailDispatcher:
+    MAX_ATTEMPTS = 3
+    
+    def __init__(self, api_url: str, api_key: Optional[str], sender: str, workers: int, batch_size: int, rate_per_second: float):
+        self.api_url = api_url.rstrip("/")
+        self.api_key = api_key
+        self.sender = sender
+        self.workers = workers
+        self.batch_size = batch_size
+        self.bucket = TokenBucket(rate_per_second, max(1.0, rate_per_second))
+        self._client: Optional[httpx.AsyncClient] = None
+    
+    @property
+    def configured(self) -> bool:
+        return bool(self.api_key) and self.api_key != 're_your_api_key_here'
+    
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.api_url,
+                headers={"Authorization": f"Bearer {self.api_key}"},
+                timeout=httpx.Timeout(30.0, connect=5.0),
+                limits=httpx.Limits(max_connections=self.workers, max_keepalive_connections=self.workers)
+            )
+        return self._client
+    
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+    
+    def payload(self, message: dict) -> dict:
+        payload = {"from": self.sender, "to": [message["to"]], "subject": message["subject"], "html": message["html"]}
+        if message.get("text"):
+            payload["text"] = message["text"]
+        return payload
+    
+    async def post(self, path: str, body) -> bool:
+        for attempt in range(self.MAX_ATTEMPTS):
+            await self.bucket.acquire()
+            try:
+                response = await self.client.post(path, json=body)
+            except httpx.HTTPError as e:
+                logger.warning(f"Email API request failed (attempt {attempt + 1}): {e}")
+                await asyncio.sleep(2 ** attempt)
+                continue
+            if response.status_code == 429 or response.status_code >= 500:
+                try:
+                    retry_after = float(response.headers.get("retry-after", 2 ** attempt))
+                except ValueError:
+                    retry_after = 2 ** attempt
+                await asyncio.sleep(retry_after)
+                continue
+            if response.is_success:
+                return True
+            logger.error(f"Email API rejected request: {response.status_code} {response.text[:200]}")
+            return False
+        return False
+    
+    async def send_one(self, message: dict) -> bool:
+        return await self.post("/emails", self.payload(message))
+    
+    async def send_many(self, messages: List[dict]) -> List[dict]:
+        # Batches are fed to a fixed number of workers; the bucket keeps them within the API quota
+        batches: asyncio.Queue = asyncio.Queue()
+        for i in range(0, len(messages), self.batch_size):
+            batches.put_nowait(messages[i:i + self.batch_size])
+        sent = []
+        
+        async def worker():
+            while not batches.empty():
+                batch = batches.get_nowait()
+                if await self.post("/emails/batch", [self.payload(m) for m in batch]):
+                    sent.extend(batch)
+                else:
+                    logger.error(f"Failed to send a batch of {len(batch)} emails")
+        
+        await asyncio.gather(*(worker() for _ in range(min(self.workers, batches.qsize()))))
+        return sent
+
+email_dispatcher = EmailDispatcher(RESEND_API_URL, RESEND_API_KEY, SENDER_EMAIL, EMAIL_WORKERS, EMAIL_BATCH_SIZE, EMAIL_RATE_PER_SECOND)
+
+async def send_email_async(to_email: str, subject: str, html_content: str, text_content: Optional[str] = None) -> bool:
+    if not email_dispatcher.configured:
         logger.warning("Resend API key not configured, skipping email")
         return False
     
-    try:
-        params = {
-            "from": SENDER_EMAIL,
-            "to": [to_email],
-            "subject": subject,
-            "html": html_content
-        }
-        await asyncio.to_thread(resend.Emails.send, params)
+    if await email_dispatcher.send_one({"to": to_email, "subject": subject, "html": html_content, "text": text_content}):
         logger.info(f"Email sent to {to_email}: {subject}")
         return True
-    except Exception as e:
-        logger.error(f"Failed to send email to {to_email}: {e}")
-        return False
+    logger.error(f"Failed to send email to {to_email}")
+    return False
+
+async def deliver_emails(messages: List[dict]) -> List[dict]:
+    # messages: {"to", "subject", "html", "user_id", "email_type"}; sent ones are logged with one insert_many
+    if not messages:
+        return []
+    if not email_dispatcher.configured:
+        logger.warning(f"Resend API key not configured, skipping {len(messages)} emails")
+        return []
+    
+    sent = await email_dispatcher.send_many(messages)
+    if sent:
+        sent_at = datetime.now(timezone.utc).isoformat()
+        await db.email_logs.insert_many([
+            {"user_id": m["user_id"], "email_type": m["email_type"], "sent_at": sent_at} for m in sent
+        ], ordered=False)
+    logger.info(f"Sent {len(sent)} of {len(messages)} emails")
+    return sent
+
+# Email outbox - each message's _id is its (user, type, day) key, so the unique _id index makes
+# enqueueing the same email twice a no-op; a leasing worker delivers and retries with backoff
+EMAIL_OUTBOX_LEASE_SECONDS = 120
+EMAIL_OUTBOX_MAX_ATTEMPTS = 8
+EMAIL_OUTBOX_POLL_SECONDS = 30
+EMAIL_OUTBOX_RETENTION_DAYS = 30
+email_outbox_signal = asyncio.Event()
+
+def outbox_key(user_id: str, email_type: str, day: str) -> str:
+    return f"{user_id}:{email_type}:{day}"
+
+async def enqueue_emails(messages: List[dict]) -> int:
+    # messages: {"to", "subject", "html", "text", "user_id", "email_type", "day"}
+    if not messages:
+        return 0
+    now = datetime.now(timezone.utc)
+    operations = [
+        UpdateOne(
+            {"_id": outbox_key(m["user_id"], m["email_type"], m["day"])},
+            {"$setOnInsert": {
+                "user_id": m["user_id"],
+                "email_type": m["email_type"],
+                "day": m["day"],
+                "to": m["to"],
+                "subject": m["subject"],
+                "html": m["html"],
+                "text": m.get("text"),
+                "status": "pending",
+                "attempts": 0,
+                "created_at": now.isoformat(),
+                "next_attempt_at": now.isoformat(),
+                "expires_at": now + timedelta(days=EMAIL_OUTBOX_RETENTION_DAYS)
+            }},
+            upsert=True
+        )
+        for m in messages
+    ]
+    try:
+        enqueued = (await db.email_outbox.bulk_write(operations, ordered=False)).upserted_count
+    except BulkWriteError as e:
+        # Concurrent producers upserting the same key: the loser hits the unique _id and is skipped
+        if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+            raise
+        enqueued = e.details.get("nUpserted", 0)
+    if enqueued:
+        email_outbox_signal.set()
+    return enqueued
+
+async def claim_outbox_email() -> Optional[dict]:
+    now = datetime.now(timezone.utc)
+    return await db.email_outbox.find_one_and_update(
+        {"$or": [
+            {"status": "pending", "next_attempt_at": {"$lte": now.isoformat()}},
+            {"status": "sending", "lease_until": {"$lt": now.isoformat()}}
+        ]},
+        {
+            "$set": {"status": "sending", "lease_until": (now + timedelta(seconds=EMAIL_OUTBOX_LEASE_SECONDS)).isoformat()},
+            "$inc": {"attempts": 1}
+        },
+        sort=[("next_attempt_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+async def drain_email_outbox() -> int:
+    if not email_dispatcher.configured:
+        return 0
+    delivered = 0
+    batch_limit = email_dispatcher.batch_size * email_dispatcher.workers
+    while True:
+        claimed = []
+        while len(claimed) < batch_limit:
+            message = await claim_outbox_email()
+            if not message:
+                break
+            claimed.append(message)
+        if not claimed:
+            return delivered
+        
+        sent_ids = {m["_id"] for m in await deliver_emails(claimed)}
+        now = datetime.now(timezone.utc)
+        if sent_ids:
+            await db.email_outbox.update_many(
+                {"_id": {"$in": list(sent_ids)}},
+                {"$set": {"status": "sent", "sent_at": now.isoformat()}, "$unset": {"lease_until": ""}}
+            )
+        failed = [m for m in claimed if m["_id"] not in sent_ids]
+        if failed:
+            await db.email_outbox.bulk_write([
+                UpdateOne({"_id": m["_id"]}, {
+                    "$set": {
+                        "status": "failed" if m["attempts"] >= EMAIL_OUTBOX_MAX_ATTEMPTS else "pending",
+                        "next_attempt_at": (now + timedelta(seconds=min(3600, 30 * 2 ** m["attempts"]))).isoformat(),
+                        "last_error": "delivery failed"
+                    },
+                    "$unset": {"lease_until": ""}
+                })
+                for m in failed
+            ], ordered=False)
+        delivered += len(sent_ids)
+        if len(claimed) < batch_limit:
+            return delivered
+
+async def email_outbox_worker():
+    while True:
+        try:
+            await drain_email_outbox()
+        except Exception as e:
+            logger.error(f"Email outbox worker error: {e}")
+        # Woken by producers; the timeout picks up retries and messages enqueued by other workers
+        try:
+            await asyncio.wait_for(email_outbox_signal.wait(), timeout=EMAIL_OUTBOX_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        email_outbox_signal.clear()
 
 # Notification Settings Endpoints
+# Each settings row carries next_reminder_at (UTC) and reminder_date (the user's local day it belongs to)
+REMINDER_DISPATCH_INTERVAL_SECONDS = int(os.environ.get('REMINDER_DISPATCH_INTERVAL_SECONDS', '60'))
+REMINDER_DISPATCH_BATCH = 500
+# Reminders found later than this (e.g. after downtime) are skipped and rescheduled instead of sent
+REMINDER_MAX_LATENESS_MINUTES = 120
+
+def parse_reminder_time(reminder_time: str) -> dt_time:
+    try:
+        return datetime.strptime(reminder_time, "%H:%M").time()
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid reminder time: {reminder_time}")
+
+def reminder_schedule(reminder_time: str, tz_name: str, after: datetime) -> dict:
+    # The wall-clock time is combined with each local date, so across DST the UTC instant moves and the local hour stays
+    at = parse_reminder_time(reminder_time)
+    zone = parse_timezone(tz_name)
+    local_day = after.astimezone(zone).date()
+    for offset in range(3):
+        day = local_day + timedelta(days=offset)
+        fire_at = datetime.combine(day, at, tzinfo=zone).astimezone(timezone.utc)
+        if fire_at > after:
+            return {"next_reminder_at": fire_at, "reminder_date": day.isoformat()}
+    raise ValueError(f"No reminder time after {after}")
+
+def reminder_schedule_or_default(ns: dict, after: datetime) -> dict:
+    try:
+        return reminder_schedule(ns.get("reminder_time", "20:00"), ns.get("timezone") or DEFAULT_TIMEZONE, after)
+    except ValueError:
+        return reminder_schedule("20:00", DEFAULT_TIMEZONE, after)
+
+async def backfill_reminder_schedule(only_missing: bool = True) -> int:
+    query = {"next_reminder_at": {"$exists": False}} if only_missing else {}
+    now = datetime.now(timezone.utc)
+    updated = 0
+    batch = []
+    async for ns in db.notification_settings.find(query, {"_id": 1, "reminder_time": 1, "timezone": 1}):
+        batch.append(UpdateOne({"_id": ns["_id"]}, {
+            "$set": reminder_schedule_or_default(ns, now),
+            "$unset": {"reminder_hour": ""}
+        }))
+        if len(batch) >= USER_SEARCH_BACKFILL_BATCH:
+            updated += (await db.notification_settings.bulk_write(batch, ordered=False)).modified_count
+            batch = []
+    if batch:
+        updated += (await db.notification_settings.bulk_write(batch, ordered=False)).modified_count
+    return updated
+
 @api_router.get("/settings/notifications")
 async def get_notification_settings(request: Request):
     user = await get_current_user(request)
-    settings = await db.notification_settings.find_one({"user_id": user["user_id"]}, {"_id": 0})
+    settings = await db.notification_settings.find_one(
+        {"user_id": user["user_id"]}, {"_id": 0, "next_reminder_at": 0, "reminder_date": 0}
+    )
     
     if not settings:
         settings = {
@@ -1021,173 +2744,177 @@ async def get_notification_settings(request: Request):
             "reminder_time": "20:00",
             "trial_warnings": True
         }
+    settings["timezone"] = user.get("timezone") or DEFAULT_TIMEZONE
     
     return settings
 
 @api_router.post("/settings/notifications")
 async def update_notification_settings(settings: NotificationSettings, request: Request):
     user = await get_current_user(request)
+    tz_name = settings.timezone or user.get("timezone") or DEFAULT_TIMEZONE
+    try:
+        parse_timezone(tz_name)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Nepoznata vremenska zona")
+    try:
+        schedule = reminder_schedule(settings.reminder_time, tz_name, datetime.now(timezone.utc))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Vreme podsetnika mora biti u formatu HH:MM")
     
+    if tz_name != user.get("timezone"):
+        await db.users.update_one({"user_id": user["user_id"]}, {"$set": {"timezone": tz_name}})
     await db.notification_settings.update_one(
         {"user_id": user["user_id"]},
         {"$set": {
             "user_id": user["user_id"],
             "email_reminders": settings.email_reminders,
             "reminder_time": settings.reminder_time,
+            "timezone": tz_name,
+            **schedule,
             "trial_warnings": settings.trial_warnings,
             "updated_at": datetime.now(timezone.utc).isoformat()
         }},
         upsert=True
     )
     
-    return {"message": "Podešavanja sačuvana", "settings": settings.model_dump()}
+    return {"message": "Podešavanja sačuvana", "settings": {**settings.model_dump(), "timezone": tz_name}}
+
+async def dispatch_due_reminders() -> int:
+    now = datetime.now(timezone.utc)
+    queued = 0
+    while True:
+        # Due rows come off the (email_reminders, next_reminder_at) index; the user's local day is
+        # anti-joined against moods and the email joined from users in the same pass
+        due = await db.notification_settings.aggregate([
+            {"$match": {"email_reminders": True, "next_reminder_at": {"$lte": now}}},
+            {"$sort": {"next_reminder_at": 1}},
+            {"$limit": REMINDER_DISPATCH_BATCH},
+            {"$lookup": {
+                "from": "moods",
+                "localField": "user_id",
+                "foreignField": "user_id",
+                "let": {"day": "$reminder_date"},
+                "pipeline": [{"$match": {"$expr": {"$eq": ["$date", "$$day"]}}}, {"$limit": 1}, {"$project": {"_id": 1}}],
+                "as": "logged"
+            }},
+            {"$lookup": {
+                "from": "users",
+                "localField": "user_id",
+                "foreignField": "user_id",
+                "pipeline": [{"$project": {"_id": 0, "name": 1, "email": 1}}],
+                "as": "user"
+            }},
+            {"$project": {
+                "user_id": 1, "reminder_time": 1, "timezone": 1, "next_reminder_at": 1, "reminder_date": 1,
+                "logged": {"$gt": [{"$size": "$logged"}, 0]},
+                "user": {"$first": "$user"}
+            }}
+        ]).to_list(None)
+        if not due:
+            return queued
+        
+        # Advance before sending so a crash mid-batch can't send the same day's reminder twice
+        await db.notification_settings.bulk_write([
+            UpdateOne({"_id": r["_id"]}, {"$set": reminder_schedule_or_default(r, now)}) for r in due
+        ], ordered=False)
+        
+        cutoff = now - timedelta(minutes=REMINDER_MAX_LATENESS_MINUTES)
+        messages = []
+        for r in due:
+            user = r.get("user") or {}
+            if r["logged"] or not user.get("email") or as_utc_datetime(r["next_reminder_at"]) < cutoff:
+                continue
+            messages.append({
+                "to": user["email"],
+                **email_templates.render("mood_reminder", {"user_name": user.get("name") or "korisniče"}),
+                "user_id": r["user_id"], "email_type": "mood_reminder", "day": r["reminder_date"]
+            })
+        queued += await enqueue_emails(messages)
 
-# Send daily mood reminders (called by cron/scheduler)
+# Send due mood reminders (also run by the scheduler every REMINDER_DISPATCH_INTERVAL_SECONDS)
 @api_router.post("/admin/send-reminders")
 async def send_daily_reminders(request: Request):
     await require_admin(request)
-    
+    queued = await dispatch_due_reminders()
+    return {"message": f"Zakazano {queued} podsetnika za slanje"}
+
+# Trial lifecycle - one indexed range scan over expires_at queues the warning/expired emails,
+# then trials past expires_at are flipped to "expired" so they stop counting as active
+TRIAL_LIFECYCLE_INTERVAL_SECONDS = int(os.environ.get('TRIAL_LIFECYCLE_INTERVAL_SECONDS', '3600'))
+TRIAL_EXPIRE_BATCH = 1000
+
+async def expire_trials(now: datetime) -> int:
+    query = {"status": "active", "is_trial": True, "expires_at": {"$lt": now}}
+    expired = 0
+    while True:
+        subs = await db.subscriptions.find(query, {"_id": 1, "user_id": 1}).limit(TRIAL_EXPIRE_BATCH).to_list(None)
+        if not subs:
+            return expired
+        user_ids = [sub["user_id"] for sub in subs]
+        # The expires_at guard keeps a trial that was upgraded in the meantime active
+        result = await db.subscriptions.update_many(
+            {**query, "_id": {"$in": [sub["_id"] for sub in subs]}},
+            {"$set": {"status": "expired", "updated_at": now.isoformat()}}
+        )
+        await db.users.update_many(
+            {"user_id": {"$in": user_ids}, "subscription_status": "trial", "subscription_expires_at": {"$lt": now}},
+            {"$set": user_subscription_fields(None)}
+        )
+        invalidate_entitlement(*user_ids)
+        expired += result.modified_count
+
+async def run_trial_lifecycle() -> dict:
     now = datetime.now(timezone.utc)
-    today = now.strftime("%Y-%m-%d")
-    current_hour = now.strftime("%H:00")
-    
-    # Find users who have reminders enabled for this hour and haven't logged mood today
-    users_with_reminders = await db.notification_settings.find(
-        {"email_reminders": True},
-        {"_id": 0}
-    ).to_list(10000)
-    
-    sent_count = 0
-    for ns in users_with_reminders:
-        # Check if it's time for this user's reminder (within the hour)
-        if ns.get("reminder_time", "20:00")[:2] + ":00" != current_hour:
-            continue
-        
-        user_id = ns["user_id"]
-        
-        # Check if user already logged mood today
-        existing_mood = await db.moods.find_one({"user_id": user_id, "date": today}, {"_id": 0})
-        if existing_mood:
-            continue
-        
-        # Get user info
-        user = await db.users.find_one({"user_id": user_id}, {"_id": 0})
+    subs = db.subscriptions.aggregate([
+        {"$match": {
+            "status": "active",
+            "is_trial": True,
+            "expires_at": {"$gte": now - timedelta(hours=24), "$lt": now + timedelta(days=3)}
+        }},
+        {"$lookup": {"from": "notification_settings", "localField": "user_id", "foreignField": "user_id", "as": "settings"}},
+        {"$lookup": {"from": "users", "localField": "user_id", "foreignField": "user_id", "as": "user"}},
+        {"$project": {"_id": 0, "user_id": 1, "expires_at": 1, "settings.trial_warnings": 1, "user.name": 1, "user.email": 1}}
+    ])
+    
+    messages = []
+    warnings = 0
+    async for sub in subs:
+        user = sub["user"][0] if sub["user"] else None
         if not user or not user.get("email"):
             continue
-        
-        # Send reminder
-        subject, html = get_mood_reminder_email(user.get("name", "korisniče"))
-        if await send_email_async(user["email"], subject, html):
-            sent_count += 1
-            # Log the sent email
-            await db.email_logs.insert_one({
-                "user_id": user_id,
-                "email_type": "mood_reminder",
-                "sent_at": now.isoformat()
-            })
-    
-    return {"message": f"Poslato {sent_count} podsetnika"}
+        expires_at = as_utc_datetime(sub["expires_at"])
+        recipient = {"user_name": user.get("name", "korisniče")}
+        if expires_at < now:
+            email = email_templates.render("trial_expired", recipient)
+            email_type = "trial_expired"
+        else:
+            # Send warning at 2 days and 1 day before expiry
+            days_left = (expires_at - now).days
+            if days_left not in [1, 2]:
+                continue
+            if sub["settings"] and not sub["settings"][0].get("trial_warnings", True):
+                continue
+            email = email_templates.render("trial_warning", recipient, days_left=days_left)
+            email_type = f"trial_warning_{days_left}"
+            warnings += 1
+        # Keyed by the trial's expiry date, so each email goes out once however often this runs
+        messages.append({
+            "to": user["email"], **email,
+            "user_id": sub["user_id"], "email_type": email_type, "day": expires_at.strftime("%Y-%m-%d")
+        })
+    queued = await enqueue_emails(messages)
+    expired = await expire_trials(now)
+    return {"queued": queued, "warnings": warnings, "expired": expired}
 
-# Send trial warning emails (called by cron/scheduler)
+# Send trial warning emails (also run by the scheduler every TRIAL_LIFECYCLE_INTERVAL_SECONDS)
 @api_router.post("/admin/send-trial-warnings")
 async def send_trial_warnings(request: Request):
     await require_admin(request)
-    
-    now = datetime.now(timezone.utc)
-    
-    # Find users on trial
-    trial_subs = await db.subscriptions.find(
-        {"is_trial": True, "status": "active"},
-        {"_id": 0}
-    ).to_list(10000)
-    
-    sent_count = 0
-    for sub in trial_subs:
-        user_id = sub["user_id"]
-        
-        # Check notification settings
-        ns = await db.notification_settings.find_one({"user_id": user_id}, {"_id": 0})
-        if ns and not ns.get("trial_warnings", True):
-            continue
-        
-        # Calculate days left
-        expires_at = sub.get("expires_at", "")
-        if isinstance(expires_at, str):
-            expires_at = datetime.fromisoformat(expires_at)
-        if expires_at.tzinfo is None:
-            expires_at = expires_at.replace(tzinfo=timezone.utc)
-        
-        days_left = (expires_at - now).days
-        
-        # Send warning at 2 days and 1 day before expiry
-        if days_left not in [1, 2]:
-            continue
-        
-        # Check if we already sent this warning
-        existing_log = await db.email_logs.find_one({
-            "user_id": user_id,
-            "email_type": f"trial_warning_{days_left}",
-            "sent_at": {"$gte": (now - timedelta(hours=20)).isoformat()}
-        }, {"_id": 0})
-        if existing_log:
-            continue
-        
-        # Get user info
-        user = await db.users.find_one({"user_id": user_id}, {"_id": 0})
-        if not user or not user.get("email"):
-            continue
-        
-        # Send warning
-        subject, html = get_trial_warning_email(user.get("name", "korisniče"), days_left)
-        if await send_email_async(user["email"], subject, html):
-            sent_count += 1
-            await db.email_logs.insert_one({
-                "user_id": user_id,
-                "email_type": f"trial_warning_{days_left}",
-                "sent_at": now.isoformat()
-            })
-    
-    # Also check for expired trials
-    expired_subs = await db.subscriptions.find(
-        {"is_trial": True, "status": "active"},
-        {"_id": 0}
-    ).to_list(10000)
-    
-    for sub in expired_subs:
-        expires_at = sub.get("expires_at", "")
-        if isinstance(expires_at, str):
-            expires_at = datetime.fromisoformat(expires_at)
-        if expires_at.tzinfo is None:
-            expires_at = expires_at.replace(tzinfo=timezone.utc)
-        
-        # Check if just expired (within last 24 hours)
-        if not (timedelta(hours=-24) < (expires_at - now) < timedelta(hours=0)):
-            continue
-        
-        user_id = sub["user_id"]
-        
-        # Check if we already sent expiry email
-        existing_log = await db.email_logs.find_one({
-            "user_id": user_id,
-            "email_type": "trial_expired",
-            "sent_at": {"$gte": (now - timedelta(days=1)).isoformat()}
-        }, {"_id": 0})
-        if existing_log:
-            continue
-        
-        user = await db.users.find_one({"user_id": user_id}, {"_id": 0})
-        if not user or not user.get("email"):
-            continue
-        
-        subject, html = get_trial_expired_email(user.get("name", "korisniče"))
-        if await send_email_async(user["email"], subject, html):
-            await db.email_logs.insert_one({
-                "user_id": user_id,
-                "email_type": "trial_expired",
-                "sent_at": now.isoformat()
-            })
-    
-    return {"message": f"Poslato {sent_count} upozorenja za trial"}
+    result = await run_trial_lifecycle()
+    return {
+        "message": f"Zakazano {result['queued']} emailova za trial, isteklo {result['expired']} trial pretplata",
+        **result
+    }
 
 # Test email endpoint (admin only)
 @api_router.post("/admin/test-email")
@@ -1200,21 +2927,164 @@ async def test_email(request: Request):
     if not to_email:
         raise HTTPException(status_code=400, detail="Email je obavezan")
     
+    recipient = {"user_name": "Test Korisnik"}
     if email_type == "reminder":
-        subject, html = get_mood_reminder_email("Test Korisnik")
+        email = email_templates.render("mood_reminder", recipient)
     elif email_type == "trial_warning":
-        subject, html = get_trial_warning_email("Test Korisnik", 2)
+        email = email_templates.render("trial_warning", recipient, days_left=2)
     elif email_type == "trial_expired":
-        subject, html = get_trial_expired_email("Test Korisnik")
+        email = email_templates.render("trial_expired", recipient)
     else:
         raise HTTPException(status_code=400, detail="Nepoznat tip emaila")
     
-    success = await send_email_async(to_email, subject, html)
+    success = await send_email_async(to_email, email["subject"], email["html"], email["text"])
     if success:
         return {"message": f"Test email poslat na {to_email}"}
     else:
         raise HTTPException(status_code=500, detail="Greška pri slanju emaila. Proverite RESEND_API_KEY.")
 
+# Job scheduler - every replica runs the same schedule, a lease on the job's scheduler_jobs row
+# lets only one of them run each job, and every run is recorded in job_runs
+SCHEDULER_TICK_SECONDS = int(os.environ.get('SCHEDULER_TICK_SECONDS', '15'))
+SCHEDULER_LEASE_SECONDS = 300
+MAINTENANCE_INTERVAL_SECONDS = int(os.environ.get('MAINTENANCE_INTERVAL_SECONDS', '86400'))
+JOB_RUNS_RETENTION_DAYS = 30
+
+class JobScheduler:
+    def __init__(self, owner: str, tick_seconds: float, lease_seconds: float):
+        self.owner = owner
+        self.tick_seconds = tick_seconds
+        self.lease_seconds = lease_seconds
+        self.jobs: Dict[str, tuple] = {}
+        self.running: Dict[str, asyncio.Task] = {}
+        self._wake = asyncio.Event()
+    
+    def add(self, name: str, interval_seconds: float, func):
+        # An interval of 0 turns the job off
+        if interval_seconds > 0:
+            self.jobs[name] = (interval_seconds, func)
+    
+    async def register(self):
+        # New jobs are due right away; existing rows keep their schedule across restarts
+        now = datetime.now(timezone.utc).isoformat()
+        for name, (interval, _) in self.jobs.items():
+            try:
+                await db.scheduler_jobs.update_one(
+                    {"_id": name},
+                    {"$set": {"interval_seconds": interval}, "$setOnInsert": {"next_run_at": now, "lease_until": now, "owner": None}},
+                    upsert=True
+                )
+            except DuplicateKeyError:
+                pass
+    
+    async def claim(self, name: str) -> Optional[dict]:
+        now = datetime.now(timezone.utc)
+        return await db.scheduler_jobs.find_one_and_update(
+            {"_id": name, "next_run_at": {"$lte": now.isoformat()}, "lease_until": {"$lt": now.isoformat()}},
+            {"$set": {"owner": self.owner, "lease_until": (now + timedelta(seconds=self.lease_seconds)).isoformat()}},
+            return_document=ReturnDocument.AFTER
+        )
+    
+    async def heartbeat(self, name: str):
+        # Long runs keep extending the lease; a replica that lost it only logs, the run record shows the overlap
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            lease_until = datetime.now(timezone.utc) + timedelta(seconds=self.lease_seconds)
+            result = await db.scheduler_jobs.update_one(
+                {"_id": name, "owner": self.owner}, {"$set": {"lease_until": lease_until.isoformat()}}
+            )
+            if not result.matched_count:
+                logger.warning(f"Scheduled job {name} lost its lease")
+    
+    async def run_job(self, name: str) -> dict:
+        interval, func = self.jobs[name]
+        started = datetime.now(timezone.utc)
+        started_monotonic = time.monotonic()
+        run = {"run_id": f"run_{uuid.uuid4().hex[:12]}", "job": name, "owner": self.owner, "started_at": started.isoformat()}
+        heartbeat = asyncio.create_task(self.heartbeat(name))
+        try:
+            run["result"] = await func()
+            run["status"] = "ok"
+        except Exception as e:
+            logger.error(f"Scheduled job {name} failed: {e}")
+            run.update({"status": "error", "error": str(e)})
+        finally:
+            heartbeat.cancel()
+        finished = datetime.now(timezone.utc)
+        run.update({"finished_at": finished.isoformat(), "duration_ms": round((time.monotonic() - started_monotonic) * 1000)})
+        # Cadence counts from the start of a run, so slow runs don't push the schedule back
+        next_run_at = max(started + timedelta(seconds=interval), finished)
+        await db.scheduler_jobs.update_one({"_id": name, "owner": self.owner}, {"$set": {
+            "next_run_at": next_run_at.isoformat(),
+            "lease_until": finished.isoformat(),
+            "owner": None,
+            "last_run": {k: run.get(k) for k in ("run_id", "status", "started_at", "duration_ms", "error")}
+        }})
+        await db.job_runs.insert_one({**run, "expires_at": finished + timedelta(days=JOB_RUNS_RETENTION_DAYS)})
+        run.pop("_id", None)
+        return run
+    
+    async def tick(self):
+        for name in self.jobs:
+            if name in self.running:
+                continue
+            try:
+                if await self.claim(name):
+                    self.running[name] = spawn_background(self.run_job(name))
+                    self.running[name].add_done_callback(lambda _, name=name: self.running.pop(name, None))
+            except Exception as e:
+                logger.error(f"Scheduler claim error for {name}: {e}")
+    
+    async def run(self):
+        await self.register()
+        while True:
+            await self.tick()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.tick_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+    
+    async def trigger(self, name: str) -> bool:
+        result = await db.scheduler_jobs.update_one(
+            {"_id": name}, {"$set": {"next_run_at": datetime.now(timezone.utc).isoformat()}}
+        )
+        self._wake.set()
+        return bool(result.matched_count)
+
+async def run_maintenance() -> dict:
+    # Rows written before these fields existed; each pass is a no-op once everything is backfilled
+    return {
+        "subscription_dates": await backfill_subscription_dates(),
+        "users_search_terms": await backfill_user_search_terms(),
+        "users_activity": await backfill_user_activity(),
+        "reminder_schedule": await backfill_reminder_schedule()
+    }
+
+scheduler = JobScheduler(f"{socket.gethostname()}:{os.getpid()}", SCHEDULER_TICK_SECONDS, SCHEDULER_LEASE_SECONDS)
+scheduler.add("maintenance", MAINTENANCE_INTERVAL_SECONDS, run_maintenance)
+scheduler.add("reminders", REMINDER_DISPATCH_INTERVAL_SECONDS, dispatch_due_reminders)
+scheduler.add("trial_lifecycle", TRIAL_LIFECYCLE_INTERVAL_SECONDS, run_trial_lifecycle)
+scheduler.add("payment_reconciliation", RECONCILE_INTERVAL_SECONDS, reconcile_pending_payments)
+scheduler.add("daily_activity", DAILY_ACTIVITY_INTERVAL_SECONDS, refresh_daily_activity)
+
+@api_router.get("/admin/scheduler")
+async def admin_scheduler(request: Request, limit: int = 50):
+    await require_admin(request)
+    jobs = await db.scheduler_jobs.find({"_id": {"$in": list(scheduler.jobs)}}).to_list(None)
+    runs = await db.job_runs.find({}, {"_id": 0, "expires_at": 0}).sort("started_at", -1).limit(limit).to_list(limit)
+    return {
+        "jobs": [{"name": job.pop("_id"), **job} for job in jobs],
+        "runs": runs
+    }
+
+@api_router.post("/admin/scheduler/{name}/run")
+async def admin_run_scheduled_job(name: str, request: Request):
+    await require_admin(request)
+    if name not in scheduler.jobs or not await scheduler.trigger(name):
+        raise HTTPException(status_code=404, detail="Posao nije pronađen")
+    return {"message": f"Posao {name} je zakazan za pokretanje"}
+
 @api_router.get("/")
 async def root():
     return {"message": "Umiri.me API"}
@@ -1229,6 +3099,79 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def ensure_indexes():
+    # create_mood upserts one mood per user and day and counts it only when the upsert inserted,
+    # so the (user_id, date) index must be unique; the old non-unique one has the same name
+    mood_key = [("user_id", 1), ("date", -1)]
+    if not (await db.moods.index_information()).get("user_id_1_date_-1", {}).get("unique"):
+        try:
+            await db.moods.drop_index(mood_key)
+        except OperationFailure:
+            pass
+        try:
+            await db.moods.create_index(mood_key, unique=True)
+        except OperationFailure as e:
+            logger.error(f"Unique moods (user_id, date) index not created, resolve duplicate moods first: {e}")
+            await db.moods.create_index(mood_key)
+    await db.moods.create_index([("date", 1), ("user_id", 1)])
+    await db.activity_days.create_index([("date", 1), ("user_id", 1)])
+    await db.activity_days.create_index([("week", 1), ("cohort", 1), ("user_id", 1)])
+    await db.subscriptions.create_index([("user_id", 1), ("status", 1)])
+    # Every subscription write upserts by user_id; the unique index keeps concurrent ones to one row
+    try:
+        await db.subscriptions.create_index("user_id", unique=True)
+    except OperationFailure as e:
+        logger.error(f"Unique subscriptions.user_id index not created, resolve duplicate subscriptions first: {e}")
+    await db.subscriptions.create_index([("status", 1), ("is_trial", 1), ("expires_at", 1)])
+    await db.notification_settings.create_index("user_id")
+    await db.users.create_index("search_terms")
+    await db.admin_jobs.create_index("job_id", unique=True)
+    await db.users.create_index("user_id")
+    await db.notification_settings.create_index([("email_reminders", 1), ("next_reminder_at", 1)])
+    # Superseded by next_reminder_at
+    if "email_reminders_1_reminder_hour_1_user_id_1" in await db.notification_settings.index_information():
+        await db.notification_settings.drop_index("email_reminders_1_reminder_hour_1_user_id_1")
+    await db.users.create_index([("subscription_status", 1), ("last_mood_date", -1), ("user_id", -1)])
+    await db.users.create_index([("subscription_status", 1), ("mood_count", -1), ("user_id", -1)])
+    # Superseded by the indexes above, which also cover the user_id tie-breaker
+    user_indexes = await db.users.index_information()
+    for name in ("subscription_status_1_last_mood_date_-1", "subscription_status_1_mood_count_-1"):
+        if name in user_indexes:
+            await db.users.drop_index(name)
+    await db.users.create_index([("last_mood_date", -1), ("user_id", -1)])
+    await db.users.create_index([("mood_count", -1), ("user_id", -1)])
+    await db.users.create_index([("created_at", -1), ("user_id", -1)])
+    await db.users.create_index([("name", 1), ("user_id", 1)])
+    await db.users.create_index([("email", 1), ("user_id", 1)])
+    await db.users.create_index([("subscription_expires_at", 1), ("user_id", 1)])
+    await db.ai_tips_usage.create_index("expires_at", expireAfterSeconds=0)
+    # Legacy per-tip usage rows have no counter and would never expire
+    await db.ai_tips_usage.delete_many({"count": {"$exists": False}})
+    await db.ai_tip_cache.create_index("expires_at", expireAfterSeconds=0)
+    await db.email_outbox.create_index([("status", 1), ("next_attempt_at", 1)])
+    await db.email_outbox.create_index("expires_at", expireAfterSeconds=0)
+    await db.payment_transactions.create_index("session_id", unique=True)
+    await db.payment_transactions.create_index([("payment_status", 1), ("created_at", 1)])
+    await db.payment_transactions.create_index([("user_id", 1), ("plan_id", 1), ("origin_url", 1), ("created_at", -1)])
+    await db.stripe_events.create_index("event_id", unique=True)
+    await db.stripe_events.create_index([("status", 1), ("next_attempt_at", 1)])
+    await db.job_runs.create_index([("job", 1), ("started_at", -1)])
+    await db.job_runs.create_index("started_at")
+    await db.job_runs.create_index("expires_at", expireAfterSeconds=0)
+
+@app.on_event("startup")
+async def start_background_workers():
+    if not STRIPE_WEBHOOK_URL:
+        logger.warning("STRIPE_WEBHOOK_URL is not set")
+    get_stripe_checkout()
+    spawn_background(stripe_event_consumer())
+    spawn_background(email_outbox_worker())
+    spawn_background(scheduler.run())
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in list(background_tasks):
+        task.cancel()
+    await email_dispatcher.close()
     client.close()
@@ -0,0 +1,188 @@
+"""
+Shared fixtures for in-process tests that import server.py directly.
+They run against the MongoDB configured in backend/.env (MONGO_URL, DB_NAME)
+and only create users/sessions with a "test-inproc-" prefix, which are removed afterwards.
+"""
+import asyncio
+import json
+import sys
+import uuid
+from datetime import datetime, timezone, timedelta
+from pathlib import Path
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from pymongo import monitoring
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+
+class CommandCounter(monitoring.CommandListener):
+    """Records every command sent to MongoDB; registered before server.py creates its client"""
+
+    def __init__(self):
+        self.commands = []
+
+    def started(self, event):
+        self.commands.append(event.command_name)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+command_counter = CommandCounter()
+monitoring.register(command_counter)
+
+
+class LocalStripeCheckout:
+    """Local stand-in for StripeCheckout with per-session (status, payment_status) results"""
+
+    def __init__(self, statuses=None, default=("complete", "paid"), delay=0.01, failing=()):
+        self.statuses = dict(statuses or {})
+        self.default = default
+        self.delay = delay
+        self.failing = set(failing)
+        self.checked = []
+
+    async def get_checkout_status(self, session_id):
+        self.checked.append(session_id)
+        await asyncio.sleep(self.delay)
+        if session_id in self.failing:
+            raise RuntimeError("Stripe unavailable")
+        status, payment_status = self.statuses.get(session_id, self.default)
+        return SimpleNamespace(status=status, payment_status=payment_status, amount_total=50000, currency="rsd", metadata={})
+
+    async def handle_webhook(self, body, signature):
+        # The test body is just the session id
+        await asyncio.sleep(self.delay)
+        session_id = body.decode()
+        status, payment_status = self.statuses.get(session_id, self.default)
+        return SimpleNamespace(
+            event_id=f"evt_{uuid.uuid4().hex}", event_type="checkout.session.completed",
+            session_id=session_id, payment_status=payment_status, metadata={}
+        )
+
+
+@pytest.fixture
+def local_stripe():
+    return LocalStripeCheckout
+
+
+class LocalEmailApi:
+    """Local stand-in for the Resend HTTP API; records every recipient and can reject requests"""
+
+    def __init__(self):
+        self.sent = []
+        self.requests = []
+        self.status_code = 200
+
+    def handle(self, request):
+        body = json.loads(request.content)
+        self.requests.append((request.url.path, body))
+        if self.status_code != 200:
+            return httpx.Response(self.status_code, json={"message": "rejected"})
+        emails = body if isinstance(body, list) else [body]
+        self.sent.extend(to for email in emails for to in email["to"])
+        return httpx.Response(200, json={"data": [{"id": uuid.uuid4().hex} for _ in emails]})
+
+
+@pytest.fixture
+def email_api(server, monkeypatch):
+    api = LocalEmailApi()
+    dispatcher = server.EmailDispatcher("http://email.test", "re_test", "test@umiri.me", workers=4, batch_size=100, rate_per_second=1000)
+    dispatcher._client = httpx.AsyncClient(transport=httpx.MockTransport(api.handle), base_url="http://email.test")
+    monkeypatch.setattr(server, "email_dispatcher", dispatcher)
+    return api
+
+
+@pytest.fixture
+def make_transaction(server, run):
+    def factory(user_id, plan_id="monthly", payment_status="initiated", age=timedelta(0)):
+        session_id = f"cs_test_{uuid.uuid4().hex}"
+        run(server.db.payment_transactions.insert_one({
+            "transaction_id": f"txn_{uuid.uuid4().hex[:12]}",
+            "session_id": session_id,
+            "user_id": user_id,
+            "plan_id": plan_id,
+            "amount": server.PREMIUM_PLANS[plan_id]["amount"],
+            "currency": "rsd",
+            "payment_status": payment_status,
+            "status": "pending",
+            "created_at": (datetime.now(timezone.utc) - age).isoformat()
+        }))
+        return session_id
+    return factory
+
+
+@pytest.fixture(scope="session")
+def run():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop.run_until_complete
+    loop.close()
+
+
+@pytest.fixture(scope="session")
+def server(run):
+    import server as server_module
+    run(server_module.ensure_indexes())
+    return server_module
+
+
+@pytest.fixture
+def api(server, run):
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://test")
+    yield client
+    run(client.aclose())
+
+
+@pytest.fixture
+def db_commands():
+    command_counter.commands.clear()
+    return command_counter.commands
+
+
+@pytest.fixture
+def make_user(server, run):
+    created = []
+
+    def factory(email=None, name="Test Korisnik"):
+        user_id = f"test-inproc-{uuid.uuid4().hex[:12]}"
+        token = f"test_inproc_session_{uuid.uuid4().hex}"
+        now = datetime.now(timezone.utc)
+        email = email or f"{user_id}@example.com"
+        run(server.db.users.insert_one({
+            "user_id": user_id,
+            "email": email,
+            "name": name,
+            "picture": "",
+            "search_terms": server.user_search_terms(name, email),
+            "created_at": now.isoformat()
+        }))
+        run(server.db.user_sessions.insert_one({
+            "user_id": user_id,
+            "session_token": token,
+            "expires_at": (now + timedelta(days=1)).isoformat(),
+            "created_at": now.isoformat()
+        }))
+        created.append(user_id)
+        return user_id, {"Authorization": f"Bearer {token}"}
+
+    yield factory
+
+    async def cleanup():
+        for name in ("users", "user_sessions", "subscriptions", "payment_transactions", "moods"):
+            await server.db[name].delete_many({"user_id": {"$in": created}})
+    run(cleanup())
+
+
+@pytest.fixture
+def admin_headers(server, make_user, monkeypatch):
+    email = f"admin-{uuid.uuid4().hex[:8]}@example.com"
+    monkeypatch.setattr(server, "ADMIN_EMAILS", [email])
+    _, headers = make_user(email=email)
+    return headers
@@ -0,0 +1,63 @@
+"""
+Tests for POST /api/admin/grant-premium/bulk and /api/admin/revoke-premium/bulk
+Tests:
+- Explicit user_id lists are granted in chunks, unknown ids are skipped
+- Filters select users the same way as the admin listing
+- Progress is reported on the job and entitlement caches are invalidated
+"""
+import asyncio
+import uuid
+
+
+def wait_for_job(run, api, headers, job_id):
+    for _ in range(100):
+        response = run(api.get(f"/api/admin/jobs/{job_id}", headers=headers))
+        assert response.status_code == 200, response.text
+        job = response.json()
+        if job["status"] != "running":
+            return job
+        run(asyncio.sleep(0.02))
+    raise AssertionError("Bulk job did not finish")
+
+
+class TestBulkPremium:
+    def test_grant_by_ids_in_chunks(self, server, run, api, make_user, admin_headers, monkeypatch):
+        monkeypatch.setattr(server, "BULK_PREMIUM_CHUNK", 2)
+        user_ids = [make_user()[0] for _ in range(5)]
+        for user_id in user_ids:
+            run(server.is_premium(user_id))
+
+        response = run(api.post("/api/admin/grant-premium/bulk",
+                                json={"user_ids": user_ids + ["missing-user"], "days": 30}, headers=admin_headers))
+        assert response.status_code == 200, response.text
+        job = wait_for_job(run, api, admin_headers, response.json()["job_id"])
+
+        assert job["status"] == "completed"
+        assert job["total"] == 6
+        assert job["processed"] == 5
+        assert job["changed"] == 5
+        for user_id in user_ids:
+            assert run(server.is_premium(user_id)) is True
+            assert run(server.db.users.find_one({"user_id": user_id}))["subscription_status"] == "premium"
+        assert run(server.db.subscriptions.find_one({"user_id": "missing-user"})) is None
+
+    def test_revoke_by_filter(self, server, run, api, make_user, admin_headers):
+        batch = f"batch{uuid.uuid4().hex[:8]}"
+        user_ids = [make_user(email=f"{batch}-{i}@example.com")[0] for i in range(3)]
+        response = run(api.post("/api/admin/grant-premium/bulk", json={"search": batch}, headers=admin_headers))
+        wait_for_job(run, api, admin_headers, response.json()["job_id"])
+
+        response = run(api.post("/api/admin/revoke-premium/bulk",
+                                json={"search": batch, "filter": "status:premium"}, headers=admin_headers))
+        assert response.status_code == 200, response.text
+        assert response.json()["total"] == 3
+        job = wait_for_job(run, api, admin_headers, response.json()["job_id"])
+
+        assert job["changed"] == 3
+        for user_id in user_ids:
+            assert run(server.is_premium(user_id)) is False
+            assert run(server.db.users.find_one({"user_id": user_id}))["subscription_status"] == "inactive"
+
+    def test_requires_a_target(self, run, api, admin_headers):
+        response = run(api.post("/api/admin/grant-premium/bulk", json={"days": 30}, headers=admin_headers))
+        assert response.status_code == 400
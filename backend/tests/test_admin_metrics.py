@@ -0,0 +1,102 @@
+"""
+Tests for the daily activity rollups behind /api/admin/metrics
+Tests:
+- A rollup stores the day's counts, and the active users as one activity_days document each
+- A refresh rolls each day once, oldest first
+- DAU/WAU/MAU are computed from the rollups over sliding windows
+- Retention cohorts follow signup week users into later weeks
+"""
+import uuid
+from datetime import datetime, timezone, timedelta
+
+import pytest
+
+# A fixed, otherwise empty stretch of history (weeks starting on Mondays)
+WEEK_0 = datetime(2001, 1, 1, 12, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def history(server, run, make_user):
+    days = [WEEK_0 + timedelta(days=i) for i in range(14)]
+    run(server.db.daily_activity.delete_many({"_id": {"$gte": "2001-01-01", "$lte": "2001-01-31"}}))
+    run(server.db.moods.delete_many({"date": {"$gte": "2001-01-01", "$lte": "2001-01-31"}}))
+    user_a, _ = make_user()
+    user_b, _ = make_user()
+    run(server.db.users.update_many({"user_id": {"$in": [user_a, user_b]}}, {"$set": {"created_at": WEEK_0.isoformat()}}))
+    # user_a logs on the first day of both weeks, user_b only on the first day
+    moods = [(user_a, days[0]), (user_a, days[7]), (user_b, days[0])]
+    run(server.db.moods.insert_many([
+        {"mood_id": f"mood_{uuid.uuid4().hex[:12]}", "user_id": user_id, "mood_type": "miran", "score": 4,
+         "date": day.strftime("%Y-%m-%d"), "created_at": day.isoformat()}
+        for user_id, day in moods
+    ]))
+    for day in days:
+        run(server.rollup_daily_activity(day.strftime("%Y-%m-%d")))
+    yield user_a, user_b
+    run(server.db.daily_activity.delete_many({"_id": {"$gte": "2001-01-01", "$lte": "2001-01-31"}}))
+    run(server.db.activity_days.delete_many({"date": {"$gte": "2001-01-01", "$lte": "2001-01-31"}}))
+
+
+class TestDailyActivityRollup:
+    def test_rollup_document(self, server, run, history):
+        user_a, user_b = history
+        doc = run(server.db.daily_activity.find_one({"_id": "2001-01-01"}))
+        assert "active_users" not in doc and "signups" not in doc
+        assert (doc["active_count"], doc["mood_count"], doc["signup_count"]) == (2, 2, 2)
+        assert run(server.db.daily_activity.find_one({"_id": "2001-01-08"}))["mau"] == 2
+        days = run(server.db.activity_days.find({"date": "2001-01-01"}, {"_id": 0, "rolled_at": 0}).to_list(None))
+        assert sorted(days, key=lambda d: d["user_id"]) == [
+            {"user_id": user_id, "date": "2001-01-01", "week": "2001-01-01", "cohort": "2001-01-01"}
+            for user_id in sorted([user_a, user_b])
+        ]
+
+    def test_rollup_drops_deleted_moods(self, server, run, history):
+        user_a, _ = history
+        run(server.db.moods.delete_many({"user_id": user_a, "date": "2001-01-08"}))
+        run(server.rollup_daily_activity("2001-01-08"))
+        assert run(server.db.activity_days.count_documents({"date": "2001-01-08"})) == 0
+        assert run(server.db.daily_activity.find_one({"_id": "2001-01-08"}))["active_count"] == 0
+
+    def test_refresh_rolls_each_day_once(self, server, run, monkeypatch):
+        rolled = []
+
+        async def rollup(day):
+            rolled.append(day)
+        existing = [(datetime.now(timezone.utc) - timedelta(days=i)).strftime("%Y-%m-%d") for i in range(5)]
+        monkeypatch.setattr(server, "rollup_daily_activity", rollup)
+        monkeypatch.setattr(server, "DAILY_ACTIVITY_BACKFILL_DAYS", 5)
+        run(server.db.daily_activity.insert_many([{"_id": day} for day in existing]))
+        try:
+            run(server.refresh_daily_activity())
+            assert rolled == [existing[1], existing[0]]
+            rolled.clear()
+            run(server.db.daily_activity.delete_one({"_id": existing[3]}))
+            run(server.refresh_daily_activity())
+            assert rolled == existing[3::-1]
+        finally:
+            run(server.db.daily_activity.delete_many({"_id": {"$in": existing}}))
+
+    def test_active_series(self, run, api, admin_headers, history):
+        response = run(api.get("/api/admin/metrics/active", params={"days": 14, "end": "2001-01-14"}, headers=admin_headers))
+        assert response.status_code == 200, response.text
+        series = {point["date"]: point for point in response.json()["series"]}
+        assert len(series) == 14
+        assert series["2001-01-01"] == {"date": "2001-01-01", "dau": 2, "wau": 2, "mau": 2}
+        assert series["2001-01-07"]["wau"] == 2
+        assert series["2001-01-08"]["wau"] == 1
+        assert series["2001-01-08"]["mau"] == 2
+
+    def test_retention_cohorts(self, run, api, admin_headers, history):
+        response = run(api.get("/api/admin/metrics/retention", params={"weeks": 2, "end": "2001-01-08"}, headers=admin_headers))
+        assert response.status_code == 200, response.text
+        cohorts = response.json()["cohorts"]
+        assert cohorts[0]["week"] == "2001-01-01"
+        assert cohorts[0]["signups"] == 2
+        assert cohorts[0]["active"] == [2, 1]
+        assert cohorts[0]["retention"] == [1.0, 0.5]
+        assert cohorts[1]["signups"] == 0
+
+    def test_invalid_end_date(self, run, api, admin_headers):
+        for path in ("/api/admin/metrics/active", "/api/admin/metrics/retention"):
+            response = run(api.get(path, params={"end": "2026-13-45"}, headers=admin_headers))
+            assert response.status_code == 400, path
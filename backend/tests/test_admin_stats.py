@@ -0,0 +1,188 @@
+"""
+Tests for GET /api/admin/stats
+Tests:
+- Weekly active users and today's moods are counted per user, not per entry
+- The snapshot is served from cache within the TTL and recomputed after it
+- The live feed applies change events to its counters and falls back to polling
+- Reconnecting after a stream error recounts without replaying changes
+"""
+import asyncio
+import uuid
+from datetime import datetime, timezone, timedelta
+
+import pytest
+from pymongo.errors import OperationFailure
+
+
+@pytest.fixture
+def fresh_snapshot(server, monkeypatch):
+    monkeypatch.setattr(server, "admin_stats_snapshot", {"data": None, "computed_at": 0.0})
+
+
+def get_stats(run, api, headers):
+    response = run(api.get("/api/admin/stats", headers=headers))
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def add_moods(server, run, user_id, days):
+    now = datetime.now(timezone.utc)
+    run(server.db.moods.insert_many([
+        {"mood_id": f"mood_{uuid.uuid4().hex[:12]}", "user_id": user_id, "mood_type": "miran", "score": 4,
+         "date": (now - timedelta(days=day)).strftime("%Y-%m-%d"), "created_at": now.isoformat()}
+        for day in days
+    ]))
+
+
+class TestAdminStats:
+    def test_weekly_active_counts_users(self, server, run, api, make_user, admin_headers, fresh_snapshot):
+        before = get_stats(run, api, admin_headers)
+        server.admin_stats_snapshot["data"] = None
+
+        user_a, _ = make_user()
+        user_b, _ = make_user()
+        add_moods(server, run, user_a, [0, 1, 2])
+        add_moods(server, run, user_b, [3, 30])
+
+        after = get_stats(run, api, admin_headers)
+        assert after["weekly_active_users"] - before["weekly_active_users"] == 2
+        assert after["today_moods"] - before["today_moods"] == 1
+
+    def test_snapshot_is_cached(self, server, run, api, make_user, admin_headers, fresh_snapshot, monkeypatch):
+        first = get_stats(run, api, admin_headers)
+        user_id, _ = make_user()
+        add_moods(server, run, user_id, [0])
+        assert get_stats(run, api, admin_headers) == first
+
+        monkeypatch.setattr(server, "ADMIN_STATS_CACHE_SECONDS", 0)
+        run(server.admin_stats_refresh)
+        get_stats(run, api, admin_headers)
+        run(server.admin_stats_refresh)
+        assert get_stats(run, api, admin_headers)["today_moods"] == first["today_moods"] + 1
+
+
+class FakeChangeStream:
+    """Database-wide change stream over a shared event log; raises once when fail is set"""
+
+    def __init__(self, log, start):
+        self.log = log
+        self.position = start
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    @property
+    def resume_token(self):
+        return self.position - 1
+
+    async def try_next(self):
+        if self.log.fail:
+            self.log.fail = False
+            raise OperationFailure("connection reset", code=6)
+        if self.position < len(self.log.events):
+            self.position += 1
+            return self.log.events[self.position - 1]
+        await asyncio.sleep(0.01)
+        return None
+
+
+class ChangeLog:
+    def __init__(self):
+        self.events = []
+        self.fail = False
+        self.opens = 0
+
+    def watch(self, db, pipeline, resume_after=None, **kwargs):
+        self.opens += 1
+        # A resume token is the position of the last delivered event
+        return FakeChangeStream(self, resume_after + 1 if resume_after is not None else len(self.events))
+
+
+class TestAdminStatsFeed:
+    def test_change_events_update_counters(self, server, run):
+        feed = server.AdminStatsFeed(coalesce_seconds=0, poll_seconds=60)
+        run(feed.resync())
+        before = dict(feed.stats)
+
+        feed.apply({"ns": {"coll": "users"}, "operationType": "insert"})
+        feed.apply({"ns": {"coll": "moods"}, "operationType": "insert", "fullDocument": {"date": feed._day}})
+        feed.apply({"ns": {"coll": "moods"}, "operationType": "insert", "fullDocument": {"date": "2001-01-01"}})
+        run(feed.flush({"users", "moods"}))
+
+        assert feed.version == 2
+        assert feed.stats["total_users"] == before["total_users"] + 1
+        assert feed.stats["total_moods"] == before["total_moods"] + 2
+        assert feed.stats["today_moods"] == before["today_moods"] + 1
+
+    def test_falls_back_to_polling(self, server, run, monkeypatch):
+        async def unsupported():
+            raise OperationFailure("The $changeStream stage is only supported on replica sets", code=40573)
+
+        feed = server.AdminStatsFeed(coalesce_seconds=0, poll_seconds=0.05)
+        monkeypatch.setattr(feed, "watch", unsupported)
+
+        user_id = f"test-inproc-{uuid.uuid4().hex[:12]}"
+
+        async def scenario():
+            feed.subscribe()
+            try:
+                assert await feed.wait_for_update(0, 2)
+                seen = feed.version
+                await server.db.users.insert_one({"user_id": user_id, "email": f"{user_id}@example.com"})
+                assert await feed.wait_for_update(seen, 2)
+                return feed.mode
+            finally:
+                feed.unsubscribe()
+
+        assert run(scenario()) == "polling"
+        run(server.db.users.delete_one({"user_id": user_id}))
+
+    def test_reconnect_does_not_double_count(self, server, run, monkeypatch):
+        log = ChangeLog()
+        monkeypatch.setattr(type(server.db), "watch", lambda db, pipeline, **kwargs: log.watch(db, pipeline, **kwargs), raising=False)
+        feed = server.AdminStatsFeed(coalesce_seconds=0, poll_seconds=0.05)
+        user_ids = []
+
+        async def insert_users(count):
+            for _ in range(count):
+                user_id = f"test-inproc-{uuid.uuid4().hex[:12]}"
+                user_ids.append(user_id)
+                await server.db.users.insert_one({"user_id": user_id, "email": f"{user_id}@example.com"})
+                log.events.append({"ns": {"coll": "users"}, "operationType": "insert", "_id": len(log.events)})
+
+        async def wait_for(predicate):
+            for _ in range(200):
+                if predicate():
+                    return
+                await asyncio.sleep(0.01)
+            raise AssertionError(feed.stats)
+
+        async def scenario():
+            feed.subscribe()
+            try:
+                await wait_for(lambda: feed.mode == "change_stream")
+                before = feed.stats["total_users"]
+                await insert_users(3)
+                await wait_for(lambda: feed.stats["total_users"] == before + 3)
+
+                # Two more users land while the stream is down; the recount includes them
+                log.fail = True
+                await insert_users(2)
+                await wait_for(lambda: log.opens == 2 and feed.mode == "change_stream")
+                await asyncio.sleep(0.1)
+                assert feed.stats["total_users"] == before + 5
+
+                await insert_users(1)
+                await wait_for(lambda: feed.stats["total_users"] == before + 6)
+                await asyncio.sleep(0.1)
+                assert feed.stats["total_users"] == before + 6
+            finally:
+                feed.unsubscribe()
+
+        try:
+            run(scenario())
+        finally:
+            run(server.db.users.delete_many({"user_id": {"$in": user_ids}}))
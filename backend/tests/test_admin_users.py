@@ -0,0 +1,179 @@
+"""
+Tests for GET /api/admin/users
+Tests:
+- Subscription info, mood count and last activity are returned per user
+- The number of DB commands per page is constant (no per-user queries)
+- Search matches case- and accent-insensitive prefixes of name tokens and email
+- Activity summary on users is maintained by mood and subscription writes, one mood per user and day
+- sort= and filter= on the denormalized fields
+"""
+import uuid
+from datetime import datetime, timezone, timedelta
+
+import pytest
+from pymongo.errors import DuplicateKeyError
+
+
+def create_batch(server, run, make_user, batch, size):
+    user_ids = []
+    for i in range(size):
+        user_id, _ = make_user(email=f"{batch}-{i}@example.com")
+        user_ids.append(user_id)
+    now = datetime.now(timezone.utc)
+    run(server.db.moods.insert_many([
+        {"mood_id": f"mood_{uuid.uuid4().hex[:12]}", "user_id": user_id, "mood_type": "miran", "score": 4,
+         "date": (now - timedelta(days=day)).strftime("%Y-%m-%d"), "created_at": now.isoformat()}
+        for user_id in user_ids for day in range(2)
+    ]))
+    run(server.db.subscriptions.insert_one({
+        "user_id": user_ids[0], "plan_id": "trial", "is_trial": True, "status": "active",
+        "started_at": now.isoformat(), "expires_at": (now + timedelta(days=3)).isoformat(), "updated_at": now.isoformat()
+    }))
+    run(server.backfill_user_activity())
+    return user_ids
+
+
+def list_users(run, api, headers, search, **params):
+    response = run(api.get("/api/admin/users", params={"search": search, "limit": 50, **params}, headers=headers))
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+class TestAdminListUsers:
+    def test_enriched_fields(self, server, run, api, make_user, admin_headers):
+        batch = f"batch{uuid.uuid4().hex[:8]}"
+        user_ids = create_batch(server, run, make_user, batch, 3)
+
+        data = list_users(run, api, admin_headers, batch)
+        assert data["total"] == 3
+        by_id = {u["user_id"]: u for u in data["users"]}
+        today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+        for user_id in user_ids:
+            assert by_id[user_id]["mood_count"] == 2
+            assert by_id[user_id]["last_active"] == today
+        assert by_id[user_ids[0]]["is_trial"] is True
+        assert by_id[user_ids[0]]["is_premium"] is True
+        assert by_id[user_ids[1]]["is_premium"] is False
+
+    def test_constant_number_of_db_commands_per_page(self, server, run, api, make_user, admin_headers, db_commands):
+        small_batch = f"batch{uuid.uuid4().hex[:8]}"
+        large_batch = f"batch{uuid.uuid4().hex[:8]}"
+        create_batch(server, run, make_user, small_batch, 2)
+        create_batch(server, run, make_user, large_batch, 25)
+
+        db_commands.clear()
+        assert len(list_users(run, api, admin_headers, small_batch)["users"]) == 2
+        small_page_commands = list(db_commands)
+
+        db_commands.clear()
+        assert len(list_users(run, api, admin_headers, large_batch)["users"]) == 25
+        large_page_commands = list(db_commands)
+
+        assert small_page_commands, "No MongoDB commands were recorded"
+        assert len(large_page_commands) == len(small_page_commands), (
+            f"DB commands grew with page size: {small_page_commands} vs {large_page_commands}"
+        )
+
+
+class TestAdminUserSearch:
+    def test_prefix_search_on_name_tokens(self, server, run, api, make_user, admin_headers):
+        surname = f"Đorđević{uuid.uuid4().hex[:6]}"
+        user_id, _ = make_user(name=f"Marko {surname}")
+
+        for search in (surname.upper(), f"djordjevic{surname[-6:]}", f"marko {surname[:4]}"):
+            data = list_users(run, api, admin_headers, search)
+            assert [u["user_id"] for u in data["users"]] == [user_id], search
+            assert "search_terms" not in data["users"][0]
+
+        assert list_users(run, api, admin_headers, surname[2:])["total"] == 0
+
+    def test_search_is_not_a_regex(self, server, run, api, make_user, admin_headers):
+        assert list_users(run, api, admin_headers, ".*")["total"] == 0
+
+    def test_backfill_sets_missing_search_terms(self, server, run, make_user):
+        user_id, _ = make_user(name="Jelena Šarić")
+        run(server.db.users.update_one({"user_id": user_id}, {"$unset": {"search_terms": ""}}))
+
+        run(server.backfill_user_search_terms())
+        user = run(server.db.users.find_one({"user_id": user_id}))
+        assert {"jelena", "saric", "jelena saric"} <= set(user["search_terms"])
+
+
+class TestUserActivitySummary:
+    def test_create_mood_updates_summary(self, server, run, api, make_user):
+        user_id, headers = make_user()
+        for _ in range(2):
+            response = run(api.post("/api/moods", json={"mood_type": "srecan"}, headers=headers))
+            assert response.status_code == 200, response.text
+
+        user = run(server.db.users.find_one({"user_id": user_id}))
+        assert user["mood_count"] == 1
+        assert user["last_mood_date"] == server.user_today(user)
+
+    def test_one_mood_per_user_and_day(self, server, run, make_user):
+        run(server.ensure_indexes())
+        assert run(server.db.moods.index_information())["user_id_1_date_-1"].get("unique")
+        user_id, _ = make_user()
+        mood = {"user_id": user_id, "date": "2000-01-01", "mood_type": "miran", "score": 4}
+        run(server.db.moods.insert_one(dict(mood)))
+        with pytest.raises(DuplicateKeyError):
+            run(server.db.moods.insert_one(dict(mood)))
+
+    def test_backfill_covers_users_who_logged_a_mood_first(self, server, run, api, make_user):
+        user_id, headers = make_user()
+        now = datetime.now(timezone.utc)
+        run(server.db.subscriptions.insert_one({
+            "user_id": user_id, "plan_id": "trial", "is_trial": True, "status": "active",
+            "started_at": now.isoformat(), "expires_at": now + timedelta(days=3), "updated_at": now.isoformat()
+        }))
+        assert run(api.post("/api/moods", json={"mood_type": "miran"}, headers=headers)).status_code == 200
+
+        run(server.backfill_user_activity())
+        user = run(server.db.users.find_one({"user_id": user_id}))
+        assert user["mood_count"] == 1
+        assert user["subscription_status"] == "trial"
+
+    def test_grant_and_revoke_update_status(self, server, run, api, make_user, admin_headers):
+        user_id, _ = make_user()
+        response = run(api.post("/api/admin/grant-premium", json={"user_id": user_id, "days": 30}, headers=admin_headers))
+        assert response.status_code == 200, response.text
+        assert run(server.db.users.find_one({"user_id": user_id}))["subscription_status"] == "premium"
+
+        response = run(api.post("/api/admin/revoke-premium", json={"user_id": user_id}, headers=admin_headers))
+        assert response.status_code == 200, response.text
+        assert run(server.db.users.find_one({"user_id": user_id}))["subscription_status"] == "inactive"
+
+
+class TestAdminUserSortAndFilter:
+    def test_sort_by_mood_count(self, server, run, api, make_user, admin_headers):
+        batch = f"batch{uuid.uuid4().hex[:8]}"
+        user_ids = create_batch(server, run, make_user, batch, 3)
+        run(server.db.users.update_one({"user_id": user_ids[2]}, {"$set": {"mood_count": 10}}))
+
+        data = list_users(run, api, admin_headers, batch, sort="-mood_count")
+        assert [u["user_id"] for u in data["users"]][0] == user_ids[2]
+
+    def test_every_sort_field_is_indexed(self, server, run):
+        run(server.ensure_indexes())
+        indexed = [[field for field, _ in index["key"]] for index in run(server.db.users.index_information()).values()]
+        for field in server.ADMIN_USER_SORT_FIELDS:
+            assert [field, "user_id"] in indexed, field
+        for field in ("last_mood_date", "mood_count"):
+            assert ["subscription_status", field, "user_id"] in indexed, field
+
+    def test_filter_inactive_trial_users(self, server, run, api, make_user, admin_headers):
+        batch = f"batch{uuid.uuid4().hex[:8]}"
+        user_ids = create_batch(server, run, make_user, batch, 3)
+        old = (datetime.now(timezone.utc) - timedelta(days=20)).strftime("%Y-%m-%d")
+        run(server.db.users.update_one({"user_id": user_ids[0]}, {"$set": {"last_mood_date": old}}))
+
+        data = list_users(run, api, admin_headers, batch, filter="status:trial,inactive_days:14")
+        assert [u["user_id"] for u in data["users"]] == [user_ids[0]]
+        assert data["users"][0]["is_trial"] is True
+        assert list_users(run, api, admin_headers, batch, filter="min_moods:2")["total"] == 3
+
+    def test_invalid_sort_and_filter(self, run, api, admin_headers):
+        response = run(api.get("/api/admin/users", params={"sort": "password"}, headers=admin_headers))
+        assert response.status_code == 400
+        response = run(api.get("/api/admin/users", params={"filter": "status:gold"}, headers=admin_headers))
+        assert response.status_code == 400
@@ -0,0 +1,74 @@
+"""
+Tests for the hedged /api/ai/tips endpoint
+Tests:
+- An LLM tip that arrives after the hedge fired is cached and served once on the next request
+- A late tip already served to a request that joined the same call is not cached again
+"""
+import asyncio
+
+import pytest
+
+
+class GatedProvider:
+    def __init__(self):
+        self.gate = asyncio.Event()
+        self.calls = 0
+
+    async def complete(self, session_id, system_message, text):
+        self.calls += 1
+        call = self.calls
+        await self.gate.wait()
+        return f"AI savet {call}"
+
+
+@pytest.fixture
+def provider(server, monkeypatch):
+    provider = GatedProvider()
+    gateway = server.LlmGateway(provider, max_concurrency=4, call_timeout=5, failure_threshold=5, reset_seconds=60)
+    monkeypatch.setattr(server, "llm_gateway", gateway)
+    monkeypatch.setattr(server, "AI_TIP_HEDGE_SECONDS", 0.05)
+    monkeypatch.setattr(server, "AI_TIP_CACHE_LATE_REPLIES", True)
+
+    async def is_premium(user_id):
+        return True
+    monkeypatch.setattr(server, "is_premium", is_premium)
+    return provider
+
+
+def get_tip(run, api, headers):
+    response = run(api.post("/api/ai/tips", headers=headers))
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def test_late_tip_is_cached_for_the_next_request(server, run, api, make_user, provider):
+    user_id, headers = make_user()
+    assert get_tip(run, api, headers)["source"] == "local"
+
+    async def release():
+        provider.gate.set()
+        await asyncio.sleep(0.05)
+    run(release())
+
+    tip = get_tip(run, api, headers)
+    assert (tip["source"], tip["tip"]) == ("ai", "AI savet 1")
+    assert run(server.db.ai_tip_cache.find_one({"_id": user_id})) is None
+
+
+def test_joined_request_consumes_the_late_tip(server, run, api, make_user, provider):
+    user_id, headers = make_user()
+    assert get_tip(run, api, headers)["source"] == "local"
+
+    async def retry_then_release():
+        retry = asyncio.ensure_future(api.post("/api/ai/tips", headers=headers))
+        await asyncio.sleep(0.01)
+        provider.gate.set()
+        response = await retry
+        await asyncio.sleep(0.05)
+        return response.json()
+    tip = run(retry_then_release())
+    assert (tip["source"], tip["tip"]) == ("ai", "AI savet 1")
+    assert provider.calls == 1
+    assert run(server.db.ai_tip_cache.find_one({"_id": user_id})) is None
+
+    assert get_tip(run, api, headers)["tip"] == "AI savet 2"
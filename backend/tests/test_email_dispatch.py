@@ -0,0 +1,107 @@
+"""
+Tests for the batched email dispatcher and the email outbox
+Tests:
+- Messages are grouped into provider batch requests of at most 100
+- Sent messages are logged in email_logs, rejected batches are not
+- The token bucket keeps requests within the configured rate
+- The outbox dedups on (user, type, day), retries failures with backoff and reclaims expired leases
+"""
+import time
+import uuid
+from datetime import datetime, timezone
+
+import pytest
+
+
+def messages(count, email_type):
+    return [
+        {"to": f"user{i}@example.com", "subject": "Podsetnik", "html": "<p>Zdravo</p>",
+         "user_id": f"test-inproc-{uuid.uuid4().hex[:12]}", "email_type": email_type}
+        for i in range(count)
+    ]
+
+
+@pytest.fixture
+def email_type(server, run):
+    email_type = f"test_{uuid.uuid4().hex[:8]}"
+    yield email_type
+    run(server.db.email_logs.delete_many({"email_type": email_type}))
+
+
+class TestEmailDispatch:
+    def test_batches_and_logs(self, server, run, email_api, email_type):
+        assert len(run(server.deliver_emails(messages(250, email_type)))) == 250
+
+        assert [path for path, _ in email_api.requests] == ["/emails/batch"] * 3
+        assert sorted(len(body) for _, body in email_api.requests) == [50, 100, 100]
+        assert len(email_api.sent) == 250
+        assert run(server.db.email_logs.count_documents({"email_type": email_type})) == 250
+
+    def test_rejected_batch_is_not_logged(self, server, run, email_api, email_type):
+        email_api.status_code = 422
+        assert run(server.deliver_emails(messages(3, email_type))) == []
+        assert run(server.db.email_logs.count_documents({"email_type": email_type})) == 0
+
+    def test_token_bucket_rate(self, server, run):
+        bucket = server.TokenBucket(rate=50, capacity=1)
+
+        async def take(n):
+            for _ in range(n):
+                await bucket.acquire()
+
+        started = time.monotonic()
+        run(take(6))
+        assert time.monotonic() - started >= 0.09
+
+
+@pytest.fixture
+def outbox_messages(server, run):
+    user_ids = []
+
+    def factory(count, email_type="mood_reminder", day="2026-01-01"):
+        batch = messages(count, email_type)
+        for m in batch:
+            m["day"] = day
+            user_ids.append(m["user_id"])
+        return batch
+
+    yield factory
+    run(server.db.email_outbox.delete_many({"user_id": {"$in": user_ids}}))
+    run(server.db.email_logs.delete_many({"user_id": {"$in": user_ids}}))
+
+
+class TestEmailOutbox:
+    def test_enqueue_is_idempotent(self, server, run, email_api, outbox_messages):
+        batch = outbox_messages(3)
+        assert run(server.enqueue_emails(batch)) == 3
+        assert run(server.enqueue_emails(batch)) == 0
+
+        assert run(server.drain_email_outbox()) == 3
+        assert run(server.enqueue_emails(batch)) == 0
+        assert run(server.drain_email_outbox()) == 0
+        assert sorted(email_api.sent) == sorted(m["to"] for m in batch)
+
+    def test_failed_delivery_is_retried_with_backoff(self, server, run, email_api, outbox_messages):
+        batch = outbox_messages(2)
+        run(server.enqueue_emails(batch))
+        email_api.status_code = 422
+        assert run(server.drain_email_outbox()) == 0
+
+        keys = [server.outbox_key(m["user_id"], m["email_type"], m["day"]) for m in batch]
+        docs = run(server.db.email_outbox.find({"_id": {"$in": keys}}).to_list(None))
+        assert {d["status"] for d in docs} == {"pending"}
+        assert all(d["attempts"] == 1 and d["next_attempt_at"] > datetime.now(timezone.utc).isoformat() for d in docs)
+
+        # Once the backoff has passed the messages are claimed and delivered
+        email_api.status_code = 200
+        run(server.db.email_outbox.update_many({"_id": {"$in": keys}}, {"$set": {"next_attempt_at": "2000-01-01T00:00:00+00:00"}}))
+        assert run(server.drain_email_outbox()) == 2
+
+    def test_expired_lease_is_reclaimed(self, server, run, email_api, outbox_messages):
+        batch = outbox_messages(1)
+        run(server.enqueue_emails(batch))
+        key = server.outbox_key(batch[0]["user_id"], batch[0]["email_type"], batch[0]["day"])
+        run(server.db.email_outbox.update_one({"_id": key}, {"$set": {"status": "sending", "lease_until": "2000-01-01T00:00:00+00:00"}}))
+
+        assert run(server.drain_email_outbox()) == 1
+        assert run(server.db.email_outbox.find_one({"_id": key}))["status"] == "sent"
@@ -0,0 +1,66 @@
+"""
+Tests for email templates
+Tests:
+- Every template renders subject, html and text parts
+- Recipient fields are escaped in html only, shells are rendered once per shared context
+- Queued emails carry the text part through to the email API
+"""
+from datetime import datetime, timezone
+
+import pytest
+
+
+@pytest.mark.parametrize("name,context", [
+    ("mood_reminder", {}),
+    ("trial_warning", {"days_left": 2}),
+    ("trial_expired", {}),
+])
+def test_templates_render_all_parts(server, name, context):
+    email = server.email_templates.render(name, {"user_name": "Ana"}, **context)
+    assert set(email) == {"subject", "html", "text"}
+    assert "\n" not in email["subject"]
+    assert "Zdravo, Ana!" in email["html"] and "Zdravo, Ana!" in email["text"]
+    assert "<" not in email["text"]
+    assert f"{server.APP_URL}/" in email["text"]
+
+
+def test_recipient_fields_are_escaped_in_html_only(server):
+    email = server.email_templates.render("trial_warning", {"user_name": "<b>Ana & Marko</b>"}, days_left=1)
+    assert "&lt;b&gt;Ana &amp; Marko&lt;/b&gt;" in email["html"]
+    assert "<b>Ana & Marko</b>" in email["text"]
+    assert "za 1 dana" in email["subject"]
+
+
+def test_shell_is_rendered_once_per_context(server, monkeypatch):
+    templates = server.EmailTemplates(server.EMAIL_TEMPLATE_DIR, app_url="https://example.test", trial_days=7)
+    loads = []
+    original = templates.env.get_template
+    monkeypatch.setattr(templates.env, "get_template", lambda name, *args, **kwargs: loads.append(name) or original(name, *args, **kwargs))
+
+    templates.render("trial_warning", {"user_name": "Korisnik"}, days_left=2)
+    per_shell = len(loads)
+    assert per_shell > 0
+    for i in range(50):
+        templates.render("trial_warning", {"user_name": f"Korisnik {i}"}, days_left=2)
+    assert len(loads) == per_shell
+    templates.render("trial_warning", {"user_name": "Ana"}, days_left=1)
+    assert len(loads) == 2 * per_shell
+
+
+def test_queued_email_includes_text_part(server, run, make_user, email_api):
+    user_id, _ = make_user()
+    day = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    email = server.email_templates.render("mood_reminder", {"user_name": "Ana"})
+    try:
+        run(server.enqueue_emails([{
+            "to": f"{user_id}@example.com", **email, "user_id": user_id, "email_type": "mood_reminder", "day": day
+        }]))
+        run(server.drain_email_outbox())
+
+        sent = [body for _, body in email_api.requests for body in (body if isinstance(body, list) else [body])]
+        ours = [body for body in sent if body["to"] == [f"{user_id}@example.com"]]
+        assert len(ours) == 1
+        assert ours[0]["text"] == email["text"]
+    finally:
+        run(server.db.email_outbox.delete_many({"user_id": user_id}))
+        run(server.db.email_logs.delete_many({"user_id": user_id}))
@@ -0,0 +1,70 @@
+"""
+Tests for the LLM gateway circuit breaker
+Tests:
+- A half-open stream probe abandoned by the client re-opens the breaker instead of wedging it
+- A stream that outlives the call timeout fails and counts against the breaker
+- Concurrent streams with the same key share one upstream stream
+"""
+import asyncio
+
+import pytest
+
+
+class StaticStreamProvider:
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.streams = 0
+
+    async def complete(self, session_id, system_message, text):
+        return "ok"
+
+    async def stream(self, session_id, system_message, text):
+        self.streams += 1
+        for chunk in ("a", "b", "c"):
+            yield chunk
+            await asyncio.sleep(self.delay)
+
+
+def test_abandoned_half_open_stream_allows_next_probe(server, run):
+    gateway = server.LlmGateway(StaticStreamProvider(delay=1), max_concurrency=2, call_timeout=5, failure_threshold=1, reset_seconds=0)
+    gateway._record_failure()
+    assert gateway.state == "open"
+
+    async def read_one_chunk():
+        stream = gateway.stream("key", "s", "system", "text")
+        assert await stream.__anext__() == "a"
+        assert gateway.state == "half_open"
+        await stream.aclose()
+    run(read_one_chunk())
+
+    assert gateway.state == "open"
+    assert run(gateway.complete("key", "s", "system", "text")) == "ok"
+    assert gateway.state == "closed"
+
+
+def test_stream_deadline(server, run):
+    gateway = server.LlmGateway(StaticStreamProvider(delay=0.1), max_concurrency=2, call_timeout=0.15, failure_threshold=1, reset_seconds=60)
+
+    async def read_all():
+        return [chunk async for chunk in gateway.stream("key", "s", "system", "text")]
+    with pytest.raises(server.LlmUnavailable):
+        run(read_all())
+    assert gateway.state == "open"
+
+
+def test_same_key_streams_share_one_upstream(server, run):
+    provider = StaticStreamProvider(delay=0.01)
+    gateway = server.LlmGateway(provider, max_concurrency=2, call_timeout=5, failure_threshold=1, reset_seconds=60)
+
+    async def read_all(key):
+        return "".join([chunk async for chunk in gateway.stream(key, "s", "system", "text")])
+
+    async def read_concurrently():
+        first = asyncio.ensure_future(read_all("key"))
+        await asyncio.sleep(0.015)
+        # Joins after the first chunk and still gets the whole reply
+        return await asyncio.gather(first, read_all("key"), read_all("other"))
+    assert run(read_concurrently()) == ["abc", "abc", "abc"]
+    assert provider.streams == 2
+    assert gateway.state == "closed"
+    assert not gateway._streams
@@ -0,0 +1,77 @@
+"""
+Tests for the pending payment reconciliation sweeper
+Tests:
+- Stale paid sessions are activated through activate_paid_subscription
+- Sessions Stripe reports as expired, or older than 24h, are marked expired
+- Fresh and still-open sessions are left alone
+- Stripe errors are counted and don't stop the run, and don't keep abandoned sessions pending
+- POST /api/admin/reconcile-payments requires admin access
+"""
+from datetime import timedelta
+
+
+class TestReconcilePendingPayments:
+    def test_resolves_stale_transactions(self, server, run, make_user, make_transaction, local_stripe):
+        user_id, _ = make_user()
+        stale = timedelta(minutes=30)
+        paid = make_transaction(user_id, age=stale)
+        expired = make_transaction(user_id, age=stale)
+        still_open = make_transaction(user_id, payment_status="unpaid", age=stale)
+        abandoned = make_transaction(user_id, age=timedelta(hours=30))
+        broken = make_transaction(user_id, age=stale)
+        lost = make_transaction(user_id, age=timedelta(hours=30))
+        fresh = make_transaction(user_id)
+
+        stripe = local_stripe(
+            statuses={
+                paid: ("complete", "paid"),
+                expired: ("expired", "unpaid"),
+                still_open: ("open", "unpaid"),
+                abandoned: ("open", "unpaid"),
+                fresh: ("complete", "paid"),
+            },
+            default=("open", "unpaid"),
+            failing={broken, lost},
+        )
+        metrics = run(server.reconcile_pending_payments(stripe))
+
+        assert metrics["activated"] >= 1
+        assert metrics["expired"] >= 3
+        assert metrics["errors"] >= 2
+        assert "duration_ms" in metrics
+
+        def payment_status(session_id):
+            txn = run(server.db.payment_transactions.find_one({"session_id": session_id}, {"_id": 0}))
+            return txn["payment_status"]
+
+        assert payment_status(paid) == "paid"
+        assert payment_status(expired) == "expired"
+        assert payment_status(abandoned) == "expired"
+        assert payment_status(still_open) == "unpaid"
+        assert payment_status(broken) == "initiated"
+        assert payment_status(lost) == "expired"
+        assert payment_status(fresh) == "initiated", "Transactions younger than the stale threshold must not be touched"
+
+        sub = run(server.db.subscriptions.find_one({"user_id": user_id}, {"_id": 0}))
+        assert sub["session_id"] == paid
+        assert sub["status"] == "active"
+
+    def test_second_run_is_a_no_op_for_resolved_rows(self, server, run, make_user, make_transaction, local_stripe):
+        user_id, _ = make_user()
+        paid = make_transaction(user_id, age=timedelta(minutes=30))
+        stripe = local_stripe(statuses={paid: ("complete", "paid")}, default=("open", "unpaid"))
+
+        run(server.reconcile_pending_payments(stripe))
+        run(server.reconcile_pending_payments(stripe))
+
+        # The paid row is no longer pending, so it isn't sent to Stripe again
+        txn = run(server.db.payment_transactions.find_one({"session_id": paid}, {"_id": 0}))
+        assert txn["payment_status"] == "paid"
+        assert stripe.checked.count(paid) == 1
+
+
+class TestReconcileEndpoint:
+    def test_requires_admin(self, run, api, make_user):
+        _, headers = make_user()
+        response = run(api.post("/api/admin/reconcile-payments", headers=headers))
+        assert response.status_code == 403
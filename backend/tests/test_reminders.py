@@ -0,0 +1,106 @@
+"""
+Tests for mood reminders
+Tests:
+- Only users whose next_reminder_at has passed and who haven't logged their local day get a reminder
+- Dispatching advances next_reminder_at and logs sent emails
+- Reminder times follow the user's timezone across DST changes
+- Saving settings validates the time and timezone
+- Mood dates use the user's local day
+"""
+from datetime import datetime, timezone, timedelta
+from zoneinfo import ZoneInfo
+
+import pytest
+
+
+@pytest.fixture
+def settings_for(server, run):
+    user_ids = []
+
+    def factory(user_id, next_reminder_at, tz_name="Europe/Belgrade"):
+        user_ids.append(user_id)
+        run(server.db.notification_settings.insert_one({
+            "user_id": user_id, "email_reminders": True, "reminder_time": "20:00", "timezone": tz_name,
+            "trial_warnings": True, "next_reminder_at": next_reminder_at,
+            "reminder_date": next_reminder_at.astimezone(ZoneInfo(tz_name)).strftime("%Y-%m-%d")
+        }))
+
+    yield factory
+    run(server.db.notification_settings.delete_many({"user_id": {"$in": user_ids}}))
+    run(server.db.email_logs.delete_many({"user_id": {"$in": user_ids}}))
+    run(server.db.email_outbox.delete_many({"user_id": {"$in": user_ids}}))
+
+
+class TestSendReminders:
+    def test_only_due_users_without_mood(self, server, run, api, make_user, admin_headers, email_api, settings_for):
+        now = datetime.now(timezone.utc)
+        due, _ = make_user()
+        logged, logged_headers = make_user()
+        later, _ = make_user()
+        stale, _ = make_user()
+        settings_for(due, now - timedelta(minutes=1))
+        settings_for(logged, now - timedelta(minutes=1))
+        settings_for(later, now + timedelta(hours=1))
+        settings_for(stale, now - timedelta(days=3))
+        assert run(api.post("/api/moods", json={"mood_type": "miran"}, headers=logged_headers)).status_code == 200
+
+        response = run(api.post("/api/admin/send-reminders", headers=admin_headers))
+        assert response.status_code == 200, response.text
+        run(server.drain_email_outbox())
+
+        assert email_api.sent == [f"{due}@example.com"]
+        assert run(server.db.email_logs.count_documents({"user_id": due, "email_type": "mood_reminder"})) == 1
+        for user_id in (due, logged, stale):
+            ns = run(server.db.notification_settings.find_one({"user_id": user_id}))
+            assert server.as_utc_datetime(ns["next_reminder_at"]) > now
+
+        run(api.post("/api/admin/send-reminders", headers=admin_headers))
+        run(server.drain_email_outbox())
+        assert email_api.sent == [f"{due}@example.com"]
+
+    def test_schedule_across_dst(self, server):
+        # Europe/Belgrade switches to summer time on 2026-03-29 and back on 2026-10-25
+        before_spring = datetime(2026, 3, 28, 12, tzinfo=timezone.utc)
+        schedule = server.reminder_schedule("20:00", "Europe/Belgrade", before_spring)
+        assert schedule == {"next_reminder_at": datetime(2026, 3, 28, 19, tzinfo=timezone.utc), "reminder_date": "2026-03-28"}
+        schedule = server.reminder_schedule("20:00", "Europe/Belgrade", schedule["next_reminder_at"])
+        assert schedule == {"next_reminder_at": datetime(2026, 3, 29, 18, tzinfo=timezone.utc), "reminder_date": "2026-03-29"}
+
+        schedule = server.reminder_schedule("20:00", "Europe/Belgrade", datetime(2026, 10, 25, 12, tzinfo=timezone.utc))
+        assert schedule["next_reminder_at"] == datetime(2026, 10, 25, 19, tzinfo=timezone.utc)
+
+        # 02:30 doesn't exist on the spring-forward night and fires at 03:30 local
+        schedule = server.reminder_schedule("02:30", "Europe/Belgrade", datetime(2026, 3, 28, 23, tzinfo=timezone.utc))
+        assert schedule["next_reminder_at"] == datetime(2026, 3, 29, 1, 30, tzinfo=timezone.utc)
+
+
+class TestReminderSettings:
+    def test_settings_store_schedule_and_timezone(self, server, run, api, make_user, settings_for):
+        user_id, headers = make_user()
+        settings_for(user_id, datetime.now(timezone.utc))
+        response = run(api.post("/api/settings/notifications", json={
+            "email_reminders": True, "reminder_time": "07:30", "trial_warnings": True, "timezone": "America/New_York"
+        }, headers=headers))
+        assert response.status_code == 200, response.text
+
+        ns = run(server.db.notification_settings.find_one({"user_id": user_id}))
+        fire_at = server.as_utc_datetime(ns["next_reminder_at"]).astimezone(ZoneInfo("America/New_York"))
+        assert (fire_at.hour, fire_at.minute) == (7, 30)
+        assert run(server.db.users.find_one({"user_id": user_id}))["timezone"] == "America/New_York"
+        assert run(api.get("/api/settings/notifications", headers=headers)).json()["timezone"] == "America/New_York"
+
+    def test_invalid_settings(self, run, api, make_user):
+        _, headers = make_user()
+        for body in ({"reminder_time": "25:99"}, {"reminder_time": "20:00", "timezone": "Mars/Olympus"}):
+            response = run(api.post("/api/settings/notifications", json=body, headers=headers))
+            assert response.status_code == 400
+
+
+class TestLocalMoodDate:
+    def test_mood_date_uses_user_timezone(self, server, run, api, make_user):
+        user_id, headers = make_user()
+        run(server.db.users.update_one({"user_id": user_id}, {"$set": {"timezone": "Pacific/Kiritimati"}}))
+
+        response = run(api.post("/api/moods", json={"mood_type": "miran"}, headers=headers))
+        assert response.status_code == 200, response.text
+        assert response.json()["date"] == datetime.now(ZoneInfo("Pacific/Kiritimati")).strftime("%Y-%m-%d")
@@ -0,0 +1,126 @@
+"""
+Tests for the job scheduler
+Tests:
+- Only one of several replicas claims a due job, and an expired lease can be taken over
+- Runs are recorded in job_runs and reschedule the job, failures included
+- Admins can trigger a job and see runs
+"""
+import asyncio
+import uuid
+from datetime import datetime, timezone, timedelta
+
+import pytest
+
+
+@pytest.fixture
+def job_name(server, run):
+    name = f"test_job_{uuid.uuid4().hex[:8]}"
+    yield name
+    run(server.db.scheduler_jobs.delete_many({"_id": name}))
+    run(server.db.job_runs.delete_many({"job": name}))
+
+
+def replica(server, owner, name, func, interval=3600):
+    scheduler = server.JobScheduler(owner, tick_seconds=1, lease_seconds=60)
+    scheduler.add(name, interval, func)
+    return scheduler
+
+
+class TestLeases:
+    def test_one_replica_claims_a_due_job(self, server, run, job_name):
+        calls = []
+
+        async def job():
+            calls.append(1)
+            return len(calls)
+
+        replicas = [replica(server, f"replica-{i}", job_name, job) for i in range(3)]
+        for scheduler in replicas:
+            run(scheduler.register())
+
+        async def claim_all():
+            return await asyncio.gather(*[scheduler.claim(job_name) for scheduler in replicas])
+        claims = run(claim_all())
+        assert sum(1 for claim in claims if claim) == 1
+
+        owner = next(scheduler for scheduler, claim in zip(replicas, claims) if claim)
+        result = run(owner.run_job(job_name))
+        assert result["status"] == "ok" and result["result"] == 1
+
+        # Not due again until the interval has passed
+        assert all(run(scheduler.claim(job_name)) is None for scheduler in replicas)
+        row = run(server.db.scheduler_jobs.find_one({"_id": job_name}))
+        assert row["owner"] is None
+        assert row["last_run"]["status"] == "ok"
+        assert server.as_utc_datetime(row["next_run_at"]) > datetime.now(timezone.utc) + timedelta(minutes=59)
+
+    def test_expired_lease_is_taken_over(self, server, run, job_name):
+        async def job():
+            return 0
+
+        first, second = replica(server, "first", job_name, job), replica(server, "second", job_name, job)
+        run(first.register())
+        assert run(first.claim(job_name))
+        assert run(second.claim(job_name)) is None
+
+        past = (datetime.now(timezone.utc) - timedelta(seconds=1)).isoformat()
+        run(server.db.scheduler_jobs.update_one({"_id": job_name}, {"$set": {"lease_until": past}}))
+        assert run(second.claim(job_name))["owner"] == "second"
+
+
+class TestRuns:
+    def test_failed_run_is_recorded_and_rescheduled(self, server, run, job_name):
+        async def job():
+            raise RuntimeError("boom")
+
+        scheduler = replica(server, "replica", job_name, job, interval=60)
+        run(scheduler.register())
+        assert run(scheduler.claim(job_name))
+        result = run(scheduler.run_job(job_name))
+        assert result["status"] == "error" and result["error"] == "boom"
+
+        runs = run(server.db.job_runs.find({"job": job_name}).to_list(None))
+        assert [r["status"] for r in runs] == ["error"]
+        assert runs[0]["duration_ms"] >= 0
+        row = run(server.db.scheduler_jobs.find_one({"_id": job_name}))
+        assert row["last_run"]["error"] == "boom"
+        assert server.as_utc_datetime(row["next_run_at"]) > datetime.now(timezone.utc)
+
+    def test_tick_runs_due_jobs_once(self, server, run, job_name):
+        calls = []
+
+        async def job():
+            calls.append(1)
+
+        scheduler = replica(server, "replica", job_name, job)
+        run(scheduler.register())
+
+        async def tick_twice():
+            await scheduler.tick()
+            await asyncio.gather(*scheduler.running.values())
+            await scheduler.tick()
+        run(tick_twice())
+        assert calls == [1]
+
+
+class TestSchedulerApi:
+    def test_trigger_and_list(self, server, run, api, admin_headers, job_name, monkeypatch):
+        async def job():
+            return {"done": True}
+
+        scheduler = replica(server, "replica", job_name, job)
+        monkeypatch.setattr(server, "scheduler", scheduler)
+        run(scheduler.register())
+        assert run(scheduler.claim(job_name))
+        run(scheduler.run_job(job_name))
+        assert run(scheduler.claim(job_name)) is None
+
+        response = run(api.post(f"/api/admin/scheduler/{job_name}/run", headers=admin_headers))
+        assert response.status_code == 200, response.text
+        assert run(scheduler.claim(job_name))
+
+        data = run(api.get("/api/admin/scheduler", headers=admin_headers)).json()
+        assert [job["name"] for job in data["jobs"]] == [job_name]
+        assert any(r["job"] == job_name and r["result"] == {"done": True} for r in data["runs"])
+
+        assert run(api.post("/api/admin/scheduler/unknown/run", headers=admin_headers)).status_code == 404
@@ -0,0 +1,107 @@
+"""
+Concurrency tests for subscription activation
+Tests:
+- activate_paid_subscription applies a paid session exactly once under concurrent calls
+- Stripe webhook + consumer and GET /api/subscription/checkout/status/{id} racing on the same session
+- A later session for the same user is applied again
+- A failed subscription write leaves the transaction unpaid so it is retried
+"""
+import asyncio
+import uuid
+
+import pytest
+
+
+class TestActivatePaidSubscription:
+    def test_concurrent_calls_apply_once(self, server, run, make_user, make_transaction):
+        user_id, _ = make_user()
+        session_id = make_transaction(user_id)
+
+        results = run(asyncio.gather(*[server.activate_paid_subscription(session_id) for _ in range(20)]))
+        assert results.count(True) == 1, f"Expected exactly one activation, got {results.count(True)}"
+
+        subs = run(server.db.subscriptions.find({"user_id": user_id}, {"_id": 0}).to_list(10))
+        assert len(subs) == 1
+        assert subs[0]["session_id"] == session_id
+        assert subs[0]["status"] == "active"
+        assert subs[0]["is_trial"] is False
+
+        txn = run(server.db.payment_transactions.find_one({"session_id": session_id}, {"_id": 0}))
+        assert txn["payment_status"] == "paid"
+        assert txn["subscription_applied"] is True
+
+    def test_new_session_is_applied_again(self, server, run, make_user, make_transaction):
+        user_id, _ = make_user()
+        first = make_transaction(user_id)
+        second = make_transaction(user_id, plan_id="yearly")
+
+        assert run(server.activate_paid_subscription(first)) is True
+        assert run(server.activate_paid_subscription(second)) is True
+        assert run(server.activate_paid_subscription(first)) is False
+
+        sub = run(server.db.subscriptions.find_one({"user_id": user_id}, {"_id": 0}))
+        assert sub["session_id"] == second
+        assert sub["plan_id"] == "yearly"
+
+    def test_failed_subscription_write_is_retried(self, server, run, make_user, make_transaction, monkeypatch):
+        user_id, _ = make_user()
+        session_id = make_transaction(user_id)
+        collection_class = type(server.db.subscriptions)
+        original = collection_class.update_one
+        failures = []
+
+        async def failing_update_one(collection, *args, **kwargs):
+            if collection.name == "subscriptions" and not failures:
+                failures.append(1)
+                raise RuntimeError("write failed")
+            return await original(collection, *args, **kwargs)
+        monkeypatch.setattr(collection_class, "update_one", failing_update_one)
+
+        with pytest.raises(RuntimeError):
+            run(server.activate_paid_subscription(session_id))
+        txn = run(server.db.payment_transactions.find_one({"session_id": session_id}, {"_id": 0}))
+        assert txn["payment_status"] != "paid"
+        assert "subscription_applied" not in txn
+
+        assert run(server.activate_paid_subscription(session_id)) is True
+        txn = run(server.db.payment_transactions.find_one({"session_id": session_id}, {"_id": 0}))
+        assert txn["payment_status"] == "paid"
+        assert run(server.db.subscriptions.find_one({"user_id": user_id}))["session_id"] == session_id
+
+    def test_unknown_session_is_ignored(self, server, run):
+        assert run(server.activate_paid_subscription(f"cs_missing_{uuid.uuid4().hex}")) is False
+
+
+class TestWebhookAndPollingRace:
+    def test_webhook_and_status_poll_at_the_same_time(self, server, run, api, make_user, make_transaction, local_stripe, monkeypatch):
+        user_id, headers = make_user()
+        session_id = make_transaction(user_id)
+        monkeypatch.setattr(server, "stripe_client", local_stripe())
+
+        activations = []
+        original = server.activate_paid_subscription
+
+        async def counting_activate(sid):
+            applied = await original(sid)
+            activations.append(applied)
+            return applied
+        monkeypatch.setattr(server, "activate_paid_subscription", counting_activate)
+
+        async def webhook_path():
+            resp = await api.post("/api/webhook/stripe", content=session_id.encode(), headers={"Stripe-Signature": "t=1,v1=test"})
+            assert resp.status_code == 200
+            await server.drain_stripe_events()
+
+        async def polling_path():
+            resp = await api.get(f"/api/subscription/checkout/status/{session_id}", headers=headers)
+            assert resp.status_code == 200
+            assert resp.json()["payment_status"] == "paid"
+
+        for _ in range(3):
+            run(asyncio.gather(webhook_path(), polling_path(), polling_path()))
+
+        assert activations.count(True) == 1, f"Expected exactly one activation, got {activations}"
+        subs = run(server.db.subscriptions.find({"user_id": user_id}, {"_id": 0}).to_list(10))
+        assert len(subs) == 1
+        assert subs[0]["session_id"] == session_id
+        run(server.db.stripe_events.delete_many({"session_id": session_id}))
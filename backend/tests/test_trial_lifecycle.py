@@ -0,0 +1,101 @@
+"""
+Tests for the trial lifecycle job
+Tests:
+- Warnings go out 2 and 1 days before expiry, the expired email within 24h after, each once
+- Trials past expires_at are flipped to expired and mirrored on the user
+- Legacy ISO string expiries are converted to native dates
+"""
+from datetime import datetime, timezone, timedelta
+
+import pytest
+
+
+@pytest.fixture
+def trial_for(server, run):
+    user_ids = []
+
+    def factory(user_id, expires_in, trial_warnings=True, is_trial=True):
+        user_ids.append(user_id)
+        sub = {
+            "user_id": user_id, "plan_id": "trial" if is_trial else "monthly", "is_trial": is_trial, "status": "active",
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "expires_at": datetime.now(timezone.utc) + expires_in,
+            "updated_at": datetime.now(timezone.utc).isoformat()
+        }
+        run(server.db.subscriptions.insert_one(sub))
+        run(server.sync_user_subscription(user_id, sub))
+        if not trial_warnings:
+            run(server.db.notification_settings.insert_one({"user_id": user_id, "trial_warnings": False}))
+
+    yield factory
+    run(server.db.notification_settings.delete_many({"user_id": {"$in": user_ids}}))
+    run(server.db.email_logs.delete_many({"user_id": {"$in": user_ids}}))
+    run(server.db.email_outbox.delete_many({"user_id": {"$in": user_ids}}))
+
+
+class TestTrialEmails:
+    def test_warnings_and_expired_emails_once(self, server, run, api, make_user, admin_headers, email_api, trial_for):
+        users = {}
+        for key, expires_in, warnings in (
+            ("two_days", timedelta(days=2, hours=12), True),
+            ("one_day", timedelta(days=1, hours=12), True),
+            ("opted_out", timedelta(days=1, hours=12), False),
+            ("later", timedelta(days=5), True),
+            ("just_expired", timedelta(hours=-2), True),
+            ("long_expired", timedelta(days=-3), True),
+        ):
+            users[key], _ = make_user()
+            trial_for(users[key], expires_in, trial_warnings=warnings)
+
+        response = run(api.post("/api/admin/send-trial-warnings", headers=admin_headers))
+        assert response.status_code == 200, response.text
+        run(server.drain_email_outbox())
+
+        logs = run(server.db.email_logs.find({"user_id": {"$in": list(users.values())}}, {"_id": 0}).to_list(None))
+        assert {(log["user_id"], log["email_type"]) for log in logs} == {
+            (users["two_days"], "trial_warning_2"),
+            (users["one_day"], "trial_warning_1"),
+            (users["just_expired"], "trial_expired"),
+        }
+
+        run(api.post("/api/admin/send-trial-warnings", headers=admin_headers))
+        run(server.drain_email_outbox())
+        assert run(server.db.email_logs.count_documents({"user_id": {"$in": list(users.values())}})) == 3
+
+
+class TestTrialExpiry:
+    def test_expired_trials_are_flipped(self, server, run, make_user, email_api, trial_for):
+        expired, _ = make_user()
+        active, _ = make_user()
+        paid, _ = make_user()
+        trial_for(expired, timedelta(hours=-1))
+        trial_for(active, timedelta(days=4))
+        trial_for(paid, timedelta(hours=-1), is_trial=False)
+        # A cached entitlement must not outlive the flip
+        run(server.get_active_subscription(expired))
+
+        result = run(server.run_trial_lifecycle())
+        assert result["expired"] >= 1
+
+        assert run(server.db.subscriptions.find_one({"user_id": expired}))["status"] == "expired"
+        assert run(server.db.users.find_one({"user_id": expired}))["subscription_status"] == "inactive"
+        assert run(server.get_active_subscription(expired)) is None
+        assert run(server.db.subscriptions.find_one({"user_id": active}))["status"] == "active"
+        assert run(server.db.users.find_one({"user_id": active}))["subscription_status"] == "trial"
+        assert run(server.db.subscriptions.find_one({"user_id": paid}))["status"] == "active"
+
+    def test_string_expiries_are_converted(self, server, run, make_user):
+        user_id, _ = make_user()
+        expires_at = datetime.now(timezone.utc) + timedelta(days=2)
+        run(server.db.subscriptions.insert_one({
+            "user_id": user_id, "plan_id": "trial", "is_trial": True, "status": "active",
+            "expires_at": expires_at.isoformat()
+        }))
+        run(server.db.users.update_one({"user_id": user_id}, {"$set": {"subscription_expires_at": expires_at.isoformat()}}))
+
+        run(server.backfill_subscription_dates())
+
+        sub = run(server.db.subscriptions.find_one({"user_id": user_id}))
+        assert isinstance(sub["expires_at"], datetime)
+        assert abs(server.as_utc_datetime(sub["expires_at"]) - expires_at) < timedelta(milliseconds=1)
+        assert isinstance(run(server.db.users.find_one({"user_id": user_id}))["subscription_expires_at"], datetime)
@@ -22,11 +22,22 @@ export default function AdminPanel({ user }) {
 
   useEffect(() => {
     if (isAdmin) {
-      loadStats();
       loadUsers();
     }
   }, [isAdmin, page, search]);
 
+  // Live stats over SSE; falls back to a one-off fetch if the stream can't be opened
+  useEffect(() => {
+    if (!isAdmin) return;
+    loadStats();
+    const source = new EventSource(`${API}/admin/stats/stream`, { withCredentials: true });
+    source.addEventListener("stats", (e) => setStats(JSON.parse(e.data)));
+    source.onerror = () => {
+      if (source.readyState === EventSource.CLOSED) loadStats();
+    };
+    return () => source.close();
+  }, [isAdmin]);
+
   const checkAdmin = async () => {
     try {
       const res = await fetchWithAuth(`${API}/admin/check`);
@@ -20,6 +20,8 @@ export default function PaymentSuccess() {
   const pollStatus = async (sid, attempts) => {
     const maxAttempts = 5;
     const pollInterval = 2000;
+    // Server holds each request until the payment is confirmed (long-poll)
+    const waitSeconds = 10;
 
     if (attempts >= maxAttempts) {
       setStatus("timeout");
@@ -27,7 +29,7 @@ export default function PaymentSuccess() {
     }
 
     try {
-      const res = await fetchWithAuth(`${API}/subscription/checkout/status/${sid}`);
+      const res = await fetchWithAuth(`${API}/subscription/checkout/status/${sid}?wait=${waitSeconds}`);
       if (!res.ok) throw new Error("Failed");
       const data = await res.json();
 
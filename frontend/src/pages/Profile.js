@@ -46,9 +46,11 @@ export default function Profile({ user }) {
   const saveNotificationSettings = async (newSettings) => {
     setSavingNotif(true);
     try {
+      // Reminders fire at reminder_time in the browser's timezone
+      const timezone = Intl.DateTimeFormat().resolvedOptions().timeZone;
       const res = await fetchWithAuth(`${API}/settings/notifications`, {
         method: "POST",
-        body: JSON.stringify(newSettings)
+        body: JSON.stringify({ ...newSettings, timezone })
       });
       if (res.ok) {
         setNotifSettings(newSettings);